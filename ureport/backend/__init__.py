@@ -4,9 +4,21 @@ from __future__ import absolute_import, division, print_function, unicode_litera
 from abc import ABCMeta, abstractmethod
 
 
+class SkippedPullResults(tuple):
+    """
+    The empty results stats of a results pull that did not run, because another sync of the poll holds its lock
+    """
+
+    def __new__(cls):
+        return super(SkippedPullResults, cls).__new__(cls, (0, 0, 0, 0, 0, 0))
+
+
 class BaseBackend(object):
     __metaclass__ = ABCMeta
 
+    # whether the results synced by the backend are added to the contact activity sketches
+    feeds_activity_sketches = False
+
     def __init__(self, backend):
         self.backend = backend
 
@@ -29,13 +41,28 @@ class BaseBackend(object):
         pass
 
     @abstractmethod
-    def pull_contacts(self, org, modified_after, modified_before, progress_callback=None):
+    def pull_contacts(
+        self, org, modified_after, modified_before, progress_callback=None, resume_cursor=None, time_limit=None
+    ):
         """
         Pulls contacts modified in the given time window
         :param org: the org
         :param datetime modified_after: pull contacts modified after this
         :param datetime modified_before: pull contacts modified before this
-        :param progress_callback: callable that will be called from time to time with number of contacts pulled
-        :return: tuple of the number of contacts created, updated, deleted and ignored
+        :param progress_callback: callable that will be called after each fetch with number of contacts pulled and
+                                  the cursor to resume from after that fetch
+        :param resume_cursor: cursor returned by a previous pull of the same time window to resume from
+        :param time_limit: number of seconds after which to stop fetching and return a resume cursor
+        :return: tuple of the number of contacts created, updated, deleted and ignored and a possible cursor if
+                 fetching didn't complete
         """
         pass
+
+    def pull_results_for_polls(self, org, polls):
+        """
+        Pulls the results of several polls at once, for backends able to share fetches between polls
+        :param org: the org
+        :param polls: the polls
+        :return: dict of the results stats tuples by poll id of the polls synced, polls left out must be synced alone
+        """
+        return dict()
@@ -2,10 +2,10 @@
 from __future__ import absolute_import, division, print_function, unicode_literals
 
 import logging
+import threading
 import time
 from collections import defaultdict
 
-import requests
 from django_redis import get_redis_connection
 from temba_client.v2 import TembaClient
 
@@ -17,12 +17,17 @@ from dash.utils.sync import BaseSyncer, SyncOutcome, sync_local_to_changes
 from ureport.contacts.models import Contact
 from ureport.locations.models import Boundary
 from ureport.polls.models import Poll, PollQuestion, PollResponseCategory, PollResult
-from ureport.utils import datetime_to_json_date, json_date_to_datetime
+from ureport.stats.models import ContactActivity
+from ureport.utils import datetime_to_json_date, get_http_session, json_date_to_datetime, prefetch_iter
 
-from . import BaseBackend
+from . import BaseBackend, SkippedPullResults
 
 logger = logging.getLogger(__name__)
 
+# pooled sessions shared by the backend instances of the same FLOIP backend, by backend id
+_sessions = dict()
+_sessions_lock = threading.Lock()
+
 
 class ContactSyncer(BaseSyncer):
     model = Contact
@@ -33,26 +38,10 @@ class ContactSyncer(BaseSyncer):
         if hasattr(self, cache_attr):
             return getattr(self, cache_attr)
 
-        org_state_boundaries_data = dict()
-        org_district_boundaries_data = dict()
-        org_ward_boundaries_data = dict()
-        state_boundaries = Boundary.objects.filter(org=org, level=Boundary.STATE_LEVEL)
-        for state in state_boundaries:
-            org_state_boundaries_data[state.name.lower()] = state.osm_id
-            state_district_data = dict()
-            district_boundaries = Boundary.objects.filter(org=org, level=Boundary.DISTRICT_LEVEL, parent=state)
-            for district in district_boundaries:
-                state_district_data[district.name.lower()] = district.osm_id
-                district_ward_data = dict()
-                ward_boundaries = Boundary.objects.filter(org=org, level=Boundary.WARD_LEVEL, parent=district)
-                for ward in ward_boundaries:
-                    district_ward_data[ward.name.lower()] = ward.osm_id
-                org_ward_boundaries_data[district.osm_id] = district_ward_data
-
-            org_district_boundaries_data[state.osm_id] = state_district_data
-
-        setattr(self, cache_attr, (org_state_boundaries_data, org_district_boundaries_data, org_ward_boundaries_data))
-        return org_state_boundaries_data, org_district_boundaries_data, org_ward_boundaries_data
+        boundaries_data = Boundary.get_names_lookup(org)
+
+        setattr(self, cache_attr, boundaries_data)
+        return boundaries_data
 
     def local_kwargs(self, org, remote):
         from ureport.utils import json_date_to_datetime
@@ -188,6 +177,40 @@ class FLOIPBackend(BaseBackend):
         agent = getattr(settings, "SITE_API_USER_AGENT", None)
         return TembaClient(self.backend.host, self.backend.api_token, user_agent=agent)
 
+    def _get_session(self):
+        with _sessions_lock:
+            api_token, session = _sessions.get(self.backend.pk, (None, None))
+            if session is None or api_token != self.backend.api_token:
+                session = get_http_session(pool_size=2, retries=getattr(settings, "FLOIP_HTTP_RETRIES", 3))
+                session.headers.update(
+                    {
+                        "Content-type": "application/json",
+                        "Accept": "application/json",
+                        "Authorization": "Token %s" % self.backend.api_token,
+                    }
+                )
+                _sessions[self.backend.pk] = (self.backend.api_token, session)
+            return session
+
+    def _get_json(self, url, params=None):
+        response = self._get_session().get(url, params=params, timeout=getattr(settings, "HTTP_FETCH_TIMEOUT", 30))
+        response.raise_for_status()
+        return response.json()
+
+    def _iter_pages(self, url, get_next_url, params=None):
+        """
+        Iterates over the JSON of the pages starting at url, fetching the page of the next link in the background
+        while the current page is processed
+        """
+
+        def fetch_pages(url):
+            while url:
+                page = self._get_json(url, params=params)
+                yield page
+                url = get_next_url(page)
+
+        return prefetch_iter(fetch_pages(url), size=getattr(settings, "FLOIP_PREFETCH_PAGES", 1))
+
     def pull_fields(self, org):
         # Not needed
         return {SyncOutcome.created: 0, SyncOutcome.updated: 0, SyncOutcome.deleted: 0, SyncOutcome.ignored: 0}
@@ -196,38 +219,34 @@ class FLOIPBackend(BaseBackend):
         # Not needed
         return {SyncOutcome.created: 0, SyncOutcome.updated: 0, SyncOutcome.deleted: 0, SyncOutcome.ignored: 0}
 
-    def pull_contacts(self, org, modified_after, modified_before, progress_callback=None):
+    def pull_contacts(
+        self, org, modified_after, modified_before, progress_callback=None, resume_cursor=None, time_limit=None
+    ):
         client = self._get_client(org)
 
         # all contacts created or modified in the time window
         active_query = client.get_contacts(after=modified_after, before=modified_before)
-        fetches = active_query.iterfetches(retry_on_rate_exceed=True)
+        fetches = active_query.iterfetches(retry_on_rate_exceed=True, resume_cursor=resume_cursor)
 
         # all contacts deleted in the same time window
         deleted_query = client.get_contacts(deleted=True, after=modified_after, before=modified_before)
         deleted_fetches = deleted_query.iterfetches(retry_on_rate_exceed=True)
 
+        def fetch_synced(num_synced):
+            if progress_callback:
+                progress_callback(num_synced, fetches.get_cursor())
+
         return sync_local_to_changes(
-            org, ContactSyncer(backend=self.backend), fetches, deleted_fetches, progress_callback
+            org, ContactSyncer(backend=self.backend), fetches, deleted_fetches, fetch_synced, time_limit
         )
 
     def fetch_flows(self, org):
         flow_url = "https://go.votomobile.org/flow-results/packages/"
 
-        headers = {
-            "Content-type": "application/json",
-            "Accept": "application/json",
-            "Authorization": "Token %s" % self.backend.api_token,
-        }
-
         flows = []
 
-        while flow_url:
-            response = requests.request("GET", flow_url, headers=headers)
-            response_json = response.json()
-
+        for response_json in self._iter_pages(flow_url, lambda page: page["links"]["next"]):
             flows += response_json["data"]
-            flow_url = response_json["links"]["next"]
 
         all_flows = dict()
         for flow in flows:
@@ -248,14 +267,7 @@ class FLOIPBackend(BaseBackend):
     def get_definition(self, org, flow_uuid):
         flow_url = "https://go.votomobile.org/flow-results/packages/" + flow_uuid
 
-        headers = {
-            "Content-type": "application/json",
-            "Accept": "application/json",
-            "Authorization": "Token %s" % self.backend.api_token,
-        }
-
-        response = requests.request("GET", flow_url, headers=headers)
-        response_json = response.json()
+        response_json = self._get_json(flow_url)
 
         flow_definition = None
         try:
@@ -311,18 +323,13 @@ class FLOIPBackend(BaseBackend):
 
         if r.get(key):
             logger.info("Skipping pulling results for poll #%d on org #%d as it is still running" % (poll.pk, org.pk))
+            return SkippedPullResults()
         else:
             with r.lock(key, timeout=Poll.POLL_SYNC_LOCK_TIMEOUT):
                 lock_expiration = time.time() + 0.8 * Poll.POLL_SYNC_LOCK_TIMEOUT
 
                 poll_results_url = "https://go.votomobile.org/flow-results/packages/%s/responses" % poll.flow_uuid
 
-                headers = {
-                    "Content-type": "application/json",
-                    "Accept": "application/json",
-                    "Authorization": "Token %s" % self.backend.api_token,
-                }
-
                 results = []
 
                 questions_uuids = poll.get_question_uuids()
@@ -344,77 +351,84 @@ class FLOIPBackend(BaseBackend):
                     filter={"start-timestamp": latest_synced_obj_time},
                 )
 
-                while poll_results_url:
-                    response = requests.request("GET", poll_results_url, headers=headers, params=params)
-                    response_json = response.json()
-
-                    results = response_json["data"]["attributes"]["responses"]
-                    poll_results_url = response_json["data"]["relationships"]["links"]["next"]
-
-                    (contacts_map, poll_results_map, poll_results_to_save_map) = self._initiate_lookup_maps(
-                        results, org, poll
-                    )
+                pages = self._iter_pages(
+                    poll_results_url, lambda page: page["data"]["relationships"]["links"]["next"], params=params
+                )
+                try:
+                    for response_json in pages:
+                        results = response_json["data"]["attributes"]["responses"]
 
-                    for result in results:
-                        if latest_synced_obj_time is None or json_date_to_datetime(result[0]) > json_date_to_datetime(
-                            latest_synced_obj_time
-                        ):
-                            latest_synced_obj_time = result[0]
-
-                        contact_obj = contacts_map.get(result[2], None)
-                        self._process_run_poll_results(
-                            org,
-                            poll.flow_uuid,
-                            questions_uuids,
-                            result,
-                            contact_obj,
-                            poll_results_map,
-                            poll_results_to_save_map,
-                            stats_dict,
+                        (contacts_map, poll_results_map, poll_results_to_save_map) = self._initiate_lookup_maps(
+                            results, org, poll
                         )
 
-                        stats_dict["num_synced"] += len(results)
-                        if progress_callback:
-                            progress_callback(stats_dict["num_synced"])
+                        updated_poll_results = []
+                        for result in results:
+                            if latest_synced_obj_time is None or json_date_to_datetime(
+                                result[0]
+                            ) > json_date_to_datetime(latest_synced_obj_time):
+                                latest_synced_obj_time = result[0]
+
+                            contact_obj = contacts_map.get(result[2], None)
+                            updated_poll_results += self._process_run_poll_results(
+                                org,
+                                poll.flow_uuid,
+                                questions_uuids,
+                                result,
+                                contact_obj,
+                                poll_results_map,
+                                poll_results_to_save_map,
+                                stats_dict,
+                            )
 
-                    self._save_new_poll_results_to_database(poll_results_to_save_map)
+                            stats_dict["num_synced"] += len(results)
+                            if progress_callback:
+                                progress_callback(stats_dict["num_synced"])
 
-                    logger.info(
-                        "Processed fetch of %d - %d "
-                        "runs for poll #%d on org #%d"
-                        % (stats_dict["num_synced"] - len(results), stats_dict["num_synced"], poll.pk, org.pk)
-                    )
-                    # fetch_start = time.time()
-                    logger.info("=" * 40)
+                        new_poll_results = self._save_new_poll_results_to_database(poll_results_to_save_map)
+                        ContactActivity.update_for_poll_results(org.id, updated_poll_results + new_poll_results)
 
-                    if stats_dict["num_synced"] >= Poll.POLL_RESULTS_MAX_SYNC_RUNS or time.time() > lock_expiration:
-                        poll.rebuild_poll_results_counts()
+                        logger.info(
+                            "Processed fetch of %d - %d "
+                            "runs for poll #%d on org #%d"
+                            % (stats_dict["num_synced"] - len(results), stats_dict["num_synced"], poll.pk, org.pk)
+                        )
+                        # fetch_start = time.time()
+                        logger.info("=" * 40)
 
-                        self._mark_poll_results_sync_paused(org, poll, latest_synced_obj_time)
+                        if (
+                            stats_dict["num_synced"] >= Poll.POLL_RESULTS_MAX_SYNC_RUNS
+                            or time.time() > lock_expiration
+                        ):
+                            poll.rebuild_poll_results_counts()
+
+                            self._mark_poll_results_sync_paused(org, poll, latest_synced_obj_time)
+
+                            logger.info(
+                                "Break pull results for poll #%d on org #%d in %ds, "
+                                "Times: sync_latest= %s, "
+                                "Objects: created %d, updated %d, ignored %d. "
+                                % (
+                                    poll.pk,
+                                    org.pk,
+                                    time.time() - start,
+                                    latest_synced_obj_time,
+                                    stats_dict["num_val_created"],
+                                    stats_dict["num_val_updated"],
+                                    stats_dict["num_val_ignored"],
+                                )
+                            )
 
-                        logger.info(
-                            "Break pull results for poll #%d on org #%d in %ds, "
-                            "Times: sync_latest= %s, "
-                            "Objects: created %d, updated %d, ignored %d. "
-                            % (
-                                poll.pk,
-                                org.pk,
-                                time.time() - start,
-                                latest_synced_obj_time,
+                            return (
                                 stats_dict["num_val_created"],
                                 stats_dict["num_val_updated"],
                                 stats_dict["num_val_ignored"],
+                                stats_dict["num_path_created"],
+                                stats_dict["num_path_updated"],
+                                stats_dict["num_path_ignored"],
                             )
-                        )
-
-                        return (
-                            stats_dict["num_val_created"],
-                            stats_dict["num_val_updated"],
-                            stats_dict["num_val_ignored"],
-                            stats_dict["num_path_created"],
-                            stats_dict["num_path_updated"],
-                            stats_dict["num_path_ignored"],
-                        )
+                finally:
+                    pages.close()
 
                 self._mark_poll_results_sync_completed(poll, org, latest_synced_obj_time)
 
@@ -494,6 +508,8 @@ class FLOIPBackend(BaseBackend):
         category = result[5]
         text = result[5]
 
+        updated_poll_results = []
+
         existing_poll_result = existing_db_poll_results_map.get(contact_uuid, dict()).get(ruleset_uuid, None)
 
         poll_result_to_save = poll_results_to_save_map.get(contact_uuid, dict()).get(ruleset_uuid, None)
@@ -529,6 +545,7 @@ class FLOIPBackend(BaseBackend):
                 existing_poll_result.completed = completed
 
                 existing_db_poll_results_map[contact_uuid][ruleset_uuid] = existing_poll_result
+                updated_poll_results.append(existing_poll_result)
 
                 stats_dict["num_val_updated"] += 1
             else:
@@ -580,6 +597,8 @@ class FLOIPBackend(BaseBackend):
 
             stats_dict["num_val_created"] += 1
 
+        return updated_poll_results
+
     @staticmethod
     def _check_update_required(poll_obj, category, text, state, district, ward, born, gender, completed, value_date):
         update_required = any(
@@ -611,6 +630,7 @@ class FLOIPBackend(BaseBackend):
                 if obj_to_create is not None:
                     new_poll_results.append(obj_to_create)
         PollResult.objects.bulk_create(new_poll_results)
+        return new_poll_results
 
     @staticmethod
     def _mark_poll_results_sync_paused(org, poll, latest_synced_obj_time):
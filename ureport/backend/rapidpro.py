@@ -2,11 +2,15 @@
 from __future__ import absolute_import, division, print_function, unicode_literals
 
 import gzip
-import io
+import hashlib
 import json
 import logging
+import math
+import os
+import tempfile
 import time
-from collections import defaultdict
+from collections import defaultdict, deque
+from concurrent.futures import ProcessPoolExecutor
 from datetime import timedelta
 
 import requests
@@ -14,22 +18,280 @@ from django_redis import get_redis_connection
 from temba_client.exceptions import TembaRateExceededError
 from temba_client.v2.types import Run
 
+from django.conf import settings
 from django.core.cache import cache
+from django.db import connection, transaction
+from django.db.models.functions import MD5
 from django.utils import timezone
 
 from dash.utils import is_dict_equal
-from dash.utils.sync import BaseSyncer, sync_local_to_changes, sync_local_to_set
+from dash.utils.sync import BaseSyncer, SyncOutcome, sync_local_to_changes, sync_local_to_set
 from ureport.contacts.models import Contact, ContactField
 from ureport.flows.models import FlowResultCategory
 from ureport.locations.models import Boundary
 from ureport.polls.models import Poll, PollQuestion, PollResponseCategory, PollResult
 from ureport.polls.tasks import pull_refresh_from_archives
-from ureport.utils import chunk_list, datetime_to_json_date, json_date_to_datetime
+from ureport.stats.models import ContactActivity, ContactActivitySketch
+from ureport.utils import BloomFilter, chunk_list, datetime_to_json_date, json_date_to_datetime, prefetch_iter
 
-from . import BaseBackend
+from . import BaseBackend, SkippedPullResults
 
 logger = logging.getLogger(__name__)
 
+# number of archived runs written to the database at once
+ARCHIVE_RUNS_BATCH_SIZE = 1000
+
+
+def iter_archive_records(download_url, flow_uuid):
+    """
+    Downloads and decompresses a runs archive as it streams in, yielding the serialized runs of the given flow.
+    This touches neither the database nor the cache so it can be run in a worker process.
+    """
+    r = requests.get(download_url, stream=True)
+    stream = gzip.GzipFile(fileobj=r.raw)
+
+    for line in stream:
+        line_decoded = line.decode("utf-8")
+        if line_decoded.find(flow_uuid) > 0:
+            record = json.loads(line_decoded)
+            if record["flow"]["uuid"] == flow_uuid:
+                record.update(start=None)
+                yield record
+
+
+def decode_archive_runs(download_url, flow_uuid):
+    """
+    Writes the serialized runs of the given flow in a runs archive to a temporary JSON lines file and returns its
+    path, so that a worker process hands them over without holding them all in memory
+    """
+    f = tempfile.NamedTemporaryFile("w", suffix=".jsonl", delete=False)
+    try:
+        with f:
+            for record in iter_archive_records(download_url, flow_uuid):
+                f.write(json.dumps(record))
+                f.write("\n")
+    except BaseException:
+        os.remove(f.name)
+        raise
+    return f.name
+
+
+def iter_runs_batches(records):
+    """
+    Deserializes the runs of serialized records in batches of ARCHIVE_RUNS_BATCH_SIZE
+    """
+    for record_batch in chunk_list(records, ARCHIVE_RUNS_BATCH_SIZE):
+        yield Run.deserialize_list(list(record_batch))
+
+
+class DecodedArchiveRuns(object):
+    """
+    The runs of an archive decoded by a worker to a temporary file, deserialized in batches as they are iterated.
+    The file is removed once iterated, or discarded if the runs are not needed anymore.
+    """
+
+    def __init__(self, future):
+        self.future = future
+
+    def __iter__(self):
+        if self.future is None:
+            return
+
+        path = self.future.result()
+        try:
+            with open(path) as f:
+                yield from iter_runs_batches(json.loads(line) for line in f)
+        finally:
+            self.discard()
+
+    def discard(self):
+        future, self.future = self.future, None
+        if future is None or future.cancel() or future.exception() is not None:
+            return
+
+        path = future.result()
+        if os.path.exists(path):
+            os.remove(path)
+
+
+class ContactLookup(object):
+    """
+    The contact fields copied on poll results, loaded as a values tuple instead of a Contact
+    """
+
+    __slots__ = ("uuid", "state", "district", "ward", "born", "gender", "scheme")
+
+    def __init__(self, *values):
+        for name, value in zip(self.__slots__, values):
+            setattr(self, name, value)
+
+
+class PollResultLookup(object):
+    """
+    The fields of an existing poll result compared when syncing runs, loaded as a values tuple instead of
+    a PollResult. The text is only kept as its MD5 digest, computed by the database.
+    """
+
+    __slots__ = (
+        "pk",
+        "contact",
+        "ruleset",
+        "category",
+        "text_digest",
+        "state",
+        "district",
+        "ward",
+        "born",
+        "gender",
+        "scheme",
+        "completed",
+        "date",
+    )
+
+    def __init__(self, *values):
+        for name, value in zip(self.__slots__, values):
+            setattr(self, name, value)
+
+    @staticmethod
+    def digest(text):
+        return hashlib.md5(text.encode("utf-8")).hexdigest() if text is not None else None
+
+
+class RapidProRateLimiter(object):
+    """
+    Redis token buckets shared by every task calling the RapidPro workspace of an org backend, one per throttle
+    scope of the RapidPro API, only used when RAPIDPRO_RATE_LIMIT is on. Lower priority callers leave a reserve of
+    the bucket to the higher priority ones. Callers able to reschedule themselves fail fast with the seconds to wait
+    rather than hold their lock, the others wait for the bucket to refill.
+    """
+
+    KEY = "rapidpro-rate-limit:org:%d:backend:%s:scope:%s"
+
+    # the endpoints RapidPro throttles separately, all the others share the default scope
+    SCOPE_DEFAULT = "v2"
+    SCOPED_ENDPOINTS = ("broadcasts", "contacts", "messages", "runs")
+
+    PRIORITY_HIGH = "H"
+    PRIORITY_NORMAL = "N"
+    PRIORITY_LOW = "L"
+
+    # share of the bucket each priority cannot draw from
+    PRIORITY_RESERVES = {PRIORITY_HIGH: 0.0, PRIORITY_NORMAL: 0.25, PRIORITY_LOW: 0.5}
+
+    # longest sleep of a waiting caller before it checks the bucket again
+    MAX_SLEEP = 60
+
+    # refills the bucket for the elapsed time, then takes the requested tokens if that leaves the reserve
+    # untouched, returns the seconds to wait before the request could succeed, or 0 if tokens were taken
+    TAKE_SCRIPT = """
+local capacity = tonumber(ARGV[1])
+local rate = tonumber(ARGV[2])
+local now = tonumber(ARGV[3])
+local requested = tonumber(ARGV[4])
+local reserve = tonumber(ARGV[5])
+
+local state = redis.call("HMGET", KEYS[1], "tokens", "ts")
+local tokens = tonumber(state[1])
+local ts = tonumber(state[2])
+if tokens == nil then
+    tokens = capacity
+    ts = now
+end
+tokens = math.min(capacity, tokens + math.max(0, now - ts) * rate)
+
+local wait = 0
+if requested > 0 and tokens - requested >= reserve then
+    tokens = tokens - requested
+else
+    wait = math.max(0, (reserve + math.max(requested, 1) - tokens) / rate)
+end
+
+redis.call("HSET", KEYS[1], "tokens", tostring(tokens), "ts", tostring(now))
+redis.call("EXPIRE", KEYS[1], math.ceil(capacity / rate) + 60)
+return tostring(wait)
+"""
+
+    def __init__(self, org, backend_slug, priority=PRIORITY_NORMAL, scope=SCOPE_DEFAULT, fail_fast=False):
+        self.org = org
+        self.backend_slug = backend_slug
+        self.key = self.KEY % (org.pk, backend_slug, scope)
+        self.priority = priority
+        self.fail_fast = fail_fast
+        self.capacity = getattr(settings, "RAPIDPRO_RATE_LIMIT_BURST", 2500)
+        self.rate = getattr(settings, "RAPIDPRO_RATE_LIMIT_PER_HOUR", 2500) / 3600.0
+        self.reserve = self.capacity * self.PRIORITY_RESERVES[priority]
+
+    @classmethod
+    def is_enabled(cls):
+        return getattr(settings, "RAPIDPRO_RATE_LIMIT", False)
+
+    @classmethod
+    def get_scope(cls, url):
+        """
+        Returns the throttle scope of a request to the given API URL
+        """
+        endpoint = url.rsplit("/", 1)[-1].split(".", 1)[0]
+        if endpoint in cls.SCOPED_ENDPOINTS:
+            return "%s.%s" % (cls.SCOPE_DEFAULT, endpoint)
+        return cls.SCOPE_DEFAULT
+
+    def for_scope(self, scope):
+        return RapidProRateLimiter(self.org, self.backend_slug, self.priority, scope, self.fail_fast)
+
+    def _take(self, requested):
+        r = get_redis_connection()
+        wait = r.eval(self.TAKE_SCRIPT, 1, self.key, self.capacity, self.rate, time.time(), requested, self.reserve)
+        return float(wait)
+
+    def get_delay(self):
+        """
+        Returns the seconds before a request at this priority can be made, 0 if it can be made now
+        """
+        return self._take(0)
+
+    def acquire(self):
+        """
+        Takes a token for one request. If there is none left, fail fast callers get a rate exceeded error with the
+        seconds to wait, the others wait for the bucket to refill.
+        """
+        while True:
+            wait = self._take(1)
+            if wait <= 0:
+                return
+
+            if self.fail_fast:
+                raise TembaRateExceededError(int(math.ceil(wait)))
+
+            time.sleep(min(wait, self.MAX_SLEEP))
+
+    def drain(self, retry_after):
+        """
+        Empties the bucket for everyone once RapidPro itself rejected a request, so that no caller
+        retries before retry_after seconds
+        """
+        r = get_redis_connection()
+        r.hset(self.key, mapping={"tokens": str(-self.rate * retry_after), "ts": str(time.time())})
+        r.expire(self.key, int(math.ceil(self.capacity / self.rate + retry_after)) + 60)
+
+    def limit_client(self, client):
+        """
+        Makes every request of the client draw from the bucket of its scope
+        """
+        do_request = client._request
+
+        def limited_request(method, url, *args, **kwargs):
+            limiter = self.for_scope(self.get_scope(url))
+            limiter.acquire()
+            try:
+                return do_request(method, url, *args, **kwargs)
+            except TembaRateExceededError as e:
+                if e.retry_after:
+                    limiter.drain(e.retry_after)
+                raise
+
+        client._request = limited_request
+        return client
+
 
 class FieldSyncer(BaseSyncer):
     """
@@ -125,35 +387,31 @@ class ContactSyncer(BaseSyncer):
     prefetch_related = ("backend",)
     local_backend_attr = "backend"
 
+    BULK_UPDATE_FIELDS = (
+        "gender",
+        "born",
+        "occupation",
+        "registered_on",
+        "state",
+        "district",
+        "ward",
+        "scheme",
+        "is_active",
+    )
+
+    def __init__(self, backend):
+        super().__init__(backend)
+        self.new_contacts = []
+
     def get_boundaries_data(self, org):
         cache_attr = "__boundaries__%d:%s" % (org.pk, self.backend.slug)
         if hasattr(self, cache_attr):
             return getattr(self, cache_attr)
 
-        org_state_boundaries_data = dict()
-        org_district_boundaries_data = dict()
-        org_ward_boundaries_data = dict()
-        state_boundaries = Boundary.objects.filter(org=org, level=Boundary.STATE_LEVEL, backend=self.backend)
-        for state in state_boundaries:
-            org_state_boundaries_data[state.name.lower()] = state.osm_id
-            state_district_data = dict()
-            district_boundaries = Boundary.objects.filter(
-                org=org, level=Boundary.DISTRICT_LEVEL, parent=state, backend=self.backend
-            )
-            for district in district_boundaries:
-                state_district_data[district.name.lower()] = district.osm_id
-                district_ward_data = dict()
-                ward_boundaries = Boundary.objects.filter(
-                    org=org, level=Boundary.WARD_LEVEL, parent=district, backend=self.backend
-                )
-                for ward in ward_boundaries:
-                    district_ward_data[ward.name.lower()] = ward.osm_id
-                org_ward_boundaries_data[district.osm_id] = district_ward_data
-
-            org_district_boundaries_data[state.osm_id] = state_district_data
+        boundaries_data = Boundary.get_names_lookup(org, self.backend)
 
-        setattr(self, cache_attr, (org_state_boundaries_data, org_district_boundaries_data, org_ward_boundaries_data))
-        return org_state_boundaries_data, org_district_boundaries_data, org_ward_boundaries_data
+        setattr(self, cache_attr, boundaries_data)
+        return boundaries_data
 
     def get_contact_fields(self, org):
         cache_attr = "__contact_fields__%d:%s" % (org.pk, self.backend.slug)
@@ -315,32 +573,186 @@ class ContactSyncer(BaseSyncer):
 
         one_month_ago = timezone.now() - timedelta(days=30)
         if obj.registered_on is not None and obj.registered_on > one_month_ago:
-            recent_results = PollResult.objects.filter(
-                org=obj.org,
-                contact=obj.uuid,
-                date__gte=one_month_ago,
-            ).exists()
-
-            if recent_results:
-                PollResult.objects.filter(org=obj.org, contact=obj.uuid, date__gte=one_month_ago).update(
-                    state=obj.state,
-                    district=obj.district,
-                    ward=obj.ward,
-                    gender=obj.gender,
-                    born=obj.born,
-                    scheme=obj.scheme,
-                )
+            self.new_contacts.append(obj)
 
         return obj
 
+    def bulk_sync_fetch(self, org, fetch):
+        """
+        Syncs a whole fetch of remote contacts, diffing it against the existing contacts in one query and writing the
+        creates, updates and deletes with one statement each
+        """
+        outcome_counts = {outcome: 0 for outcome in SyncOutcome}
+
+        remote_kwargs = dict()
+        for remote in fetch:
+            remote_kwargs[self.identify_remote(remote)] = self.local_kwargs(org, remote)
+
+        existing_contacts = dict()
+        for contact in self.fetch_all(org).filter(uuid__in=list(remote_kwargs.keys())).order_by("id"):
+            existing_contacts.setdefault(contact.uuid, contact)
+
+        to_create = []
+        to_update = []
+        to_delete = []
+        for uuid, local_kwargs in remote_kwargs.items():
+            existing = existing_contacts.get(uuid)
+
+            if existing:
+                existing.org = org
+                if local_kwargs:
+                    if self.update_required(existing, None, local_kwargs) or not existing.is_active:
+                        for field, value in local_kwargs.items():
+                            setattr(existing, field, value)
+                        existing.is_active = True
+                        to_update.append(existing)
+                        outcome_counts[SyncOutcome.updated] += 1
+                        continue
+
+                elif existing.is_active:
+                    to_delete.append(existing.pk)
+                    outcome_counts[SyncOutcome.deleted] += 1
+                    continue
+
+            elif local_kwargs:
+                to_create.append(self.model(**local_kwargs))
+                outcome_counts[SyncOutcome.created] += 1
+                continue
+
+            outcome_counts[SyncOutcome.ignored] += 1
+
+        with transaction.atomic():
+            if to_create:
+                # a contact created by a concurrent sync since the diff query above is updated instead
+                self.model.objects.bulk_create(
+                    to_create,
+                    update_conflicts=True,
+                    unique_fields=("org", "uuid"),
+                    update_fields=self.BULK_UPDATE_FIELDS,
+                )
+            if to_update:
+                self.model.objects.bulk_update(to_update, self.BULK_UPDATE_FIELDS)
+            if to_delete:
+                self.model.objects.filter(pk__in=to_delete).update(is_active=False)
+
+        one_month_ago = timezone.now() - timedelta(days=30)
+        for contact in to_create:
+            if contact.registered_on is not None and contact.registered_on > one_month_ago:
+                self.new_contacts.append(contact)
+
+        return outcome_counts
+
+    def bulk_delete_fetch(self, org, deleted_fetch):
+        """
+        Releases the active contacts of a whole fetch of remotely deleted contacts with a single update
+        """
+        uuids = [self.identify_remote(remote) for remote in deleted_fetch]
+        if not uuids:
+            return 0
+        return self.fetch_all(org).filter(uuid__in=uuids, is_active=True).update(is_active=False)
+
+    def backfill_poll_results(self):
+        """
+        Copies the demographics of the recently registered contacts created since the last call to their recent poll
+        results and contact activities, with one UPDATE of each per org rather than one per contact
+        """
+        new_contacts, self.new_contacts = self.new_contacts, []
+        if not new_contacts:
+            return 0
+
+        one_month_ago = timezone.now() - timedelta(days=30)
+
+        contacts_by_org = defaultdict(list)
+        for contact in new_contacts:
+            contacts_by_org[contact.org_id].append(contact)
+
+        num_updated = 0
+        for org_id, org_contacts in contacts_by_org.items():
+            values_sql = ", ".join(["(%s, %s, %s, %s, %s, %s::integer, %s)"] * len(org_contacts))
+            params = []
+            for contact in org_contacts:
+                params.extend(
+                    [
+                        contact.uuid,
+                        contact.state,
+                        contact.district,
+                        contact.ward,
+                        contact.gender,
+                        contact.born,
+                        contact.scheme,
+                    ]
+                )
+            params.extend([org_id, one_month_ago])
+
+            sql = """
+            UPDATE polls_pollresult SET "state" = c."state", "district" = c."district", "ward" = c."ward",
+              "gender" = c."gender", "born" = c."born", "scheme" = c."scheme"
+            FROM (VALUES %s) AS c("uuid", "state", "district", "ward", "gender", "born", "scheme")
+            WHERE polls_pollresult."contact" = c."uuid" AND polls_pollresult."org_id" = %%s
+              AND polls_pollresult."date" >= %%s
+            """ % (
+                values_sql
+            )
+
+            with connection.cursor() as cursor:
+                cursor.execute(sql, params)
+                num_updated += cursor.rowcount
+
+            ContactActivity.update_contacts_attributes(
+                org_id,
+                [
+                    (
+                        contact.uuid,
+                        contact.born,
+                        contact.gender,
+                        contact.state,
+                        contact.district,
+                        contact.ward,
+                        contact.scheme,
+                    )
+                    for contact in org_contacts
+                ],
+            )
+
+        return num_updated
+
+
+class PrefetchedCursorIterator(object):
+    """
+    Prefetches the pages of a RapidPro cursor iterator in the background, while still reporting the cursor to resume
+    after the last page handed out rather than after the last page loaded
+    """
+
+    def __init__(self, fetches, size):
+        def with_cursors():
+            for fetch in fetches:
+                yield fetch, fetches.get_cursor()
+
+        self.items = prefetch_iter(with_cursors(), size)
+        self.cursor = None
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        fetch, self.cursor = next(self.items)
+        return fetch
+
+    def get_cursor(self):
+        return self.cursor
+
+    def close(self):
+        self.items.close()
+
 
 class RapidProBackend(BaseBackend):
     """
     RapidPro instance as a backend
     """
 
-    @staticmethod
-    def _get_client(org, api_version):
+    feeds_activity_sketches = True
+
+    def _get_client(self, org, api_version, priority=RapidProRateLimiter.PRIORITY_NORMAL, fail_fast=False):
         from temba_client.v2.types import Field
 
         def convert_old_fields(clazz, item):
@@ -351,7 +763,41 @@ class RapidProBackend(BaseBackend):
                 )
             return item
 
-        return org.get_temba_client(api_version=api_version, transformer=convert_old_fields)
+        client = org.get_temba_client(api_version=api_version, transformer=convert_old_fields)
+        if not RapidProRateLimiter.is_enabled():
+            return client
+
+        return RapidProRateLimiter(org, self.backend.slug, priority, fail_fast=fail_fast).limit_client(client)
+
+    def _get_results_pull_countdown(self, org, priority, retry_after):
+        """
+        Returns the seconds before a results pull stopped by the rate limit should resume
+        """
+        delay = retry_after or 0
+        if RapidProRateLimiter.is_enabled():
+            limiter = RapidProRateLimiter(org, self.backend.slug, priority, RapidProRateLimiter.get_scope("runs"))
+            delay = max(limiter.get_delay(), delay)
+        return int(math.ceil(delay)) or 300
+
+    @staticmethod
+    def _get_poll_sync_priority(org, poll):
+        """
+        The main poll syncs first, then polls recent enough to still get answers, then all the others
+        """
+        if poll.pk == cache.get(Poll.ORG_MAIN_POLL_ID % org.pk, None):
+            return RapidProRateLimiter.PRIORITY_HIGH
+
+        if poll.created_on > timezone.now() - timedelta(days=45):
+            return RapidProRateLimiter.PRIORITY_NORMAL
+
+        return RapidProRateLimiter.PRIORITY_LOW
+
+    @staticmethod
+    def _prefetch(fetches):
+        """
+        Keeps the next pages of the fetches loading in the background while the current page is processed
+        """
+        return prefetch_iter(fetches, getattr(settings, "RAPIDPRO_PREFETCH_FETCHES", 0))
 
     def fetch_flows(self, org):
         client = self._get_client(org, 2)
@@ -425,43 +871,130 @@ class RapidProBackend(BaseBackend):
             client = self._get_client(org, 2)
             incoming_objects = client.get_boundaries(geometry=True).all()
 
-        return sync_local_to_set(org, BoundarySyncer(backend=self.backend), incoming_objects)
+        results = sync_local_to_set(org, BoundarySyncer(backend=self.backend), incoming_objects)
+
+        boundaries_changed = results[SyncOutcome.created] + results[SyncOutcome.updated] + results[SyncOutcome.deleted]
+        if boundaries_changed or cache.get(Boundary.BOUNDARIES_VERSION_CACHE_KEY % org.pk, None) is None:
+            Boundary.update_version(org)
+
+        return results
 
-    def pull_contacts(self, org, modified_after, modified_before, progress_callback=None):
+    def pull_contacts(
+        self, org, modified_after, modified_before, progress_callback=None, resume_cursor=None, time_limit=None
+    ):
         client = self._get_client(org, 2)
 
         # all contacts created or modified in RapidPro in the time window
         active_query = client.get_contacts(after=modified_after, before=modified_before)
-        fetches = active_query.iterfetches(retry_on_rate_exceed=True)
+        fetches = PrefetchedCursorIterator(
+            active_query.iterfetches(retry_on_rate_exceed=True, resume_cursor=resume_cursor),
+            getattr(settings, "RAPIDPRO_PREFETCH_FETCHES", 0),
+        )
 
         # all contacts deleted in RapidPro in the same time window
         deleted_query = client.get_contacts(deleted=True, after=modified_after, before=modified_before)
-        deleted_fetches = deleted_query.iterfetches(retry_on_rate_exceed=True)
+        deleted_fetches = self._prefetch(deleted_query.iterfetches(retry_on_rate_exceed=True))
 
-        return sync_local_to_changes(
-            org, ContactSyncer(backend=self.backend), fetches, deleted_fetches, progress_callback
-        )
+        syncer = ContactSyncer(backend=self.backend)
+        last_progress = None
 
-    def _iter_archive_records(self, archive, flow_uuid):
-        r = requests.get(archive.download_url, stream=True)
-        stream = gzip.GzipFile(fileobj=io.BytesIO(r.content))
+        def fetch_synced(num_synced):
+            nonlocal last_progress
 
-        while True:
-            line = stream.readline()
-            if not line:
+            # called after each fetch, backfill the poll results of the contacts created by it
+            syncer.backfill_poll_results()
+
+            # the deleted fetches report progress too, even empty ones, only report a checkpoint that moved
+            progress = (num_synced, fetches.get_cursor())
+            if progress_callback and progress != last_progress:
+                progress_callback(*progress)
+                last_progress = progress
+
+        try:
+            if getattr(settings, "RAPIDPRO_BULK_CONTACTS_SYNC", False):
+                return self._bulk_sync_contacts(org, syncer, fetches, deleted_fetches, fetch_synced, time_limit)
+
+            return sync_local_to_changes(org, syncer, fetches, deleted_fetches, fetch_synced, time_limit)
+        finally:
+            fetches.close()
+            deleted_fetches.close()
+
+    @staticmethod
+    def _bulk_sync_contacts(org, syncer, fetches, deleted_fetches, progress_callback=None, time_limit=None):
+        """
+        Same as dash's sync_local_to_changes but writing each fetch with bulk statements instead of contact by contact
+        """
+        num_synced = 0
+        outcome_counts = {outcome: 0 for outcome in SyncOutcome}
+        resume_cursor = None
+
+        start = time.time()
+
+        for fetch in fetches:
+            for outcome, count in syncer.bulk_sync_fetch(org, fetch).items():
+                outcome_counts[outcome] += count
+
+            num_synced += len(fetch)
+            if progress_callback:
+                progress_callback(num_synced)
+
+            if time_limit and time.time() - start > time_limit:
+                resume_cursor = fetches.get_cursor()
                 break
-            line_decoded = line.decode("utf-8")
-            if line_decoded.find(flow_uuid) > 0:
-                yield json.loads(line_decoded)
-
-    def _iter_poll_record_runs(self, archive, poll_flow_uuid):
-        for record_batch in chunk_list(self._iter_archive_records(archive, poll_flow_uuid), 1000):
-            matching = []
-            for record in record_batch:
-                if record["flow"]["uuid"] == poll_flow_uuid:
-                    record.update(start=None)
-                    matching.append(record)
-            yield Run.deserialize_list(matching)
+
+        for deleted_fetch in deleted_fetches:
+            outcome_counts[SyncOutcome.deleted] += syncer.bulk_delete_fetch(org, deleted_fetch)
+
+            num_synced += len(deleted_fetch)
+            if progress_callback:
+                progress_callback(num_synced)
+
+        return outcome_counts, resume_cursor
+
+    def _iter_archives_runs(self, archives_fetches, flow_uuid):
+        """
+        Yields each archive with an iterator of its runs for the flow, in archive order. When
+        POLL_RESULTS_ARCHIVE_WORKERS is more than 1, archives are downloaded and decoded ahead
+        in a process pool while the caller writes the runs of the current archive.
+        """
+        archives = (archive for archives in archives_fetches for archive in archives)
+
+        workers = getattr(settings, "POLL_RESULTS_ARCHIVE_WORKERS", 0)
+        if workers <= 1:
+            for archive in archives:
+                yield archive, self._iter_archive_runs(archive, flow_uuid)
+            return
+
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            pending = deque()
+            current = None
+            try:
+                for archive in archives:
+                    future = None
+                    if archive.record_count > 0:
+                        future = executor.submit(decode_archive_runs, archive.download_url, flow_uuid)
+                    pending.append((archive, DecodedArchiveRuns(future)))
+
+                    # keep at most one archive per worker decoded ahead of the writer
+                    if len(pending) > workers:
+                        current = pending.popleft()
+                        yield current
+                        current[1].discard()
+
+                while pending:
+                    current = pending.popleft()
+                    yield current
+                    current[1].discard()
+            finally:
+                # remove the decoded runs files not written if we are leaving early
+                if current is not None:
+                    current[1].discard()
+                for archive, archive_runs in pending:
+                    archive_runs.discard()
+
+    @staticmethod
+    def _iter_archive_runs(archive, flow_uuid):
+        yield from iter_runs_batches(iter_archive_records(archive.download_url, flow_uuid))
 
     def pull_results_from_archives(self, poll):
         org = poll.org
@@ -499,58 +1032,60 @@ class RapidProBackend(BaseBackend):
             client = self._get_client(org, 2)
 
             questions_uuids = poll.get_question_uuids()
+            results_contacts = self._load_results_contacts_filter(org, poll)
             archives_query = client.get_archives(archive_type="run", after=first)
             archives_fetches = archives_query.iterfetches(retry_on_rate_exceed=True)
 
             i = 0
-            for archives in archives_fetches:
-                for archive in archives:
-                    i += 1
-                    logger.info("Archive %d with %d records, size %d" % (i, archive.record_count, archive.size))
+            for archive, archive_runs in self._iter_archives_runs(archives_fetches, poll.flow_uuid):
+                i += 1
+                logger.info("Archive %d with %d records, size %d" % (i, archive.record_count, archive.size))
 
-                    try:
-                        start_archive = time.time()
-                        logger.info("Archive %d has %d records" % (i, archive.record_count))
+                try:
+                    start_archive = time.time()
+                    logger.info("Archive %d has %d records" % (i, archive.record_count))
 
-                        if archive.record_count <= 0:
-                            continue
+                    if archive.record_count <= 0:
+                        continue
 
-                        flow_uuid = poll.flow_uuid
+                    for fetch in archive_runs:
+                        fetch_start = time.time()
 
-                        for fetch in self._iter_poll_record_runs(archive, flow_uuid):
-                            fetch_start = time.time()
+                        (contacts_map, poll_results_map, poll_results_to_save_map) = self._initiate_lookup_maps(
+                            fetch, org, poll, results_contacts
+                        )
 
-                            (contacts_map, poll_results_map, poll_results_to_save_map) = self._initiate_lookup_maps(
-                                fetch, org, poll
+                        updated_poll_results = []
+                        for temba_run in fetch:
+                            contact_obj = contacts_map.get(temba_run.contact.uuid, None)
+                            updated_poll_results += self._process_run_poll_results(
+                                org,
+                                questions_uuids,
+                                temba_run,
+                                contact_obj,
+                                poll_results_map,
+                                poll_results_to_save_map,
+                                stats_dict,
                             )
 
-                            for temba_run in fetch:
-                                contact_obj = contacts_map.get(temba_run.contact.uuid, None)
-                                self._process_run_poll_results(
-                                    org,
-                                    questions_uuids,
-                                    temba_run,
-                                    contact_obj,
-                                    poll_results_map,
-                                    poll_results_to_save_map,
-                                    stats_dict,
-                                )
-
-                            stats_dict["num_synced"] += len(fetch)
+                        stats_dict["num_synced"] += len(fetch)
 
-                            self._save_new_poll_results_to_database(poll_results_to_save_map)
+                        new_poll_results = self._save_new_poll_results_to_database(poll_results_to_save_map)
+                        self._record_poll_results_activity(org, updated_poll_results + new_poll_results)
+                        if results_contacts is not None:
+                            results_contacts.update(poll_results_to_save_map.keys())
 
-                            logger.info(
-                                "Processing archive %d took %ds for fetch of %d"
-                                % (i, time.time() - fetch_start, len(fetch))
-                            )
+                        logger.info(
+                            "Processing archive %d took %ds for fetch of %d"
+                            % (i, time.time() - fetch_start, len(fetch))
+                        )
 
-                        logger.info("Full poll process archive in %ds" % (time.time() - start_archive))
-                    except Exception as e:
-                        logger.info(e)
-                        import traceback
+                    logger.info("Full poll process archive in %ds" % (time.time() - start_archive))
+                except Exception as e:
+                    logger.info(e)
+                    import traceback
 
-                        traceback.print_exc()
+                    traceback.print_exc()
 
         return (
             stats_dict["num_val_created"],
@@ -588,10 +1123,12 @@ class RapidProBackend(BaseBackend):
 
         if r.get(key):
             logger.info("Skipping pulling results for poll #%d on org #%d as it is still running" % (poll.pk, org.pk))
+            return SkippedPullResults()
         else:
             with r.lock(key, timeout=Poll.POLL_SYNC_LOCK_TIMEOUT):
                 lock_expiration = time.time() + 0.8 * Poll.POLL_SYNC_LOCK_TIMEOUT
-                client = self._get_client(org, 2)
+                priority = self._get_poll_sync_priority(org, poll)
+                client = self._get_client(org, 2, priority=priority, fail_fast=True)
 
                 questions_uuids = poll.get_question_uuids()
 
@@ -606,13 +1143,18 @@ class RapidProBackend(BaseBackend):
                     poll.delete_poll_results()
                     pull_refresh_from_archives.apply_async((poll.pk,), queue="sync")
 
+                # syncing from scratch, most pages will have contacts without results yet
+                results_contacts = None
+                if latest_synced_obj_time is None:
+                    results_contacts = self._load_results_contacts_filter(org, poll)
+
                 start = time.time()
                 logger.info("Start fetching runs for poll #%d on org #%d" % (poll.pk, org.pk))
 
                 poll_runs_query = client.get_runs(
                     flow=poll.flow_uuid, after=latest_synced_obj_time, reverse=True, paths=True
                 )
-                fetches = poll_runs_query.iterfetches(retry_on_rate_exceed=True)
+                fetches = self._prefetch(poll_runs_query.iterfetches(retry_on_rate_exceed=True))
 
                 try:
                     fetch_start = time.time()
@@ -630,9 +1172,10 @@ class RapidProBackend(BaseBackend):
                         )
 
                         (contacts_map, poll_results_map, poll_results_to_save_map) = self._initiate_lookup_maps(
-                            fetch, org, poll
+                            fetch, org, poll, results_contacts
                         )
 
+                        updated_poll_results = []
                         for temba_run in fetch:
                             if latest_synced_obj_time is None or temba_run.modified_on > json_date_to_datetime(
                                 latest_synced_obj_time
@@ -642,7 +1185,7 @@ class RapidProBackend(BaseBackend):
                                 )
 
                             contact_obj = contacts_map.get(temba_run.contact.uuid, None)
-                            self._process_run_poll_results(
+                            updated_poll_results += self._process_run_poll_results(
                                 org,
                                 questions_uuids,
                                 temba_run,
@@ -656,7 +1199,10 @@ class RapidProBackend(BaseBackend):
                         if progress_callback:
                             progress_callback(stats_dict["num_synced"])
 
-                        self._save_new_poll_results_to_database(poll_results_to_save_map)
+                        new_poll_results = self._save_new_poll_results_to_database(poll_results_to_save_map)
+                        self._record_poll_results_activity(org, updated_poll_results + new_poll_results)
+                        if results_contacts is not None:
+                            results_contacts.update(poll_results_to_save_map.keys())
 
                         logger.info(
                             "Processed fetch of %d - %d "
@@ -697,10 +1243,16 @@ class RapidProBackend(BaseBackend):
                                 stats_dict["num_path_updated"],
                                 stats_dict["num_path_ignored"],
                             )
-                except TembaRateExceededError:
+                except TembaRateExceededError as e:
                     poll.rebuild_poll_results_counts()
 
-                    self._mark_poll_results_sync_paused(org, poll, latest_synced_obj_time)
+                    # come back once the shared budget allows this poll to sync again
+                    self._mark_poll_results_sync_paused(
+                        org,
+                        poll,
+                        latest_synced_obj_time,
+                        countdown=self._get_results_pull_countdown(org, priority, e.retry_after),
+                    )
 
                     logger.info(
                         "Break pull results for poll #%d on org #%d in %ds, "
@@ -725,6 +1277,9 @@ class RapidProBackend(BaseBackend):
                         stats_dict["num_path_updated"],
                         stats_dict["num_path_ignored"],
                     )
+                finally:
+                    # stop fetching ahead if we are leaving early
+                    fetches.close()
 
                 self._mark_poll_results_sync_completed(poll, org, latest_synced_obj_time)
 
@@ -759,16 +1314,210 @@ class RapidProBackend(BaseBackend):
             stats_dict["num_path_ignored"],
         )
 
-    def _initiate_lookup_maps(self, fetch, org, poll):
-        contact_uuids = [run.contact.uuid for run in fetch]
-        contacts = Contact.objects.filter(org=org, uuid__in=contact_uuids)
-        contacts_map = {c.uuid: c for c in contacts}
-        existing_poll_results = PollResult.objects.filter(
-            flow=poll.flow_uuid, org=poll.org_id, contact__in=contact_uuids
+    def pull_results_for_polls(self, org, polls):
+        """
+        Pulls the new runs of several polls through a single cursor on the runs of the whole org, starting from the
+        oldest of their checkpoints and advancing each poll's checkpoint on its own. Polls syncing from scratch or
+        with checkpoints too old to share a cursor are left out for pull_results.
+        :return: dict of the results stats tuples of the synced polls by poll id
+        """
+        r = get_redis_connection()
+        oldest_checkpoint = timezone.now() - timedelta(seconds=Poll.POLL_RESULTS_COMBINED_SYNC_MAX_LAG)
+
+        polls_by_flow = dict()
+        checkpoints = dict()
+        locks = []
+
+        try:
+            for poll in polls:
+                if poll.stopped_syncing or not poll.has_synced or poll.flow_uuid in polls_by_flow:
+                    continue
+
+                latest_synced_obj_time, pull_after_delete = poll.get_pull_cached_params()
+                if latest_synced_obj_time is None or pull_after_delete is not None:
+                    continue
+                if json_date_to_datetime(latest_synced_obj_time) < oldest_checkpoint:
+                    continue
+
+                key = Poll.POLL_PULL_RESULTS_TASK_LOCK % (org.pk, poll.flow_uuid)
+                lock = r.lock(key, timeout=Poll.POLL_SYNC_LOCK_TIMEOUT)
+                if not lock.acquire(blocking=False):
+                    logger.info(
+                        "Skipping pulling results for poll #%d on org #%d as it is still running" % (poll.pk, org.pk)
+                    )
+                    continue
+
+                locks.append(lock)
+                polls_by_flow[poll.flow_uuid] = poll
+                checkpoints[poll.flow_uuid] = latest_synced_obj_time
+
+            if not polls_by_flow:
+                return dict()
+
+            stats = self._pull_polls_runs(org, polls_by_flow, checkpoints)
+        finally:
+            for lock in locks:
+                lock.release()
+
+        return {
+            polls_by_flow[flow_uuid].pk: (
+                stats_dict["num_val_created"],
+                stats_dict["num_val_updated"],
+                stats_dict["num_val_ignored"],
+                stats_dict["num_path_created"],
+                stats_dict["num_path_updated"],
+                stats_dict["num_path_ignored"],
+            )
+            for flow_uuid, stats_dict in stats.items()
+        }
+
+    def _pull_polls_runs(self, org, polls_by_flow, checkpoints):
+        stats = {
+            flow_uuid: dict(
+                num_val_created=0,
+                num_val_updated=0,
+                num_val_ignored=0,
+                num_path_created=0,
+                num_path_updated=0,
+                num_path_ignored=0,
+                num_synced=0,
+            )
+            for flow_uuid in polls_by_flow
+        }
+        questions_uuids = {flow_uuid: poll.get_question_uuids() for flow_uuid, poll in polls_by_flow.items()}
+
+        lock_expiration = time.time() + 0.8 * Poll.POLL_SYNC_LOCK_TIMEOUT
+        priority = min(
+            [self._get_poll_sync_priority(org, poll) for poll in polls_by_flow.values()],
+            key=lambda p: RapidProRateLimiter.PRIORITY_RESERVES[p],
         )
+        client = self._get_client(org, 2, priority=priority, fail_fast=True)
+
+        after = min(checkpoints.values(), key=json_date_to_datetime)
+        num_synced = 0
+
+        start = time.time()
+        logger.info("Start fetching runs for %d polls on org #%d after %s" % (len(polls_by_flow), org.pk, after))
+
+        runs_query = client.get_runs(after=after, reverse=True, paths=True)
+        fetches = self._prefetch(runs_query.iterfetches(retry_on_rate_exceed=True))
+
+        try:
+            for fetch in fetches:
+                fetch_latest_time = None
+                runs_by_flow = defaultdict(list)
+                for temba_run in fetch:
+                    if fetch_latest_time is None or temba_run.modified_on > fetch_latest_time:
+                        fetch_latest_time = temba_run.modified_on
+
+                    # runs of other flows, or already synced by their poll on its own, are skipped
+                    checkpoint = checkpoints.get(temba_run.flow.uuid)
+                    if checkpoint is not None and temba_run.modified_on >= json_date_to_datetime(checkpoint):
+                        runs_by_flow[temba_run.flow.uuid].append(temba_run)
+
+                for flow_uuid, flow_runs in runs_by_flow.items():
+                    poll = polls_by_flow[flow_uuid]
+                    stats_dict = stats[flow_uuid]
+
+                    (contacts_map, poll_results_map, poll_results_to_save_map) = self._initiate_lookup_maps(
+                        flow_runs, org, poll
+                    )
+
+                    updated_poll_results = []
+                    for temba_run in flow_runs:
+                        updated_poll_results += self._process_run_poll_results(
+                            org,
+                            questions_uuids[flow_uuid],
+                            temba_run,
+                            contacts_map.get(temba_run.contact.uuid, None),
+                            poll_results_map,
+                            poll_results_to_save_map,
+                            stats_dict,
+                        )
+
+                    stats_dict["num_synced"] += len(flow_runs)
+                    new_poll_results = self._save_new_poll_results_to_database(poll_results_to_save_map)
+                    self._record_poll_results_activity(org, updated_poll_results + new_poll_results)
+
+                # every run of the org up to the end of this fetch has been seen, so all checkpoints can move there
+                if fetch_latest_time is not None:
+                    fetch_latest = datetime_to_json_date(fetch_latest_time.replace(tzinfo=timezone.utc))
+                    for flow_uuid, checkpoint in checkpoints.items():
+                        if json_date_to_datetime(fetch_latest) > json_date_to_datetime(checkpoint):
+                            checkpoints[flow_uuid] = fetch_latest
+
+                num_synced += len(fetch)
+                if num_synced >= Poll.POLL_RESULTS_MAX_SYNC_RUNS or time.time() > lock_expiration:
+                    # the refresh of each poll continues from its checkpoint, like a single poll sync does
+                    for flow_uuid, poll in polls_by_flow.items():
+                        self._mark_poll_results_sync_paused(org, poll, checkpoints[flow_uuid])
+
+                    logger.info(
+                        "Break pull results for %d polls on org #%d in %ds after %d runs"
+                        % (len(polls_by_flow), org.pk, time.time() - start, num_synced)
+                    )
+                    return stats
+
+        except TembaRateExceededError as e:
+            # come back once the shared budget allows these polls to sync again
+            countdown = self._get_results_pull_countdown(org, priority, e.retry_after)
+            for flow_uuid, poll in polls_by_flow.items():
+                self._mark_poll_results_sync_paused(org, poll, checkpoints[flow_uuid], countdown=countdown)
+
+            logger.info(
+                "Break pull results for %d polls on org #%d in %ds after %d runs, rate limit exceeded"
+                % (len(polls_by_flow), org.pk, time.time() - start, num_synced)
+            )
+            return stats
+        finally:
+            fetches.close()
+
+        for flow_uuid, poll in polls_by_flow.items():
+            self._mark_poll_results_sync_completed(poll, org, checkpoints[flow_uuid])
+
+        logger.info(
+            "Finished pulling results for %d polls on org #%d, %d runs in %ds"
+            % (len(polls_by_flow), org.pk, num_synced, time.time() - start)
+        )
+        return stats
+
+    @staticmethod
+    def _load_results_contacts_filter(org, poll):
+        """
+        Loads the contacts having results on the poll flow into a bloom filter, so that pages of runs from
+        contacts without results can skip looking them up. Only worth its query on polls with many runs.
+        """
+        if poll.runs_count < Poll.POLL_RESULTS_CONTACTS_FILTER_MIN_RUNS:
+            return None
+
+        results_contacts = BloomFilter(poll.runs_count)
+        results_contacts.update(
+            PollResult.objects.filter(org=org.id, flow=poll.flow_uuid)
+            .values_list("contact", flat=True)
+            .iterator(chunk_size=10000)
+        )
+        return results_contacts
+
+    def _initiate_lookup_maps(self, fetch, org, poll, results_contacts=None):
+        contact_uuids = [run.contact.uuid for run in fetch]
+        contacts = Contact.objects.filter(org=org, uuid__in=contact_uuids).values_list(*ContactLookup.__slots__)
+        contacts_map = {values[0]: ContactLookup(*values) for values in contacts}
+
+        # only look up the contacts that may have results, the filter has no false negatives
+        results_uuids = contact_uuids
+        if results_contacts is not None:
+            results_uuids = [uuid for uuid in contact_uuids if uuid in results_contacts]
+
         poll_results_map = defaultdict(dict)
-        for res in existing_poll_results:
-            poll_results_map[res.contact][res.ruleset] = res
+        if results_uuids:
+            existing_poll_results = (
+                PollResult.objects.filter(flow=poll.flow_uuid, org=poll.org_id, contact__in=results_uuids)
+                .annotate(text_digest=MD5("text"))
+                .values_list(*PollResultLookup.__slots__)
+            )
+            for values in existing_poll_results:
+                res = PollResultLookup(*values)
+                poll_results_map[res.contact][res.ruleset] = res
 
         poll_results_to_save_map = defaultdict(dict)
         return contacts_map, poll_results_map, poll_results_to_save_map
@@ -801,6 +1550,8 @@ class RapidProBackend(BaseBackend):
             gender = contact_obj.gender
             scheme = contact_obj.scheme
 
+        updated_poll_results = []
+
         for temba_value in sorted(temba_run.values.values(), key=lambda val: val.time):
             ruleset_uuid = temba_value.node
             category = temba_value.category
@@ -843,7 +1594,7 @@ class RapidProBackend(BaseBackend):
 
                     # update the map object as well
                     existing_poll_result.category = category
-                    existing_poll_result.text = text
+                    existing_poll_result.text_digest = PollResultLookup.digest(text)
                     existing_poll_result.state = state
                     existing_poll_result.district = district
                     existing_poll_result.ward = ward
@@ -854,6 +1605,7 @@ class RapidProBackend(BaseBackend):
                     existing_poll_result.completed = completed
 
                     existing_db_poll_results_map[contact_uuid][ruleset_uuid] = existing_poll_result
+                    updated_poll_results.append(existing_poll_result)
 
                     stats_dict["num_val_updated"] += 1
                 else:
@@ -947,7 +1699,7 @@ class RapidProBackend(BaseBackend):
 
                         # update the map object as well
                         existing_poll_result.category = category
-                        existing_poll_result.text = text
+                        existing_poll_result.text_digest = PollResultLookup.digest(text)
                         existing_poll_result.state = state
                         existing_poll_result.district = district
                         existing_poll_result.ward = ward
@@ -958,6 +1710,7 @@ class RapidProBackend(BaseBackend):
                         existing_poll_result.completed = completed
 
                         existing_db_poll_results_map[contact_uuid][ruleset_uuid] = existing_poll_result
+                        updated_poll_results.append(existing_poll_result)
 
                         stats_dict["num_path_updated"] += 1
                     else:
@@ -1011,11 +1764,18 @@ class RapidProBackend(BaseBackend):
             else:
                 stats_dict["num_path_ignored"] += 1
 
+        return updated_poll_results
+
     @staticmethod
     def _check_update_required(
         poll_obj, category, text, state, district, ward, born, gender, scheme, completed, value_date
     ):
-        update_required = poll_obj.category != category or poll_obj.text != text
+        if isinstance(poll_obj, PollResultLookup):
+            text_changed = poll_obj.text_digest != PollResultLookup.digest(text)
+        else:
+            text_changed = poll_obj.text != text
+
+        update_required = poll_obj.category != category or text_changed
         update_required = update_required or poll_obj.state != state
         update_required = update_required or poll_obj.district != district
         update_required = update_required or poll_obj.ward != ward
@@ -1039,15 +1799,25 @@ class RapidProBackend(BaseBackend):
                 if obj_to_create is not None:
                     new_poll_results.append(obj_to_create)
         PollResult.objects.bulk_create(new_poll_results)
+        return new_poll_results
+
+    @staticmethod
+    def _record_poll_results_activity(org, poll_results):
+        # the contact activities and their counters are not read anymore once the sketches hold all the org activity
+        if not ContactActivity.count_from_sketches(org):
+            ContactActivity.update_for_poll_results(org.id, poll_results)
+
+        if ContactActivity.use_sketches():
+            ContactActivitySketch.add_poll_results(org.id, poll_results)
 
     @staticmethod
-    def _mark_poll_results_sync_paused(org, poll, latest_synced_obj_time):
+    def _mark_poll_results_sync_paused(org, poll, latest_synced_obj_time, countdown=300):
         # update the time for this poll from which we fetch next time
         cache.set(Poll.POLL_RESULTS_LAST_PULL_CACHE_KEY % (org.pk, poll.flow_uuid), latest_synced_obj_time, None)
 
         from ureport.polls.tasks import pull_refresh
 
-        pull_refresh.apply_async((poll.pk,), countdown=300, queue="sync")
+        pull_refresh.apply_async((poll.pk,), countdown=countdown, queue="sync")
 
     @staticmethod
     def _mark_poll_results_sync_completed(poll, org, latest_synced_obj_time):
@@ -0,0 +1,517 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import base64
+import gzip
+import json
+import logging
+import random
+import threading
+import time
+import uuid
+from bisect import bisect_left, bisect_right
+from collections import Counter
+from datetime import datetime, timezone
+from functools import lru_cache
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlencode, urlparse
+
+logger = logging.getLogger(__name__)
+
+UUID_NAMESPACE = uuid.UUID("5a8b3c1e-4f6d-4e2a-9b7c-0d1e2f3a4b5c")
+
+REPORTER_GROUP = "U-Reporters"
+
+CATEGORIES = ("Yes", "No", "Maybe", "Other")
+
+OCCUPATIONS = ("Student", "Farmer", "Teacher", "Trader", "")
+
+DAY = 24 * 60 * 60
+
+MONTH = 30 * DAY
+
+
+def format_time(timestamp):
+    return datetime.fromtimestamp(timestamp, tz=timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.%fZ")
+
+
+def parse_time(value):
+    return datetime.fromisoformat(value.replace("Z", "+00:00")).timestamp()
+
+
+class TimeSeries(object):
+    """
+    A lazy sequence of the items of an endpoint, ordered by their ascending modified time
+    """
+
+    def __init__(self, count, time_of, item_of):
+        self.count = count
+        self.time_of = time_of
+        self.item_of = item_of
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, index):
+        return self.time_of(index)
+
+    def select(self, after=None, before=None, reverse=False):
+        """
+        Returns the items modified in the given window, newest first unless reverse, as (count, get_item)
+        """
+        low = bisect_left(self, parse_time(after)) if after else 0
+        high = bisect_right(self, parse_time(before)) if before else self.count
+        count = max(high - low, 0)
+
+        if reverse:
+            return count, lambda offset: self.item_of(low + offset)
+        return count, lambda offset: self.item_of(high - 1 - offset)
+
+
+class StandInData(object):
+    """
+    Synthetic RapidPro workspace data, generated from the index of each object so that any page of any size
+    can be served without keeping the workspace in memory. The same seed and now always give the same data.
+    """
+
+    def __init__(
+        self,
+        contacts=1000,
+        deleted_contacts=0,
+        flows=2,
+        questions=3,
+        runs_per_flow=1000,
+        archived_runs_per_flow=0,
+        archive_months=3,
+        states=4,
+        districts_per_state=3,
+        seed=0,
+        now=None,
+    ):
+        self.num_contacts = max(contacts, 1)
+        self.num_deleted_contacts = deleted_contacts
+        self.num_flows = flows
+        self.num_questions = questions
+        self.num_runs = runs_per_flow
+        self.num_archived_runs = archived_runs_per_flow
+        self.num_archive_months = max(archive_months, 1) if archived_runs_per_flow else 0
+        self.num_states = states
+        self.num_districts = districts_per_state
+        self.seed = seed
+
+        self.now = int(now if now is not None else time.time())
+        self.live_start = self.now - MONTH
+        self.archives_start = self.live_start - self.num_archive_months * MONTH
+        self.flows_created_on = self.archives_start - DAY
+
+    def make_uuid(self, *parts):
+        return str(uuid.uuid5(UUID_NAMESPACE, ":".join(str(part) for part in (self.seed,) + parts)))
+
+    def random(self, *parts):
+        return random.Random(hash((self.seed,) + parts))
+
+    def contact_uuid(self, index):
+        return self.make_uuid("contact", index)
+
+    def flow_uuid(self, flow_index):
+        return self.make_uuid("flow", flow_index)
+
+    def question_node(self, flow_index, question_index):
+        return self.make_uuid("node", flow_index, question_index)
+
+    def contact_time(self, index):
+        return self.now - 3 * MONTH + (3 * MONTH - 60) * index / self.num_contacts
+
+    def deleted_contact_time(self, index):
+        return self.now - MONTH + (MONTH - 60) * index / max(self.num_deleted_contacts, 1)
+
+    def run_time(self, index):
+        return self.live_start + (MONTH - 60) * index / max(self.num_runs, 1)
+
+    def archive_runs_range(self, month):
+        per_month = self.num_archived_runs / self.num_archive_months
+        return int(round(month * per_month)), int(round((month + 1) * per_month))
+
+    def archived_run_time(self, month, index):
+        low, high = self.archive_runs_range(month)
+        return self.archives_start + month * MONTH + (MONTH - 60) * (index - low) / max(high - low, 1)
+
+    def contact(self, index):
+        rng = self.random(1, index)
+        modified_on = self.contact_time(index)
+        state = index % self.num_states + 1
+        district = index // self.num_states % self.num_districts + 1
+        scheme = "whatsapp" if rng.random() < 0.2 else "tel"
+        group = REPORTER_GROUP if rng.random() < 0.95 else "Testers"
+
+        return {
+            "uuid": self.contact_uuid(index),
+            "name": "Contact %d" % index,
+            "status": "active",
+            "language": "eng",
+            "urns": ["%s:+250788%06d" % (scheme, index % 1000000)],
+            "groups": [{"uuid": self.make_uuid("group", group), "name": group}],
+            "fields": {
+                "state": "Standinland > State %d" % state,
+                "district": "Standinland > State %d > District %d-%d" % (state, state, district),
+                "gender": rng.choice(("Male", "Female")),
+                "born": str(rng.randint(1980, 2010)),
+                "registration_date": format_time(modified_on - rng.randint(0, 365) * DAY),
+                "occupation": rng.choice(OCCUPATIONS) or None,
+            },
+            "blocked": False,
+            "stopped": False,
+            "created_on": format_time(modified_on - DAY),
+            "modified_on": format_time(modified_on),
+            "last_seen_on": format_time(modified_on),
+        }
+
+    def deleted_contact(self, index):
+        modified_on = format_time(self.deleted_contact_time(index))
+        return {
+            "uuid": self.contact_uuid(self.num_contacts + index),
+            "name": None,
+            "status": None,
+            "language": None,
+            "urns": [],
+            "groups": [],
+            "fields": {},
+            "blocked": None,
+            "stopped": None,
+            "created_on": modified_on,
+            "modified_on": modified_on,
+            "last_seen_on": None,
+        }
+
+    def run(self, flow_index, index, month=None):
+        archived = month is not None
+        rng = self.random(2, flow_index, index, archived)
+        modified_on = self.archived_run_time(month, index) if archived else self.run_time(index)
+        contact_index = (index * 7919 + flow_index * 104729 + archived) % self.num_contacts
+        completed = rng.random() < 0.8
+
+        path = []
+        values = dict()
+        for question_index in range(self.num_questions):
+            node = self.question_node(flow_index, question_index)
+            value_time = format_time(modified_on - (self.num_questions - question_index))
+            category = rng.choice(CATEGORIES)
+
+            path.append({"node": node, "time": value_time})
+            values["question_%d" % (question_index + 1)] = {
+                "name": "Question %d" % (question_index + 1),
+                "value": category.lower(),
+                "category": category,
+                "node": node,
+                "time": value_time,
+                "input": category.lower(),
+            }
+
+        return {
+            "id": (flow_index * 2 + archived) * 10**9 + index,
+            "uuid": self.make_uuid("run", flow_index, index, archived),
+            "flow": {"uuid": self.flow_uuid(flow_index), "name": "Stand-in flow %d" % (flow_index + 1)},
+            "contact": {"uuid": self.contact_uuid(contact_index), "name": "Contact %d" % contact_index},
+            "start": None,
+            "responded": True,
+            "path": path,
+            "values": values,
+            "created_on": format_time(modified_on - 3600),
+            "modified_on": format_time(modified_on),
+            "exited_on": format_time(modified_on) if completed else None,
+            "exit_type": "completed" if completed else None,
+        }
+
+    def flow(self, flow_index):
+        completed = int(self.num_runs * 0.8)
+        return {
+            "uuid": self.flow_uuid(flow_index),
+            "name": "Stand-in flow %d" % (flow_index + 1),
+            "type": "message",
+            "archived": False,
+            "labels": [],
+            "expires": 10080,
+            "runs": {
+                "active": self.num_runs - completed,
+                "waiting": 0,
+                "completed": completed,
+                "interrupted": 0,
+                "expired": 0,
+                "failed": 0,
+            },
+            "results": [
+                {
+                    "key": "question_%d" % (question_index + 1),
+                    "name": "Question %d" % (question_index + 1),
+                    "categories": list(CATEGORIES),
+                    "node_uuids": [self.question_node(flow_index, question_index)],
+                }
+                for question_index in range(self.num_questions)
+            ],
+            "parent_refs": [],
+            "created_on": format_time(self.flows_created_on),
+            "modified_on": format_time(self.flows_created_on),
+        }
+
+    def fields(self):
+        return [
+            {"key": key, "name": name, "label": name, "type": value_type, "value_type": value_type}
+            for key, name, value_type in (
+                ("state", "State", "state"),
+                ("district", "District", "district"),
+                ("gender", "Gender", "text"),
+                ("born", "Born", "number"),
+                ("registration_date", "Registration Date", "datetime"),
+                ("occupation", "Occupation", "text"),
+            )
+        ]
+
+    def boundaries(self):
+        geometry = {"type": "MultiPolygon", "coordinates": [[[[0, 0], [1, 0], [1, 1], [0, 0]]]]}
+        country = {"osm_id": "R0", "name": "Standinland"}
+
+        boundaries = [dict(country, level=0, parent=None, aliases=[], geometry=geometry)]
+        for state in range(1, self.num_states + 1):
+            state_ref = {"osm_id": "R1.%d" % state, "name": "State %d" % state}
+            boundaries.append(dict(state_ref, level=1, parent=country, aliases=[], geometry=geometry))
+
+            for district in range(1, self.num_districts + 1):
+                district_ref = {"osm_id": "R2.%d.%d" % (state, district), "name": "District %d-%d" % (state, district)}
+                boundaries.append(dict(district_ref, level=2, parent=state_ref, aliases=[], geometry=geometry))
+        return boundaries
+
+    def archive(self, month, base_url):
+        low, high = self.archive_runs_range(month)
+        record_count = (high - low) * self.num_flows
+        return {
+            "archive_type": "run",
+            "start_date": format_time(self.archives_start + month * MONTH),
+            "period": "monthly",
+            "record_count": record_count,
+            "size": record_count * 1024,
+            "hash": self.make_uuid("archive", month).replace("-", ""),
+            "download_url": "%s/archives/%d.jsonl.gz" % (base_url, month),
+        }
+
+    @lru_cache(maxsize=2)
+    def archive_content(self, month):
+        low, high = self.archive_runs_range(month)
+        lines = (
+            json.dumps(self.run(flow_index, index, month)) + "\n"
+            for index in range(low, high)
+            for flow_index in range(self.num_flows)
+        )
+        return gzip.compress("".join(lines).encode("utf-8"), compresslevel=1)
+
+    def runs_series(self, flow_uuid=None):
+        if flow_uuid:
+            flow_indexes = [i for i in range(self.num_flows) if self.flow_uuid(i) == flow_uuid]
+            if not flow_indexes:
+                return TimeSeries(0, self.run_time, None)
+
+            flow_index = flow_indexes[0]
+            return TimeSeries(self.num_runs, self.run_time, lambda index: self.run(flow_index, index))
+
+        # runs of all the flows share the same times, so the runs of the org interleave the runs of each flow
+        return TimeSeries(
+            self.num_runs * self.num_flows,
+            lambda position: self.run_time(position // self.num_flows),
+            lambda position: self.run(position % self.num_flows, position // self.num_flows),
+        )
+
+    def contacts_series(self, deleted=False):
+        if deleted:
+            return TimeSeries(self.num_deleted_contacts, self.deleted_contact_time, self.deleted_contact)
+        return TimeSeries(self.num_contacts, self.contact_time, self.contact)
+
+
+class StandInServer(ThreadingHTTPServer):
+    """
+    HTTP server answering the RapidPro API v2 endpoints used by the RapidPro backend from a StandInData, with an
+    optional latency per request and a ratio of requests rejected as rate limited
+    """
+
+    daemon_threads = True
+
+    def __init__(
+        self, address, data, page_size=250, latency=0.0, jitter=0.0, rate_limit_ratio=0.0, retry_after=1, seed=0
+    ):
+        super().__init__(address, StandInRequestHandler)
+        self.data = data
+        self.page_size = page_size
+        self.latency = latency
+        self.jitter = jitter
+        self.rate_limit_ratio = rate_limit_ratio
+        self.retry_after = retry_after
+
+        self.stats = Counter()
+        self.stats_lock = threading.Lock()
+        self.random = random.Random(seed)
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return "http://%s:%d" % (host, port)
+
+    def count(self, **counts):
+        with self.stats_lock:
+            self.stats.update(counts)
+
+    def reset_stats(self):
+        with self.stats_lock:
+            stats = dict(self.stats)
+            self.stats.clear()
+        return stats
+
+    def delay(self):
+        with self.stats_lock:
+            delay = self.latency + self.random.uniform(0, self.jitter) if self.latency or self.jitter else 0
+            rate_limited = self.rate_limit_ratio and self.random.random() < self.rate_limit_ratio
+        return delay, rate_limited
+
+
+class StandInRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        logger.debug("%s - %s" % (self.address_string(), format % args))
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        params = {key: values[-1] for key, values in parse_qs(url.query).items()}
+        data = self.server.data
+
+        if url.path.startswith("/archives/"):
+            try:
+                month = int(url.path.split("/")[-1].split(".")[0])
+            except ValueError:
+                return self.send_json(404, {"detail": "Not found."})
+
+            content = data.archive_content(month) if 0 <= month < data.num_archive_months else None
+            if content is None:
+                return self.send_json(404, {"detail": "Not found."})
+
+            low, high = data.archive_runs_range(month)
+            self.server.count(requests=1, archive_downloads=1, archived_runs=(high - low) * data.num_flows)
+            return self.send_content(200, "application/gzip", content)
+
+        endpoint = url.path.rstrip("/").split("/")[-1]
+        if not url.path.startswith("/api/v2/") or not endpoint.endswith(".json"):
+            return self.send_json(404, {"detail": "Not found."})
+        endpoint = endpoint[: -len(".json")]
+
+        delay, rate_limited = self.server.delay()
+        if delay:
+            time.sleep(delay)
+
+        self.server.count(requests=1)
+        if rate_limited:
+            self.server.count(rate_limited=1)
+            return self.send_json(
+                429, {"detail": "Request was throttled."}, {"Retry-After": str(self.server.retry_after)}
+            )
+
+        reverse = params.get("reverse") in ("1", "true")
+        after, before = params.get("after"), params.get("before")
+
+        if endpoint == "runs":
+            count, get_item = data.runs_series(params.get("flow")).select(after, before, reverse)
+        elif endpoint == "contacts":
+            deleted = params.get("deleted") in ("1", "true")
+            count, get_item = data.contacts_series(deleted).select(after, before, reverse)
+        elif endpoint == "flows":
+            count, get_item = data.num_flows, data.flow
+        elif endpoint == "fields":
+            fields = data.fields()
+            count, get_item = len(fields), fields.__getitem__
+        elif endpoint == "boundaries":
+            boundaries = data.boundaries()
+            count, get_item = len(boundaries), boundaries.__getitem__
+        elif endpoint == "archives":
+            archives = [data.archive(month, self.base_url) for month in range(data.num_archive_months)]
+            if params.get("archive_type", "run") != "run":
+                archives = []
+            if after:
+                archives = [elt for elt in archives if parse_time(elt["start_date"]) >= parse_time(after)]
+            count, get_item = len(archives), archives.__getitem__
+        else:
+            return self.send_json(404, {"detail": "Not found."})
+
+        self.send_page(endpoint, url.path, params, count, get_item)
+
+    @property
+    def base_url(self):
+        return "http://%s" % self.headers.get("Host", "%s:%d" % self.server.server_address[:2])
+
+    def send_page(self, endpoint, path, params, count, get_item):
+        cursor = params.pop("cursor", None)
+        offset = int(base64.urlsafe_b64decode(cursor.encode("ascii")).decode("ascii")) if cursor else 0
+        end = min(offset + self.server.page_size, count)
+
+        results = [get_item(position) for position in range(offset, end)]
+        self.server.count(**{endpoint: len(results)})
+
+        next_url = None
+        if end < count:
+            params["cursor"] = base64.urlsafe_b64encode(str(end).encode("ascii")).decode("ascii")
+            next_url = "%s%s?%s" % (self.base_url, path, urlencode(params))
+
+        self.send_json(200, {"next": next_url, "previous": None, "results": results})
+
+    def send_json(self, status, payload, headers=None):
+        self.send_content(status, "application/json", json.dumps(payload).encode("utf-8"), headers)
+
+    def send_content(self, status, content_type, content, headers=None):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(content)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(content)
+
+
+def add_standin_arguments(parser):
+    """
+    Adds the options sizing the stand-in workspace and shaping its responses to a management command parser
+    """
+    parser.add_argument("--contacts", type=int, default=10000, help="Number of contacts")
+    parser.add_argument("--deleted-contacts", type=int, default=100, help="Number of deleted contacts")
+    parser.add_argument("--flows", type=int, default=2, help="Number of flows")
+    parser.add_argument("--questions", type=int, default=3, help="Number of questions of each flow")
+    parser.add_argument("--runs-per-flow", type=int, default=10000, help="Number of runs of each flow in the API")
+    parser.add_argument(
+        "--archived-runs-per-flow", type=int, default=0, help="Number of runs of each flow in the run archives"
+    )
+    parser.add_argument("--archive-months", type=int, default=3, help="Number of monthly run archives")
+    parser.add_argument("--page-size", type=int, default=250, help="Number of items in each page of the API")
+    parser.add_argument("--latency-ms", type=float, default=0, help="Time taken by each API request")
+    parser.add_argument("--jitter-ms", type=float, default=0, help="Random extra time taken by each API request")
+    parser.add_argument(
+        "--rate-limit-ratio", type=float, default=0, help="Share of the API requests rejected as rate limited"
+    )
+    parser.add_argument("--retry-after", type=int, default=1, help="Seconds to wait after a rate limited request")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the generated data")
+
+
+def create_standin_server(options, address):
+    data = StandInData(
+        contacts=options["contacts"],
+        deleted_contacts=options["deleted_contacts"],
+        flows=options["flows"],
+        questions=options["questions"],
+        runs_per_flow=options["runs_per_flow"],
+        archived_runs_per_flow=options["archived_runs_per_flow"],
+        archive_months=options["archive_months"],
+        seed=options["seed"],
+    )
+    return StandInServer(
+        address,
+        data,
+        page_size=options["page_size"],
+        latency=options["latency_ms"] / 1000.0,
+        jitter=options["jitter_ms"] / 1000.0,
+        rate_limit_ratio=options["rate_limit_ratio"],
+        retry_after=options["retry_after"],
+        seed=options["seed"],
+    )
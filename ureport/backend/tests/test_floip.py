@@ -1,6 +1,8 @@
 # -*- coding: utf-8 -*-
 from __future__ import absolute_import, division, print_function, unicode_literals
 
+import json
+
 from mock import patch
 from temba_client.v2.types import Contact as TembaContact, ObjectRef
 
@@ -233,6 +235,9 @@ class ContactSyncerTest(UreportTest):
 
 
 class FLOIPBackendTest(UreportTest):
+    # the query counts of the results pulls include the INSERT of the missing contact activities of the saved results
+    # and the UPDATE of their attributes
+
     def setUp(self):
         super(FLOIPBackendTest, self).setUp()
         self.backend = FLOIPBackend(self.floip_backend)
@@ -288,7 +293,7 @@ class FLOIPBackendTest(UreportTest):
             geometry='{"foo":"bar-state"}',
         )
 
-    @patch("requests.request")
+    @patch("requests.Session.request")
     def test_fetch_flows(self, mock_get):
         response_contents = """{
             "links": {
@@ -328,7 +333,31 @@ class FLOIPBackendTest(UreportTest):
 
         self.assertEqual(self.backend.fetch_flows(self.nigeria), fetched_flows)
 
-    @patch("requests.request")
+        mock_get.assert_called_once_with(
+            "GET",
+            "https://go.votomobile.org/flow-results/packages/",
+            params=None,
+            timeout=30,
+            allow_redirects=True,
+        )
+
+        # pages are followed through their next links with the same pooled session
+        first_page = json.loads(response_contents)
+        first_page["links"]["next"] = "https://go.votomobile.org/flow-results/packages?page%5Bafter%5D=1"
+        mock_get.reset_mock()
+        mock_get.side_effect = [
+            MockResponse(200, json.dumps(first_page)),
+            MockResponse(200, response_contents.replace("2a754346", "3b865457")),
+        ]
+
+        self.assertEqual(len(self.backend.fetch_flows(self.nigeria)), 2)
+        self.assertEqual(mock_get.call_args_list[1][0][1], first_page["links"]["next"])
+        self.assertEqual(
+            self.backend._get_session().headers["Authorization"], "Token %s" % self.floip_backend.api_token
+        )
+        self.assertIs(self.backend._get_session(), FLOIPBackend(self.floip_backend)._get_session())
+
+    @patch("requests.Session.request")
     def test_get_definition(self, mock_get):
         response_contents = """
         {
@@ -592,7 +621,7 @@ class FLOIPBackendTest(UreportTest):
             ),
         ]
 
-        with self.assertNumQueries(10):
+        with self.assertNumQueries(8):
             contact_results, resume_cursor = self.backend.pull_contacts(self.nigeria, None, None)
 
         self.assertEqual(
@@ -651,7 +680,7 @@ class FLOIPBackendTest(UreportTest):
             ),
         ]
 
-        with self.assertNumQueries(10):
+        with self.assertNumQueries(8):
             contact_results, resume_cursor = self.backend.pull_contacts(self.nigeria, None, None)
 
         self.assertEqual(
@@ -712,7 +741,7 @@ class FLOIPBackendTest(UreportTest):
             ),
         ]
 
-        with self.assertNumQueries(10):
+        with self.assertNumQueries(8):
             contact_results, resume_cursor = self.backend.pull_contacts(self.nigeria, None, None)
 
         self.assertEqual(
@@ -774,7 +803,7 @@ class FLOIPBackendTest(UreportTest):
             ),
         ]
 
-        with self.assertNumQueries(10):
+        with self.assertNumQueries(8):
             contact_results, resume_cursor = self.backend.pull_contacts(self.nigeria, None, None)
 
         self.assertEqual(
@@ -836,7 +865,7 @@ class FLOIPBackendTest(UreportTest):
             ),
         ]
 
-        with self.assertNumQueries(10):
+        with self.assertNumQueries(8):
             contact_results, resume_cursor = self.backend.pull_contacts(self.nigeria, None, None)
 
         self.assertEqual(
@@ -882,7 +911,7 @@ class FLOIPBackendTest(UreportTest):
 
         self.assertFalse(Contact.objects.filter(uuid="C-002", is_active=True))
 
-    @patch("requests.request")
+    @patch("requests.Session.request")
     @patch("redis.client.StrictRedis.lock")
     @patch("django.core.cache.cache.get")
     def test_pull_results(self, mock_cache_get, mock_redis_lock, mock_request):
@@ -1152,7 +1181,7 @@ class FLOIPBackendTest(UreportTest):
         self.create_poll_question(self.admin, poll, "question 2", "q_1522956746998_26")
         self.create_poll_question(self.admin, poll, "question 3", "q_1522957067432_34")
 
-        with self.assertNumQueries(4):
+        with self.assertNumQueries(6):
             (
                 num_val_created,
                 num_val_updated,
@@ -5,9 +5,14 @@ import gzip
 import io
 import json
 import logging
-from datetime import timedelta
-
-from mock import PropertyMock, patch
+import os
+import tracemalloc
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, timedelta
+
+from django_redis import get_redis_connection
+from mock import PropertyMock, call, patch
 from temba_client.exceptions import TembaRateExceededError
 from temba_client.v2.types import (
     Archive as TembaArchive,
@@ -18,6 +23,7 @@ from temba_client.v2.types import (
     Run as TembaRun,
 )
 
+from django.core.cache import cache
 from django.db import connection, reset_queries
 from django.test import override_settings
 from django.utils import timezone
@@ -25,11 +31,21 @@ from django.utils import timezone
 from dash.categories.models import Category
 from dash.test import MockClientQuery
 from dash.utils.sync import SyncOutcome
-from ureport.backend.rapidpro import BoundarySyncer, ContactSyncer, FieldSyncer, RapidProBackend
+from ureport.backend import SkippedPullResults
+from ureport.backend.rapidpro import (
+    BoundarySyncer,
+    ContactSyncer,
+    FieldSyncer,
+    PollResultLookup,
+    RapidProBackend,
+    RapidProRateLimiter,
+    decode_archive_runs,
+)
 from ureport.contacts.models import Contact, ContactField
 from ureport.flows.models import FlowResult, FlowResultCategory
 from ureport.locations.models import Boundary
 from ureport.polls.models import Poll, PollQuestion, PollResponseCategory, PollResult
+from ureport.stats.models import ContactActivity
 from ureport.tests import MockResponse, UreportTest
 from ureport.utils import datetime_to_json_date, json_date_to_datetime
 
@@ -552,6 +568,11 @@ class ContactSyncerTest(UreportTest):
         self.assertEqual(contact.registered_on, json_date_to_datetime("2014-01-02T03:04:05.000000Z"))
         self.assertEqual(contact.state, "R-LAGOS")
 
+        # not registered recently so nothing to backfill
+        self.assertEqual(self.syncer.new_contacts, [])
+        with self.assertNumQueries(0):
+            self.assertEqual(self.syncer.backfill_poll_results(), 0)
+
         result.refresh_from_db()
         self.assertFalse(result.state)
 
@@ -585,6 +606,15 @@ class ContactSyncerTest(UreportTest):
         )
         self.assertFalse(result.state)
 
+        old_result = PollResult.objects.create(
+            org=self.nigeria,
+            flow="flow-uuid",
+            ruleset="ruleset-uuid-2",
+            contact="C-009",
+            completed=False,
+            date=json_date_to_datetime("2015-02-09T12:48:44.320Z"),
+        )
+
         contact = self.syncer.create_local(self.syncer.local_kwargs(self.nigeria, remote))
 
         self.assertEqual(contact.org, self.nigeria)
@@ -592,11 +622,159 @@ class ContactSyncerTest(UreportTest):
         self.assertEqual(contact.registered_on, json_date_to_datetime("2015-04-09T12:48:44.320Z"))
         self.assertEqual(contact.state, "R-LAGOS")
 
+        # poll results are only backfilled once the fetch is done
+        result.refresh_from_db()
+        self.assertFalse(result.state)
+        self.assertEqual(self.syncer.new_contacts, [contact])
+
+        # one update of the poll results and one of the contact activities of the org
+        with self.assertNumQueries(2):
+            self.assertEqual(self.syncer.backfill_poll_results(), 1)
+
+        self.assertEqual(self.syncer.new_contacts, [])
+
         result.refresh_from_db()
         self.assertEqual(result.state, "R-LAGOS")
+        self.assertEqual(result.district, "R-OYO")
+        self.assertEqual(result.born, 1990)
+        self.assertEqual(result.gender, "M")
+        self.assertEqual(result.scheme, "tel")
+
+        # results older than a month are left alone
+        old_result.refresh_from_db()
+        self.assertFalse(old_result.state)
+
+
+@override_settings(RAPIDPRO_RATE_LIMIT_BURST=10, RAPIDPRO_RATE_LIMIT_PER_HOUR=3600)
+class RapidProRateLimiterTest(UreportTest):
+    def setUp(self):
+        super(RapidProRateLimiterTest, self).setUp()
+        for scope in ("v2", "v2.runs"):
+            get_redis_connection().delete(RapidProRateLimiter.KEY % (self.nigeria.pk, "rapidpro", scope))
+
+    @patch("time.time")
+    def test_priorities(self, mock_time):
+        mock_time.return_value = 1000.0
+
+        high = RapidProRateLimiter(self.nigeria, "rapidpro", RapidProRateLimiter.PRIORITY_HIGH)
+        normal = RapidProRateLimiter(self.nigeria, "rapidpro", RapidProRateLimiter.PRIORITY_NORMAL)
+        low = RapidProRateLimiter(self.nigeria, "rapidpro", RapidProRateLimiter.PRIORITY_LOW)
+
+        self.assertEqual(low.get_delay(), 0)
+
+        # low priority leaves half of the bucket to the others
+        for i in range(5):
+            low.acquire()
+        self.assertEqual(low.get_delay(), 1)
+        self.assertEqual(normal.get_delay(), 0)
+
+        # so callers able to reschedule themselves give up with the time to wait
+        with self.assertRaises(TembaRateExceededError) as cm:
+            RapidProRateLimiter(self.nigeria, "rapidpro", RapidProRateLimiter.PRIORITY_LOW, fail_fast=True).acquire()
+        self.assertEqual(cm.exception.retry_after, 1)
+
+        # while the others wait for the bucket to refill
+        def sleep(seconds):
+            mock_time.return_value += seconds
+
+        with patch("time.sleep") as mock_sleep:
+            mock_sleep.side_effect = sleep
+            low.acquire()
+            mock_sleep.assert_called_once_with(1.0)
+
+        # normal priority leaves a quarter
+        for i in range(2):
+            normal.acquire()
+        self.assertTrue(normal.get_delay() > 0)
+
+        # high priority gets all of it
+        for i in range(3):
+            high.acquire()
+        self.assertEqual(high.get_delay(), 1)
+
+        # the bucket refills over time
+        mock_time.return_value = 1011.0
+        self.assertEqual(low.get_delay(), 0)
+        self.assertEqual(high.get_delay(), 0)
+
+    @patch("time.time")
+    def test_limit_client(self, mock_time):
+        mock_time.return_value = 1000.0
+
+        limiter = RapidProRateLimiter(self.nigeria, "rapidpro", RapidProRateLimiter.PRIORITY_HIGH)
+        client = self.nigeria.get_temba_client(api_version=2)
+
+        with patch("dash.orgs.models.TembaClient._request") as mock_request:
+            mock_request.return_value = {"results": [], "next": None}
+            limiter.limit_client(client)
+
+            client.get_fields().all()
+            self.assertEqual(limiter.get_delay(), 0)
+            self.assertEqual(mock_request.call_count, 1)
+
+            # RapidPro asking us to wait empties the bucket for everyone
+            mock_request.side_effect = TembaRateExceededError(30)
+            with self.assertRaises(TembaRateExceededError):
+                client.get_fields().all()
+
+            self.assertEqual(limiter.get_delay(), 31)
+            self.assertEqual(
+                RapidProRateLimiter(self.nigeria, "rapidpro", RapidProRateLimiter.PRIORITY_LOW).get_delay(), 36
+            )
+
+            # fail fast callers give up rather than wait
+            with self.assertRaises(TembaRateExceededError):
+                RapidProRateLimiter(
+                    self.nigeria, "rapidpro", RapidProRateLimiter.PRIORITY_HIGH, fail_fast=True
+                ).acquire()
+
+            # other scopes keep their own bucket
+            runs_limiter = limiter.for_scope(RapidProRateLimiter.get_scope("https://rapidpro.io/api/v2/runs.json"))
+            self.assertEqual(runs_limiter.get_delay(), 0)
+
+            mock_request.side_effect = None
+            client.get_runs().all()
+            self.assertEqual(mock_request.call_count, 3)
+
+    @override_settings(RAPIDPRO_RATE_LIMIT=True, RAPIDPRO_PREFETCH_FETCHES=0)
+    @patch("time.sleep")
+    @patch("time.time")
+    def test_pull_contacts_waits(self, mock_time, mock_sleep):
+        mock_time.return_value = 1000.0
+
+        def sleep(seconds):
+            mock_time.return_value += seconds
+
+        mock_sleep.side_effect = sleep
+
+        def request(method, url, params=None, retry_on_rate_exceed=False):
+            if params and params.get("deleted"):
+                return {"results": [], "next": None}
+
+            page = int(url.rsplit("=", 1)[-1]) if "cursor=" in url else 0
+            contact = TembaContact.create(
+                uuid="C-%03d" % page, name="Jan", urns=["tel:%d" % page], groups=[], fields={}, language="eng"
+            )
+            next_url = "http://localhost:8001/api/v2/contacts.json?cursor=%d" % (page + 1) if page < 119 else None
+            return {"results": [contact.serialize()], "next": next_url}
+
+        backend = RapidProBackend(self.rapidpro_backend)
+
+        # a contacts pull of far more pages than the burst waits for the bucket to refill rather than fail
+        with patch("dash.orgs.models.TembaClient._request") as mock_request:
+            mock_request.side_effect = request
+            outcomes, resume_cursor = backend.pull_contacts(self.nigeria, None, None)
+
+        self.assertEqual(sum(outcomes.values()), 120)
+        self.assertIsNone(resume_cursor)
+        self.assertEqual(mock_request.call_count, 121)
+        self.assertTrue(mock_sleep.called)
 
 
 class RapidProBackendTest(UreportTest):
+    # the query counts of the results pulls include the INSERT of the missing contact activities of the saved results
+    # and the UPDATE of their attributes
+
     def setUp(self):
         super(RapidProBackendTest, self).setUp()
         self.backend = RapidProBackend(self.rapidpro_backend)
@@ -816,7 +994,7 @@ class RapidProBackendTest(UreportTest):
             ),
         ]
 
-        with self.assertNumQueries(10):
+        with self.assertNumQueries(8):
             contact_results, resume_cursor = self.backend.pull_contacts(self.nigeria, None, None)
 
         self.assertEqual(
@@ -881,7 +1059,7 @@ class RapidProBackendTest(UreportTest):
             ),
         ]
 
-        with self.assertNumQueries(11):
+        with self.assertNumQueries(9):
             contact_results, resume_cursor = self.backend.pull_contacts(self.nigeria, None, None)
 
         self.assertEqual(
@@ -947,7 +1125,7 @@ class RapidProBackendTest(UreportTest):
             ),
         ]
 
-        with self.assertNumQueries(12):
+        with self.assertNumQueries(10):
             contact_results, resume_cursor = self.backend.pull_contacts(self.nigeria, None, None)
 
         self.assertEqual(
@@ -1012,7 +1190,7 @@ class RapidProBackendTest(UreportTest):
             ),
         ]
 
-        with self.assertNumQueries(12):
+        with self.assertNumQueries(10):
             contact_results, resume_cursor = self.backend.pull_contacts(self.nigeria, None, None)
 
         self.assertEqual(
@@ -1059,6 +1237,167 @@ class RapidProBackendTest(UreportTest):
 
         self.assertFalse(Contact.objects.filter(uuid="C-002", is_active=True))
 
+    @override_settings(RAPIDPRO_BULK_CONTACTS_SYNC=True)
+    @patch("dash.orgs.models.TembaClient.get_contacts")
+    def test_pull_contacts_bulk(self, mock_get_contacts):
+        Contact.objects.all().delete()
+
+        def remote_contact(uuid, groups, born, state="Lagos"):
+            return TembaContact.create(
+                uuid=uuid,
+                name="Jan",
+                urns=["tel:123"],
+                groups=[ObjectRef.create(uuid="G-001", name=name) for name in groups],
+                fields={
+                    "registration_date": "2014-01-02T03:04:05.000000Z",
+                    "state": state,
+                    "lga": "Oyo",
+                    "born": born,
+                    "gender": "Male",
+                },
+                language="eng",
+                status="active",
+                created_on=json_date_to_datetime("2013-01-02T03:04:05.000"),
+            )
+
+        mock_get_contacts.side_effect = [
+            MockClientQuery(
+                [
+                    remote_contact("C-001", ["ureporters"], "1990"),
+                    remote_contact("C-002", ["ureporters"], "1992"),
+                    remote_contact("C-003", ["Spammers"], "1994"),
+                ],
+                [remote_contact("C-004", ["ureporters"], "1996")],
+            ),
+            MockClientQuery([]),
+        ]
+
+        contact_results, resume_cursor = self.backend.pull_contacts(self.nigeria, None, None)
+
+        self.assertEqual(
+            contact_results,
+            {SyncOutcome.created: 3, SyncOutcome.updated: 0, SyncOutcome.deleted: 0, SyncOutcome.ignored: 1},
+        )
+        self.assertIsNone(resume_cursor)
+        self.assertEqual(
+            set(Contact.objects.filter(is_active=True).values_list("uuid", flat=True)), {"C-001", "C-002", "C-004"}
+        )
+
+        contact = Contact.objects.get(uuid="C-001")
+        self.assertEqual(contact.org, self.nigeria)
+        self.assertEqual(contact.backend, self.rapidpro_backend)
+        self.assertEqual(contact.born, 1990)
+        self.assertEqual(contact.state, "R-LAGOS")
+        self.assertEqual(contact.district, "R-OYO")
+        self.assertEqual(contact.gender, "M")
+        self.assertEqual(contact.scheme, "tel")
+
+        Contact.objects.filter(uuid="C-004").update(is_active=False)
+        Contact.objects.create(org=self.nigeria, backend=self.rapidpro_backend, uuid="C-007")
+
+        mock_get_contacts.side_effect = [
+            MockClientQuery(
+                [
+                    # unchanged
+                    remote_contact("C-001", ["ureporters"], "1990"),
+                    # changed
+                    remote_contact("C-002", ["ureporters"], "1993"),
+                    # never in the reporters group
+                    remote_contact("C-003", ["Spammers"], "1994"),
+                    # reactivated
+                    remote_contact("C-004", ["ureporters"], "1996"),
+                    # left the reporters group
+                    remote_contact("C-007", ["Spammers"], "1994"),
+                ]
+            ),
+            MockClientQuery([remote_contact("C-001", [], "1990"), remote_contact("C-006", [], "1990")]),
+        ]
+
+        contact_results, resume_cursor = self.backend.pull_contacts(self.nigeria, None, None)
+
+        self.assertEqual(
+            contact_results,
+            {SyncOutcome.created: 0, SyncOutcome.updated: 2, SyncOutcome.deleted: 2, SyncOutcome.ignored: 2},
+        )
+        self.assertEqual(
+            set(Contact.objects.filter(is_active=True).values_list("uuid", flat=True)), {"C-002", "C-004"}
+        )
+        self.assertEqual(Contact.objects.get(uuid="C-002").born, 1993)
+        self.assertEqual(Contact.objects.count(), 4)
+
+        # a contact created by another sync between the diff query and the write is updated instead
+        bulk_create = Contact.objects.bulk_create
+
+        def racing_bulk_create(objs, **kwargs):
+            Contact.objects.create(org=self.nigeria, backend=self.rapidpro_backend, uuid="C-008", born=1980)
+            return bulk_create(objs, **kwargs)
+
+        mock_get_contacts.side_effect = [
+            MockClientQuery([remote_contact("C-008", ["ureporters"], "1998")]),
+            MockClientQuery([]),
+        ]
+
+        with patch.object(Contact.objects, "bulk_create", side_effect=racing_bulk_create):
+            contact_results, resume_cursor = self.backend.pull_contacts(self.nigeria, None, None)
+
+        self.assertEqual(
+            contact_results,
+            {SyncOutcome.created: 1, SyncOutcome.updated: 0, SyncOutcome.deleted: 0, SyncOutcome.ignored: 0},
+        )
+        self.assertEqual(Contact.objects.get(uuid="C-008").born, 1998)
+        self.assertEqual(Contact.objects.count(), 5)
+
+    @patch("dash.orgs.models.TembaClient.get_contacts")
+    def test_pull_contacts_time_limit(self, mock_get_contacts):
+        Contact.objects.all().delete()
+
+        def remote_contact(uuid):
+            return TembaContact.create(
+                uuid=uuid,
+                name="Jan",
+                urns=["tel:123"],
+                groups=[ObjectRef.create(uuid="G-001", name="ureporters")],
+                fields={},
+                language="eng",
+                status="active",
+                created_on=json_date_to_datetime("2013-01-02T03:04:05.000"),
+            )
+
+        mock_get_contacts.side_effect = [
+            MockClientQuery([remote_contact("C-001"), remote_contact("C-002")], [remote_contact("C-003")]),
+            MockClientQuery([]),
+        ]
+
+        progress = []
+
+        def progress_callback(num_synced, cursor):
+            progress.append((num_synced, cursor))
+
+        # stops after the first fetch and returns the cursor to resume from
+        contact_results, resume_cursor = self.backend.pull_contacts(
+            self.nigeria, None, None, progress_callback=progress_callback, time_limit=-1
+        )
+
+        self.assertEqual(
+            contact_results,
+            {SyncOutcome.created: 2, SyncOutcome.updated: 0, SyncOutcome.deleted: 0, SyncOutcome.ignored: 0},
+        )
+        self.assertEqual(resume_cursor, "cursor-string")
+        self.assertEqual(progress, [(2, "cursor-string")])
+        self.assertEqual(set(Contact.objects.values_list("uuid", flat=True)), {"C-001", "C-002"})
+
+        active_query = MockClientQuery([remote_contact("C-003")])
+        mock_get_contacts.side_effect = [active_query, MockClientQuery([])]
+
+        with patch.object(active_query, "iterfetches", wraps=active_query.iterfetches) as mock_iterfetches:
+            contact_results, resume_cursor = self.backend.pull_contacts(
+                self.nigeria, None, None, resume_cursor="cursor-string"
+            )
+            mock_iterfetches.assert_called_once_with(retry_on_rate_exceed=True, resume_cursor="cursor-string")
+
+        self.assertEqual(contact_results[SyncOutcome.created], 1)
+        self.assertIsNone(resume_cursor)
+
     @patch("dash.orgs.models.TembaClient.get_fields")
     def test_pull_fields(self, mock_get_fields):
         ContactField.objects.all().delete()
@@ -1261,6 +1600,137 @@ class RapidProBackendTest(UreportTest):
             {SyncOutcome.created: 2, SyncOutcome.updated: 0, SyncOutcome.deleted: 2, SyncOutcome.ignored: 0},
         )
 
+    @patch("dash.orgs.models.TembaClient.get_runs")
+    @patch("django.utils.timezone.now")
+    def test_pull_results_for_polls(self, mock_timezone_now, mock_get_runs):
+        mock_timezone_now.return_value = json_date_to_datetime("2015-04-08T12:48:44.320Z")
+
+        PollResult.objects.all().delete()
+        Contact.objects.create(org=self.nigeria, uuid="C-001", gender="M", born=1990, state="R-LAGOS")
+        Contact.objects.create(org=self.nigeria, uuid="C-002", gender="F", born=1992, state="R-OYO")
+
+        polls = []
+        for i in range(4):
+            poll = self.create_poll(self.nigeria, "Flow %d" % i, "flow-%d" % i, self.education_nigeria, self.admin)
+            self.create_poll_question(self.admin, poll, "question %d" % i, "ruleset-%d" % i)
+            cache.delete(Poll.POLL_PULL_ALL_RESULTS_AFTER_DELETE_FLAG % (self.nigeria.pk, poll.pk))
+            polls.append(poll)
+
+        Poll.objects.filter(flow_uuid__in=["flow-0", "flow-1", "flow-3"]).update(has_synced=True)
+        polls = list(Poll.objects.filter(pk__in=[poll.pk for poll in polls]).order_by("pk"))
+
+        checkpoints = {
+            "flow-0": "2015-04-08T10:00:00.000Z",
+            "flow-1": "2015-04-08T11:00:00.000Z",
+            # never synced
+            "flow-2": "2015-04-08T10:00:00.000Z",
+            # too old to share the cursor
+            "flow-3": "2015-03-01T10:00:00.000Z",
+        }
+        for flow_uuid, checkpoint in checkpoints.items():
+            cache.set(Poll.POLL_RESULTS_LAST_PULL_CACHE_KEY % (self.nigeria.pk, flow_uuid), checkpoint, None)
+
+        def temba_run(uuid, flow_uuid, contact_uuid, modified_on):
+            modified_on = json_date_to_datetime(modified_on)
+            return TembaRun.create(
+                uuid=uuid,
+                flow=ObjectRef.create(uuid=flow_uuid, name="Flow"),
+                contact=ObjectRef.create(uuid=contact_uuid, name="Wiz Kid"),
+                responded=True,
+                values={
+                    "win": TembaRun.Value.create(
+                        value="Yes",
+                        input="Yes",
+                        category="Yes",
+                        node=flow_uuid.replace("flow", "ruleset"),
+                        time=modified_on,
+                    )
+                },
+                path=[],
+                created_on=modified_on,
+                modified_on=modified_on,
+                exited_on=modified_on,
+                exit_type="completed",
+            )
+
+        mock_get_runs.side_effect = [
+            MockClientQuery(
+                [
+                    temba_run(1, "flow-0", "C-001", "2015-04-08T10:30:00.000Z"),
+                    # already synced by its poll
+                    temba_run(2, "flow-1", "C-001", "2015-04-08T10:30:00.000Z"),
+                ],
+                [
+                    # not one of the polls
+                    temba_run(3, "flow-9", "C-001", "2015-04-08T11:30:00.000Z"),
+                    temba_run(4, "flow-2", "C-001", "2015-04-08T11:30:00.000Z"),
+                    temba_run(5, "flow-1", "C-002", "2015-04-08T11:30:00.000Z"),
+                ],
+            )
+        ]
+
+        polls_results = self.backend.pull_results_for_polls(self.nigeria, polls)
+
+        self.assertEqual(polls_results, {polls[0].pk: (1, 0, 0, 0, 0, 0), polls[1].pk: (1, 0, 0, 0, 0, 0)})
+        mock_get_runs.assert_called_once_with(after="2015-04-08T10:00:00.000Z", reverse=True, paths=True)
+
+        self.assertEqual(
+            set(PollResult.objects.values_list("flow", "contact", "state")),
+            {("flow-0", "C-001", "R-LAGOS"), ("flow-1", "C-002", "R-OYO")},
+        )
+
+        # the activities of the contacts of the saved results are generated for the 12 months from their answers
+        self.assertEqual(
+            set(ContactActivity.objects.filter(org=self.nigeria).values_list("contact", "date")),
+            {
+                (contact, date(2015 + (3 + i) // 12, (3 + i) % 12 + 1, 1))
+                for contact in ("C-001", "C-002")
+                for i in range(12)
+            },
+        )
+
+        # the checkpoints of the synced polls all move to the last run seen
+        for flow_uuid in ["flow-0", "flow-1"]:
+            self.assertEqual(
+                cache.get(Poll.POLL_RESULTS_LAST_PULL_CACHE_KEY % (self.nigeria.pk, flow_uuid)),
+                "2015-04-08T11:30:00.000Z",
+            )
+            self.assertEqual(
+                cache.get(Poll.POLL_RESULTS_LAST_SYNC_TIME_CACHE_KEY % (self.nigeria.pk, flow_uuid)),
+                "2015-04-08T12:48:44.320Z",
+            )
+
+        for flow_uuid in ["flow-2", "flow-3"]:
+            self.assertEqual(
+                cache.get(Poll.POLL_RESULTS_LAST_PULL_CACHE_KEY % (self.nigeria.pk, flow_uuid)), checkpoints[flow_uuid]
+            )
+
+        # nothing to sync together
+        self.assertEqual(self.backend.pull_results_for_polls(self.nigeria, polls[2:]), dict())
+        mock_get_runs.assert_called_once()
+
+        # breaking off schedules the refresh of each poll from its checkpoint, like a single poll sync
+        mock_get_runs.side_effect = [
+            MockClientQuery(
+                [temba_run(6, "flow-0", "C-002", "2015-04-08T12:00:00.000Z")],
+                [temba_run(7, "flow-1", "C-001", "2015-04-08T12:30:00.000Z")],
+            )
+        ]
+        with patch("ureport.polls.tasks.pull_refresh.apply_async") as mock_pull_refresh:
+            with patch.object(Poll, "POLL_RESULTS_MAX_SYNC_RUNS", 1):
+                polls_results = self.backend.pull_results_for_polls(self.nigeria, polls)
+
+        self.assertEqual(polls_results, {polls[0].pk: (1, 0, 0, 0, 0, 0), polls[1].pk: (0, 0, 0, 0, 0, 0)})
+        mock_pull_refresh.assert_has_calls(
+            [call((polls[0].pk,), countdown=300, queue="sync"), call((polls[1].pk,), countdown=300, queue="sync")],
+            any_order=True,
+        )
+        for flow_uuid in ["flow-0", "flow-1"]:
+            self.assertEqual(
+                cache.get(Poll.POLL_RESULTS_LAST_PULL_CACHE_KEY % (self.nigeria.pk, flow_uuid)),
+                "2015-04-08T12:00:00.000Z",
+            )
+
     @patch("redis.client.StrictRedis.lock")
     @patch("dash.orgs.models.TembaClient.get_runs")
     @patch("django.utils.timezone.now")
@@ -1300,7 +1770,7 @@ class RapidProBackendTest(UreportTest):
 
         mock_get_runs.side_effect = [MockClientQuery([temba_run])]
 
-        with self.assertNumQueries(6):
+        with self.assertNumQueries(8):
             (
                 num_val_created,
                 num_val_updated,
@@ -1368,7 +1838,7 @@ class RapidProBackendTest(UreportTest):
 
         mock_get_runs.side_effect = [MockClientQuery([temba_run_1, temba_run_2])]
 
-        with self.assertNumQueries(6):
+        with self.assertNumQueries(8):
             (
                 num_val_created,
                 num_val_updated,
@@ -1412,7 +1882,7 @@ class RapidProBackendTest(UreportTest):
 
         mock_get_runs.side_effect = [MockClientQuery([temba_run_3])]
 
-        with self.assertNumQueries(6):
+        with self.assertNumQueries(8):
             (
                 num_val_created,
                 num_val_updated,
@@ -1498,7 +1968,7 @@ class RapidProBackendTest(UreportTest):
 
         mock_get_runs.side_effect = [MockClientQuery([temba_run_4])]
 
-        with self.assertNumQueries(6):
+        with self.assertNumQueries(8):
             (
                 num_val_created,
                 num_val_updated,
@@ -1543,7 +2013,7 @@ class RapidProBackendTest(UreportTest):
 
         mock_get_runs.side_effect = [MockClientQuery([temba_run_4])]
 
-        with self.assertNumQueries(6):
+        with self.assertNumQueries(8):
             (
                 num_val_created,
                 num_val_updated,
@@ -1588,7 +2058,7 @@ class RapidProBackendTest(UreportTest):
         PollResult.objects.filter(ruleset="ruleset-uuid").update(date=None)
         mock_get_runs.side_effect = [MockClientQuery([temba_run_4])]
 
-        with self.assertNumQueries(6):
+        with self.assertNumQueries(8):
             (
                 num_val_created,
                 num_val_updated,
@@ -1697,7 +2167,7 @@ class RapidProBackendTest(UreportTest):
 
         mock_get_runs.side_effect = [MockClientQuery([temba_run_no_response])]
 
-        with self.assertNumQueries(6):
+        with self.assertNumQueries(8):
             (
                 num_val_created,
                 num_val_updated,
@@ -1760,7 +2230,7 @@ class RapidProBackendTest(UreportTest):
 
         mock_get_runs.side_effect = [MockClientQuery([temba_run])]
 
-        with self.assertNumQueries(6):
+        with self.assertNumQueries(8):
             (
                 num_val_created,
                 num_val_updated,
@@ -1855,7 +2325,7 @@ class RapidProBackendTest(UreportTest):
             )
         ]
 
-        with self.assertNumQueries(5):
+        with self.assertNumQueries(7):
             (
                 num_val_created,
                 num_val_updated,
@@ -1939,7 +2409,7 @@ class RapidProBackendTest(UreportTest):
             )
         ]
 
-        with self.assertNumQueries(5):
+        with self.assertNumQueries(7):
             (
                 num_val_created,
                 num_val_updated,
@@ -1973,6 +2443,118 @@ class RapidProBackendTest(UreportTest):
             (0, 0, 0, 0, 0, 0),
         )
 
+    @override_settings(POLL_RESULTS_ARCHIVE_WORKERS=2)
+    @patch("ureport.backend.rapidpro.ProcessPoolExecutor", ThreadPoolExecutor)
+    @patch("redis.client.StrictRedis.lock")
+    @patch("ureport.polls.models.Poll.get_flow_date")
+    @patch("dash.orgs.models.TembaClient.get_archives")
+    @patch("requests.get")
+    def test_pull_results_from_archives_parallel(
+        self, mock_request_get, mock_get_archives, mock_poll_flow_date, mock_redis_lock
+    ):
+        def gzipped_records(records):
+            stream = io.BytesIO()
+            gz = gzip.GzipFile(fileobj=stream, mode="wb")
+
+            for record in records:
+                gz.write(json.dumps(record).encode("utf-8"))
+                gz.write(b"\n")
+            gz.close()
+            stream.seek(0)
+            return MockResponse(200, stream.read())
+
+        def temba_run(uuid, contact_uuid, category, flow_uuid="flow-uuid"):
+            return TembaRun.create(
+                uuid=uuid,
+                flow=ObjectRef.create(uuid=flow_uuid, name="Flow 1"),
+                contact=ObjectRef.create(uuid=contact_uuid, name="Wiz Kid"),
+                responded=True,
+                values={
+                    "win": TembaRun.Value.create(
+                        value=category, input=category, category=category, node="ruleset-uuid", time=now
+                    )
+                },
+                path=[TembaRun.Step.create(node="ruleset-uuid", time=now)],
+                created_on=now,
+                modified_on=now,
+                exited_on=now,
+                exit_type="completed",
+            )
+
+        def archive(url, record_count=12):
+            return TembaArchive.create(
+                archive_type="run",
+                start_date=poll.created_on,
+                period="daily",
+                record_count=record_count,
+                size=23,
+                hash="f0d79988b7772c003d04a28bd7417a62",
+                download_url=url,
+            )
+
+        now = timezone.now()
+        mock_poll_flow_date.return_value = None
+
+        PollResult.objects.all().delete()
+        Contact.objects.create(
+            org=self.nigeria, uuid="C-001", gender="M", born=1990, state="R-LAGOS", district="R-OYO"
+        )
+        poll = self.create_poll(self.nigeria, "Flow 1", "flow-uuid", self.education_nigeria, self.admin)
+        self.create_poll_question(self.admin, poll, "question 1", "ruleset-uuid")
+
+        archives_content = {
+            "http://s3-bucket.aws.com/1.jsonl.gz": [
+                temba_run(1, "C-001", "Win").serialize(),
+                temba_run(2, "C-002", "Lose", flow_uuid="other-flow-uuid").serialize(),
+            ],
+            "http://s3-bucket.aws.com/3.jsonl.gz": [temba_run(3, "C-003", "Win").serialize()],
+            "http://s3-bucket.aws.com/4.jsonl.gz": [temba_run(4, "C-001", "Lose").serialize()],
+        }
+        mock_request_get.side_effect = lambda url, stream: gzipped_records(archives_content[url])
+        mock_get_archives.side_effect = [
+            MockClientQuery(
+                [
+                    archive("http://s3-bucket.aws.com/1.jsonl.gz"),
+                    archive("http://s3-bucket.aws.com/2.jsonl.gz", record_count=0),
+                    archive("http://s3-bucket.aws.com/3.jsonl.gz"),
+                ],
+                [archive("http://s3-bucket.aws.com/4.jsonl.gz")],
+            )
+        ]
+
+        decoded_paths = []
+
+        def decode(download_url, flow_uuid):
+            decoded_paths.append(decode_archive_runs(download_url, flow_uuid))
+            return decoded_paths[-1]
+
+        with patch("ureport.backend.rapidpro.decode_archive_runs", decode):
+            (
+                num_val_created,
+                num_val_updated,
+                num_val_ignored,
+                num_path_created,
+                num_path_updated,
+                num_path_ignored,
+            ) = self.backend.pull_results_from_archives(poll)
+
+        # the runs decoded by the workers are handed over in files removed once written
+        self.assertEqual(len(decoded_paths), 3)
+        self.assertFalse(any(os.path.exists(path) for path in decoded_paths))
+
+        # runs are applied in archive order, the last archive answer is not newer than the saved one
+        self.assertEqual(
+            (num_val_created, num_val_updated, num_val_ignored, num_path_created, num_path_updated, num_path_ignored),
+            (2, 0, 1, 0, 0, 3),
+        )
+        self.assertEqual(3, mock_request_get.call_count)
+        mock_redis_lock.assert_called_once_with(Poll.POLL_PULL_RESULTS_TASK_LOCK % (poll.org.pk, poll.flow_uuid))
+
+        self.assertEqual(
+            set(PollResult.objects.filter(flow="flow-uuid").values_list("contact", "category")),
+            {("C-001", "Win"), ("C-003", "Win")},
+        )
+
     @patch("dash.orgs.models.TembaClient.get_runs")
     @patch("django.utils.timezone.now")
     @patch("django.core.cache.cache.get")
@@ -2009,7 +2591,7 @@ class RapidProBackendTest(UreportTest):
 
         mock_get_runs.side_effect = [MockClientQuery([temba_run])]
 
-        with self.assertNumQueries(6):
+        with self.assertNumQueries(8):
             (
                 num_val_created,
                 num_val_updated,
@@ -2477,19 +3059,9 @@ class PerfTest(UreportTest):
 
         redis_client.set(key, "lock-taken")
 
-        (
-            num_val_created,
-            num_val_updated,
-            num_val_ignored,
-            num_path_created,
-            num_path_updated,
-            num_path_ignored,
-        ) = self.backend.pull_results(poll, None, None)
-
-        self.assertEqual(
-            (num_val_created, num_val_updated, num_val_ignored, num_path_created, num_path_updated, num_path_ignored),
-            (0, 0, 0, 0, 0, 0),
-        )
+        results = self.backend.pull_results(poll, None, None)
+        self.assertIsInstance(results, SkippedPullResults)
+        self.assertEqual(results, (0, 0, 0, 0, 0, 0))
 
         redis_client.delete(key)
 
@@ -2883,6 +3455,130 @@ class PerfTest(UreportTest):
         self.assertEqual(set(expected_args), set(self.get_mock_args_list(mock_cache_delete)))
         mock_get_runs.assert_called_once_with(flow=poll.flow_uuid, after=None, reverse=True, paths=True)
 
+    def test_initiate_lookup_maps_memory(self):
+        poll = self.create_poll(self.nigeria, "Flow 1", "flow-uuid", self.education_nigeria, self.admin)
+
+        now = timezone.now()
+        contacts, poll_results, fetch = [], [], []
+        for i in range(500):
+            contact_uuid = "C-%04d" % i
+            contacts.append(Contact(org=self.nigeria, uuid=contact_uuid, gender="M", born=1990, state="R-LAGOS"))
+            poll_results.append(
+                PollResult(
+                    org=self.nigeria,
+                    flow="flow-uuid",
+                    ruleset="ruleset-uuid",
+                    contact=contact_uuid,
+                    category="Other",
+                    text="x" * 2560,
+                    state="R-LAGOS",
+                    born=1990,
+                    gender="M",
+                    date=now,
+                    completed=True,
+                )
+            )
+            fetch.append(
+                TembaRun.create(
+                    uuid=i,
+                    flow=ObjectRef.create(uuid="flow-uuid", name="Flow 1"),
+                    contact=ObjectRef.create(uuid=contact_uuid, name="Wiz Kid"),
+                )
+            )
+        Contact.objects.bulk_create(contacts)
+        PollResult.objects.bulk_create(poll_results)
+
+        def full_lookup_maps():
+            contact_uuids = [run.contact.uuid for run in fetch]
+            contacts_map = {c.uuid: c for c in Contact.objects.filter(org=self.nigeria, uuid__in=contact_uuids)}
+            poll_results_map = defaultdict(dict)
+            for res in PollResult.objects.filter(flow="flow-uuid", org=self.nigeria.pk, contact__in=contact_uuids):
+                poll_results_map[res.contact][res.ruleset] = res
+            return contacts_map, poll_results_map
+
+        def peak_memory(build_maps):
+            tracemalloc.start()
+            try:
+                maps = build_maps()
+                return tracemalloc.get_traced_memory()[1], maps
+            finally:
+                tracemalloc.stop()
+
+        full_peak, (full_contacts_map, full_poll_results_map) = peak_memory(full_lookup_maps)
+        slim_peak, (contacts_map, poll_results_map, poll_results_to_save_map) = peak_memory(
+            lambda: self.backend._initiate_lookup_maps(fetch, self.nigeria, poll)
+        )
+
+        logger.info("Lookup maps peak memory for 500 runs: full %d bytes, slim %d bytes" % (full_peak, slim_peak))
+        self.assertLess(slim_peak * 2, full_peak)
+
+        self.assertEqual(set(contacts_map.keys()), set(full_contacts_map.keys()))
+        self.assertEqual(contacts_map["C-0001"].state, "R-LAGOS")
+        self.assertEqual(contacts_map["C-0001"].born, 1990)
+
+        result = poll_results_map["C-0001"]["ruleset-uuid"]
+        self.assertEqual(result.pk, full_poll_results_map["C-0001"]["ruleset-uuid"].pk)
+        self.assertEqual(result.text_digest, PollResultLookup.digest("x" * 2560))
+        self.assertEqual(result.date, now)
+
+        self.assertFalse(
+            RapidProBackend._check_update_required(
+                result, "Other", "x" * 2560, "R-LAGOS", None, None, 1990, "M", None, True, now
+            )
+        )
+        self.assertTrue(
+            RapidProBackend._check_update_required(
+                result, "Other", "y" * 2560, "R-LAGOS", None, None, 1990, "M", None, True, now + timedelta(seconds=1)
+            )
+        )
+
+    def test_initiate_lookup_maps_results_contacts_filter(self):
+        poll = self.create_poll(self.nigeria, "Flow 1", "flow-uuid", self.education_nigeria, self.admin)
+        Contact.objects.create(org=self.nigeria, uuid="C-001", gender="M", born=1990, state="R-LAGOS")
+        PollResult.objects.create(
+            org=self.nigeria, flow="flow-uuid", ruleset="ruleset-uuid", contact="C-001", category="Win", completed=True
+        )
+
+        def fetch_for(*contact_uuids):
+            return [
+                TembaRun.create(
+                    uuid=i,
+                    flow=ObjectRef.create(uuid="flow-uuid", name="Flow 1"),
+                    contact=ObjectRef.create(uuid=contact_uuid, name="Wiz Kid"),
+                )
+                for i, contact_uuid in enumerate(contact_uuids)
+            ]
+
+        # not worth a filter for polls with few runs
+        self.assertIsNone(self.backend._load_results_contacts_filter(self.nigeria, poll))
+
+        poll.runs_count = Poll.POLL_RESULTS_CONTACTS_FILTER_MIN_RUNS
+        with self.assertNumQueries(1):
+            results_contacts = self.backend._load_results_contacts_filter(self.nigeria, poll)
+
+        self.assertIn("C-001", results_contacts)
+        self.assertNotIn("C-002", results_contacts)
+
+        # no contact of the page can have results, only contacts are looked up
+        with self.assertNumQueries(1):
+            contacts_map, poll_results_map, poll_results_to_save_map = self.backend._initiate_lookup_maps(
+                fetch_for("C-002", "C-003"), self.nigeria, poll, results_contacts
+            )
+        self.assertEqual(poll_results_map, dict())
+
+        # only the contacts which may have results are looked up for them
+        with self.assertNumQueries(2) as queries:
+            contacts_map, poll_results_map, poll_results_to_save_map = self.backend._initiate_lookup_maps(
+                fetch_for("C-001", "C-002"), self.nigeria, poll, results_contacts
+            )
+        self.assertIn("C-001", queries.captured_queries[1]["sql"])
+        self.assertNotIn("C-002", queries.captured_queries[1]["sql"])
+        self.assertEqual(set(contacts_map.keys()), {"C-001"})
+        self.assertEqual(poll_results_map["C-001"]["ruleset-uuid"].category, "Win")
+
+        with self.assertNumQueries(2):
+            self.backend._initiate_lookup_maps(fetch_for("C-002"), self.nigeria, poll)
+
     @override_settings(DEBUG=True)
     @patch("dash.orgs.models.TembaClient._request")
     @patch("ureport.polls.tasks.pull_refresh.apply_async")
@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import gzip
+import json
+import os
+import tempfile
+import threading
+
+import requests
+from mock import patch
+from temba_client.exceptions import TembaRateExceededError
+from temba_client.v2 import TembaClient
+
+from django.test import override_settings
+
+from ureport.backend.rapidpro import RapidProBackend
+from ureport.backend.standin import StandInData, StandInServer, format_time
+from ureport.tests import UreportTest
+
+
+class StandInServerTest(UreportTest):
+    def setUp(self):
+        super(StandInServerTest, self).setUp()
+
+        self.data = StandInData(
+            contacts=300,
+            deleted_contacts=5,
+            flows=2,
+            runs_per_flow=120,
+            archived_runs_per_flow=30,
+            archive_months=3,
+            now=1700000000,
+        )
+        self.server = StandInServer(("127.0.0.1", 0), self.data, page_size=50)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+        self.client = TembaClient(self.server.url, "standin")
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        super(StandInServerTest, self).tearDown()
+
+    def test_runs(self):
+        flow_uuid = self.data.flow_uuid(1)
+
+        runs = self.client.get_runs(flow=flow_uuid, reverse=True, paths=True).all()
+        self.assertEqual(len(runs), 120)
+        self.assertEqual(len({run.uuid for run in runs}), 120)
+        self.assertEqual({run.flow.uuid for run in runs}, {flow_uuid})
+        self.assertEqual([run.modified_on for run in runs], sorted(run.modified_on for run in runs))
+        self.assertEqual(runs[0].values["question_1"].node, self.data.question_node(1, 0))
+
+        # newest first by default, and runs of all flows without a flow filter
+        runs = self.client.get_runs(after=format_time(self.data.run_time(100))).all()
+        self.assertEqual(len(runs), 40)
+        self.assertEqual(runs[0].modified_on, max(run.modified_on for run in runs))
+
+        # the same seed gives the same runs
+        self.assertEqual(StandInData(now=1700000000).run(0, 7), StandInData(now=1700000000).run(0, 7))
+
+        self.assertEqual(self.server.reset_stats()["runs"], 160)
+
+    def test_contacts(self):
+        contacts = self.client.get_contacts(before=format_time(self.data.now)).all()
+        self.assertEqual(len(contacts), 300)
+        self.assertEqual(contacts[0].fields["state"], "Standinland > State 4")
+
+        deleted_contacts = self.client.get_contacts(deleted=True).all()
+        self.assertEqual(len(deleted_contacts), 5)
+        self.assertFalse({contact.uuid for contact in deleted_contacts} & {contact.uuid for contact in contacts})
+
+    def test_flows_fields_and_boundaries(self):
+        flows = self.client.get_flows().all()
+        self.assertEqual([flow.uuid for flow in flows], [self.data.flow_uuid(0), self.data.flow_uuid(1)])
+        self.assertEqual(flows[0].results[2].node_uuids, [self.data.question_node(0, 2)])
+
+        self.assertEqual(len(self.client.get_fields().all()), 6)
+
+        boundaries = self.client.get_boundaries(geometry=True).all()
+        self.assertEqual(len(boundaries), 1 + 4 + 4 * 3)
+        self.assertEqual(boundaries[-1].parent.osm_id, "R1.4")
+
+    def test_archives(self):
+        archives = self.client.get_archives(archive_type="run", after=format_time(self.data.flows_created_on)).all()
+        self.assertEqual([archive.record_count for archive in archives], [20, 20, 20])
+
+        response = requests.get(archives[1].download_url)
+        records = [json.loads(line) for line in gzip.decompress(response.content).splitlines()]
+        self.assertEqual(len(records), 20)
+        self.assertTrue(all(record["modified_on"] < format_time(self.data.live_start) for record in records))
+
+        self.assertEqual(self.client.get_archives(archive_type="message").all(), [])
+
+    @override_settings(POLL_RESULTS_ARCHIVE_WORKERS=2)
+    def test_archives_decoded_by_workers(self):
+        backend = RapidProBackend(self.rapidpro_backend)
+        flow_uuid = self.data.flow_uuid(0)
+        archives = self.client.get_archives(archive_type="run", after=format_time(self.data.flows_created_on)).all()
+
+        def decode_archives():
+            return [
+                (archive.download_url, [run.uuid for runs in archive_runs for run in runs])
+                for archive, archive_runs in backend._iter_archives_runs([archives], flow_uuid)
+            ]
+
+        with override_settings(POLL_RESULTS_ARCHIVE_WORKERS=0):
+            decoded = decode_archives()
+
+        self.assertEqual(sum(len(uuids) for url, uuids in decoded), 30)
+
+        with tempfile.TemporaryDirectory() as tmpdir, patch("tempfile.tempdir", tmpdir):
+            self.assertEqual(decode_archives(), decoded)
+            self.assertEqual(os.listdir(tmpdir), [])
+
+            # leaving after the first archive removes the files decoded ahead, started or not
+            archives_runs = backend._iter_archives_runs([archives], flow_uuid)
+            next(archives_runs)
+            archives_runs.close()
+            self.assertEqual(os.listdir(tmpdir), [])
+
+            # as does a download failing in a worker
+            self.server.shutdown()
+            self.server.server_close()
+            with self.assertRaises(requests.ConnectionError):
+                decode_archives()
+            self.assertEqual(os.listdir(tmpdir), [])
+
+    def test_rate_limit(self):
+        self.server.rate_limit_ratio = 1.0
+        self.server.retry_after = 3
+
+        with self.assertRaises(TembaRateExceededError) as context:
+            self.client.get_flows().all()
+
+        self.assertEqual(context.exception.retry_after, 3)
+        self.assertEqual(self.server.reset_stats(), {"requests": 1, "rate_limited": 1})
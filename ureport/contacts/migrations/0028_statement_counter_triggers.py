@@ -0,0 +1,11 @@
+from django.db import migrations
+
+from ureport.sql import InstallSQL
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("contacts", "0027_install_triggers"),
+    ]
+
+    operations = [InstallSQL("contacts_0028")]
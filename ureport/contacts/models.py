@@ -3,16 +3,14 @@ from __future__ import absolute_import, division, print_function, unicode_litera
 
 import logging
 import time
-from collections import defaultdict
 
 from django_redis import get_redis_connection
 
 from django.db import connection, models
-from django.db.models import Count, Sum
+from django.db.models import Max, Sum
 from django.utils.translation import gettext_lazy as _
 
 from dash.orgs.models import Org, OrgBackend
-from ureport.utils import chunk_list
 
 CONTACT_LOCK_KEY = "lock:contact:%d:%s"
 CONTACT_FIELD_LOCK_KEY = "lock:contact-field:%d:%s"
@@ -73,6 +71,9 @@ class Contact(models.Model):
     CONTACT_LAST_FETCHED_CACHE_KEY = "last:fetch_contacts:%d:backend:%s"
     CONTACT_LAST_FETCHED_CACHE_TIMEOUT = 60 * 60 * 24 * 30
 
+    CONTACT_PULL_CHECKPOINT_CACHE_KEY = "checkpoint:fetch_contacts:%d:backend:%s"
+    CONTACT_PULL_TIME_LIMIT = 60 * 60 * 10
+
     MALE = "M"
     FEMALE = "F"
     OTHER = "O"
@@ -121,38 +122,34 @@ class Contact(models.Model):
     def lock(cls, org, uuid):
         return get_redis_connection().lock(CONTACT_LOCK_KEY % (org.pk, uuid), timeout=60)
 
+    # replaces the counters of an org by the counters generate_counters gives for each of its active contacts, with
+    # one pass on its contacts and in a single statement so readers never see a partial set of counters
+    RECALCULATE_REPORTERS_COUNTERS_SQL = """
+        WITH deleted AS (
+          DELETE FROM contacts_reporterscounter WHERE "org_id" = %(org_id)s
+        )
+        INSERT INTO contacts_reporterscounter("org_id", "type", "count")
+        SELECT %(org_id)s, t."type", COUNT(*)
+        FROM contacts_contact c
+        CROSS JOIN LATERAL ureport_contact_counter_types(
+          c."gender", c."born", c."occupation", c."registered_on", c."state", c."district", c."ward", c."scheme"
+        ) AS t("type")
+        WHERE c."org_id" = %(org_id)s AND c."is_active" = TRUE
+        GROUP BY t."type"
+        RETURNING "type", "count"
+    """
+
     @classmethod
     def recalculate_reporters_stats(cls, org):
-        ReportersCounter.objects.filter(org_id=org.id).delete()
-
-        all_contacts = Contact.objects.filter(org=org).values_list("id", flat=True).order_by("id")
         start = time.time()
-        i = 0
 
-        all_contacts = list(all_contacts)
-        all_contacts_count = len(all_contacts)
-
-        counters_dict = defaultdict(int)
-
-        for contact_id_batch in chunk_list(all_contacts, 1000):
-            contact_batch = list(contact_id_batch)
-            contacts = Contact.objects.filter(id__in=contact_batch)
-            for contact in contacts:
-                i += 1
-                gen_counters = contact.generate_counters()
-                for dict_key in gen_counters.keys():
-                    counters_dict[(org.id, dict_key)] += gen_counters[dict_key]
-
-        counters_to_insert = []
-        for counter_tuple in counters_dict.keys():
-            org_id, counter_type = counter_tuple
-            count = counters_dict[counter_tuple]
-            counters_to_insert.append(ReportersCounter(org_id=org_id, type=counter_type, count=count))
-        ReportersCounter.objects.bulk_create(counters_to_insert)
+        with connection.cursor() as c:
+            c.execute(cls.RECALCULATE_REPORTERS_COUNTERS_SQL, dict(org_id=org.id))
+            counters_dict = {(org.id, counter_type): count for counter_type, count in c.fetchall()}
 
         logger.info(
             "Finished Rebuilding the contacts reporters counters for org #%d in %ds, inserted %d counters objects for %s contacts"
-            % (org.id, time.time() - start, len(counters_to_insert), all_contacts_count)
+            % (org.id, time.time() - start, len(counters_dict), counters_dict.get((org.id, "total-reporters"), 0))
         )
 
         return counters_dict
@@ -244,6 +241,24 @@ class ReportersCounter(models.Model):
 
     count = models.IntegerField(default=0, help_text=_("Number of items with this counter"))
 
+    # collapses the rows of each (org, type) with more than one row, among the types with rows added since the last
+    # squash, into a single row holding their sum, for one org at a time
+    SQUASH_ORG_COUNTS_SQL = """
+        WITH new_types AS (
+          SELECT DISTINCT "type" FROM contacts_reporterscounter WHERE "org_id" = %(org_id)s AND "id" > %(min_id)s
+            AND "id" <= %(max_id)s
+        ), squashed_types AS (
+          SELECT c."type" FROM contacts_reporterscounter c INNER JOIN new_types t ON t."type" = c."type"
+          WHERE c."org_id" = %(org_id)s AND c."id" <= %(max_id)s GROUP BY c."type" HAVING COUNT(*) > 1
+        ), deleted AS (
+          DELETE FROM contacts_reporterscounter c USING squashed_types t
+          WHERE c."org_id" = %(org_id)s AND c."type" = t."type" AND c."id" <= %(max_id)s
+          RETURNING c."type", c."count"
+        )
+        INSERT INTO contacts_reporterscounter("org_id", "type", "count")
+        SELECT %(org_id)s, "type", GREATEST(0, SUM("count")) FROM deleted GROUP BY "type"
+    """
+
     @classmethod
     def squash_counts(cls):
         # get the id of the last count we squashed
@@ -262,44 +277,31 @@ class ReportersCounter(models.Model):
                 start = time.time()
                 squash_count = 0
 
-                if last_squash < 1:
-                    counters = (
-                        ReportersCounter.objects.values("org_id", "type")
-                        .annotate(Count("id"))
-                        .filter(id__count__gt=1)
-                        .order_by("org_id", "type")
-                    )
-
-                else:
-                    counters = (
-                        ReportersCounter.objects.filter(id__gt=last_squash)
-                        .values("org_id", "type")
-                        .order_by("org_id", "type")
-                        .distinct("org_id", "type")
-                    )
+                # counters added while we squash are left for the next squash
+                max_id = ReportersCounter.objects.aggregate(max_id=Max("id"))["max_id"]
+                if max_id is None or max_id <= last_squash:
+                    return
 
-                total_counters = len(counters)
+                org_ids = list(
+                    ReportersCounter.objects.filter(id__gt=last_squash, id__lte=max_id)
+                    .values_list("org_id", flat=True)
+                    .order_by("org_id")
+                    .distinct("org_id")
+                )
 
-                # get all the new added counters
-                for counter in counters:
-                    # perform our atomic squash in SQL by calling our squash method
+                # squash all the counters of each org with one statement
+                for i, org_id in enumerate(org_ids):
                     with connection.cursor() as c:
-                        c.execute(
-                            "SELECT ureport_squash_reporterscounters(%s, %s);", (counter["org_id"], counter["type"])
-                        )
+                        c.execute(cls.SQUASH_ORG_COUNTS_SQL, dict(org_id=org_id, min_id=last_squash, max_id=max_id))
+                        squash_count += max(c.rowcount, 0)
 
-                    squash_count += 1
-
-                    if squash_count % 100 == 0:
-                        logger.info(
-                            "Squashing progress ... %0.2f/100 in in %0.3fs"
-                            % (squash_count * 100 / total_counters, time.time() - start)
-                        )
+                    logger.info(
+                        "Squashing progress ... %0.2f/100 in in %0.3fs"
+                        % ((i + 1) * 100 / len(org_ids), time.time() - start)
+                    )
 
                 # insert our new top squashed id
-                max_id = ReportersCounter.objects.all().order_by("-id").first()
-                if max_id:
-                    r.set(ReportersCounter.LAST_SQUASHED_ID_KEY, max_id.id)
+                r.set(ReportersCounter.LAST_SQUASHED_ID_KEY, max_id)
 
                 logger.info(
                     "Squashed poll results counts for %d types in %0.3fs" % (squash_count, time.time() - start)
@@ -6,7 +6,10 @@ import time
 from celery.utils.log import get_task_logger
 from django_redis import get_redis_connection
 
+from django.conf import settings
 from django.core.cache import cache
+from django.db import connection
+from django.db.models import Max
 from django.utils import timezone
 
 from dash.orgs.models import Org, TaskState
@@ -14,11 +17,12 @@ from dash.orgs.tasks import org_task
 from dash.utils.sync import SyncOutcome
 from ureport.celery import app
 from ureport.contacts.models import Contact, ReportersCounter
-from ureport.stats.models import ContactActivity
-from ureport.utils import chunk_list, datetime_to_json_date, update_cache_org_contact_counts
+from ureport.utils import datetime_to_json_date, update_cache_org_contact_counts
 
 logger = get_task_logger(__name__)
 
+CONTACT_COUNTS_CHECK_STATE_KEY = "contact_counts_check_state"
+
 
 @app.task(name="contacts.rebuild_contacts_counts")
 def rebuild_contacts_counts():
@@ -35,13 +39,39 @@ def check_contacts_count_mismatch():
     r = get_redis_connection()
     orgs = Org.objects.filter(is_active=True).order_by("pk")
 
+    full_check_interval = getattr(settings, "CONTACT_COUNTS_FULL_CHECK_INTERVAL", 60 * 60 * 24)
+    check_states = cache.get(CONTACT_COUNTS_CHECK_STATE_KEY, None) or dict()
+
+    # contacts ids only grow, so the contacts above the last checked id are the new ones of every org
+    last_contact_id = Contact.objects.aggregate(Max("id"))["id__max"] or 0
+
     error_counts = dict()
     mismatch_counts = dict()
 
     for org in orgs:
         key = TaskState.get_lock_key(org, "contact-pull")
-        db_contacts_counts = Contact.objects.filter(org=org, is_active=True).count()
-        counter_counts = ReportersCounter.get_counts(org).get("total-reporters", 0)
+        counter_counts = ReportersCounter.get_counts(org, ["total-reporters"]).get("total-reporters", 0)
+
+        # between the daily exact counts, a consistent org stays consistent when the counters only grew by its new
+        # active contacts, otherwise we count all its contacts again. Changes to the existing contacts are not
+        # checked, so a deactivation that failed to decrement the counters can go unnoticed for up to
+        # CONTACT_COUNTS_FULL_CHECK_INTERVAL, until the next exact count
+        check_state = check_states.get(org.id)
+        db_contacts_counts = None
+        if check_state and check_state["db"] == check_state["count"]:
+            if time.time() - check_state["checked_on"] < full_check_interval:
+                new_contacts_counts = Contact.objects.filter(
+                    org=org, is_active=True, id__gt=check_state["contact_id"], id__lte=last_contact_id
+                ).count()
+                if counter_counts - check_state["count"] == new_contacts_counts:
+                    db_contacts_counts = check_state["db"] + new_contacts_counts
+                    check_state = dict(check_state, contact_id=last_contact_id, db=db_contacts_counts)
+
+        if db_contacts_counts is None:
+            db_contacts_counts = Contact.objects.filter(org=org, is_active=True).count()
+            check_state = dict(contact_id=last_contact_id, db=db_contacts_counts, checked_on=time.time())
+
+        check_states[org.id] = dict(check_state, count=counter_counts)
 
         count_diff = abs(db_contacts_counts - counter_counts)
         pct_diff = 0
@@ -69,6 +99,7 @@ def check_contacts_count_mismatch():
 
     output = dict(mismatch_counts=mismatch_counts, error_counts=error_counts)
     cache.set("contact_counts_status", output, None)
+    cache.set(CONTACT_COUNTS_CHECK_STATE_KEY, check_states, None)
 
 
 @org_task("update-org-contact-counts", 60 * 20)
@@ -90,13 +121,39 @@ def pull_contacts(org, ignored_since, ignored_until):
         backend = org.get_backend(backend_slug=backend_obj.slug)
 
         last_fetch_date_key = Contact.CONTACT_LAST_FETCHED_CACHE_KEY % (org.pk, backend_obj.slug)
+        checkpoint_key = Contact.CONTACT_PULL_CHECKPOINT_CACHE_KEY % (org.pk, backend_obj.slug)
+
+        # a previous run that didn't finish its time window left a checkpoint to resume from
+        checkpoint = cache.get(checkpoint_key, None)
+        if checkpoint:
+            since = checkpoint["since"]
+            until = checkpoint["until"]
+            resume_cursor = checkpoint["cursor"]
+            num_synced_before = checkpoint["num_synced"]
 
-        until = datetime_to_json_date(timezone.now())
-        since = cache.get(last_fetch_date_key, None)
+            logger.info(
+                "Resuming contacts pull for org #%d after %d contacts, time window %s - %s"
+                % (org.pk, num_synced_before, since, until)
+            )
+        else:
+            until = datetime_to_json_date(timezone.now())
+            since = cache.get(last_fetch_date_key, None)
+            resume_cursor = None
+            num_synced_before = 0
 
         if not since:
             logger.info("First time run for org #%d. Will sync all contacts" % org.pk)
 
+        def save_checkpoint(num_synced, cursor=None):
+            if not cursor:
+                return
+
+            cache.set(
+                checkpoint_key,
+                dict(since=since, until=until, cursor=cursor, num_synced=num_synced_before + num_synced),
+                Contact.CONTACT_LAST_FETCHED_CACHE_TIMEOUT,
+            )
+
         start = time.time()
 
         backend_fields_results = backend.pull_fields(org)
@@ -131,14 +188,26 @@ def pull_contacts(org, ignored_since, ignored_until):
         logger.info("Fetch boundaries for org #%d took %ss" % (org.pk, time.time() - start_boundaries))
         start_contacts = time.time()
 
-        backend_contact_results, resume_cursor = backend.pull_contacts(org, since, until)
+        backend_contact_results, resume_cursor = backend.pull_contacts(
+            org,
+            since,
+            until,
+            progress_callback=save_checkpoint,
+            resume_cursor=resume_cursor,
+            time_limit=Contact.CONTACT_PULL_TIME_LIMIT,
+        )
 
         contacts_created = backend_contact_results[SyncOutcome.created]
         contacts_updated = backend_contact_results[SyncOutcome.updated]
         contacts_deleted = backend_contact_results[SyncOutcome.deleted]
         ignored = backend_contact_results[SyncOutcome.ignored]
 
-        cache.set(last_fetch_date_key, until, None)
+        if resume_cursor:
+            # only move the time window forward once it has been fully pulled
+            logger.info("Contacts pull for org #%d reached its time limit, will resume on next run" % org.pk)
+        else:
+            cache.set(last_fetch_date_key, until, None)
+            cache.delete(checkpoint_key)
 
         logger.info(
             "Fetched contacts for org #%d. "
@@ -266,6 +335,57 @@ def populate_contact_schemes(org, since, until):
     populate_contact_activities_schemes.apply_async((org.id,), queue="slow")
 
 
+# copies the schemes of a range of the active contacts of an org to the rows of a table referencing them by uuid,
+# skipping the rows already having the scheme of their contact
+POPULATE_SCHEMES_SQL = """
+    UPDATE {table} t SET "scheme" = c."scheme"
+    FROM contacts_contact c
+    WHERE c."org_id" = %(org_id)s AND c."is_active" = TRUE AND c."id" > %(min_id)s AND c."id" <= %(max_id)s
+      AND c."scheme" IS NOT NULL AND c."scheme" != ''
+      AND t."org_id" = c."org_id" AND t."contact" = c."uuid" AND t."scheme" IS DISTINCT FROM c."scheme"
+"""
+
+POPULATE_SCHEMES_BATCH_SIZE = 5000
+
+
+def populate_schemes_from_contacts(org_id, table, max_id_key, name):
+    """
+    Populates the schemes of the rows of the given table from the contacts of the org, with one UPDATE per batch of
+    contacts ids and the last contact id of each batch checkpointed so an interrupted run resumes after it
+    """
+    max_id = cache.get(max_id_key, 0)
+    update_sql = POPULATE_SCHEMES_SQL.format(table=table)
+
+    start_time = time.time()
+    contacts_count = 0
+    updated_count = 0
+
+    while True:
+        batch_ids = list(
+            Contact.objects.filter(org_id=org_id, id__gt=max_id)
+            .order_by("id")
+            .values_list("id", flat=True)[:POPULATE_SCHEMES_BATCH_SIZE]
+        )
+        if not batch_ids:
+            break
+
+        with connection.cursor() as cursor:
+            cursor.execute(update_sql, dict(org_id=org_id, min_id=max_id, max_id=batch_ids[-1]))
+            updated_count += cursor.rowcount
+
+        max_id = batch_ids[-1]
+        cache.set(max_id_key, max_id, None)
+        contacts_count += len(batch_ids)
+
+        elapsed = time.time() - start_time
+        logger.info(
+            f"Populating schemes on {name} batch {contacts_count} for org #{org_id}, "
+            f"updated {updated_count} rows in {elapsed:.1f} seconds"
+        )
+
+    return updated_count
+
+
 @app.task(name="contacts.populate_contact_activities_schemes")
 def populate_contact_activities_schemes(org_id):
     contact_activities_schemes_populated_key = f"contact_activities_schemes_populated:{org_id}"
@@ -276,33 +396,13 @@ def populate_contact_activities_schemes(org_id):
         return
 
     contact_activities_schemes_max_id_key = f"contact_activities_schemes_max_id:{org_id}"
-    max_id = cache.get(contact_activities_schemes_max_id_key, 0)
 
     start_time = time.time()
     logger.info(f"started populating schemes on contacts activities for org #{org_id}")
-    contact_ids = (
-        Contact.objects.filter(org_id=org_id, is_active=True, id__gt=max_id)
-        .exclude(scheme=None)
-        .exclude(scheme="")
-        .order_by("id")
-        .values_list("id", flat=True)
-    )
-
-    contacts_count = 0
-
-    for batch in chunk_list(contact_ids, 1000):
-        batch_ids = list(batch)
-        contacts = Contact.objects.filter(id__in=batch_ids)
-        for contact in contacts:
-            ContactActivity.objects.filter(org_id=contact.org_id, contact=contact.uuid).update(scheme=contact.scheme)
-            cache.set(contact_activities_schemes_max_id_key, contact.id, None)
 
-        contacts_count += len(batch_ids)
-
-        elapsed = time.time() - start_time
-        logger.info(
-            f"Populating schemes on contacts activities batch {contacts_count} for org #{org_id} in {elapsed:.1f} seconds"
-        )
+    populate_schemes_from_contacts(
+        org_id, "stats_contactactivity", contact_activities_schemes_max_id_key, "contacts activities"
+    )
 
     elapsed = time.time() - start_time
     logger.info(f"Finished populating schemes on contacts activities for org #{org_id} in {elapsed:.1f} seconds")
@@ -312,8 +412,6 @@ def populate_contact_activities_schemes(org_id):
 
 @app.task(name="contacts.populate_poll_results_schemes")
 def populate_poll_results_schemes(org_id):
-    from ureport.polls.models import PollResult
-
     poll_results_schemes_populated_key = f"poll_results_schemes_populated:{org_id}"
 
     if cache.get(poll_results_schemes_populated_key):
@@ -321,33 +419,11 @@ def populate_poll_results_schemes(org_id):
         return
 
     poll_results_schemes_max_id_key = f"poll_results_schemes_max_id:{org_id}"
-    max_id = cache.get(poll_results_schemes_max_id_key, 0)
 
     start_time = time.time()
     logger.info(f"started populating schemes on poll results for org #{org_id}")
-    contact_ids = (
-        Contact.objects.filter(org_id=org_id, is_active=True, id__gt=max_id)
-        .exclude(scheme=None)
-        .exclude(scheme="")
-        .order_by("id")
-        .values_list("id", flat=True)
-    )
-
-    contacts_count = 0
 
-    for batch in chunk_list(contact_ids, 1000):
-        batch_ids = list(batch)
-        contacts = Contact.objects.filter(id__in=batch_ids)
-        for contact in contacts:
-            PollResult.objects.filter(contact=contact.uuid).update(scheme=contact.scheme)
-            cache.set(poll_results_schemes_max_id_key, contact.id, None)
-
-        contacts_count += len(batch_ids)
-
-        elapsed = time.time() - start_time
-        logger.info(
-            f"Populating schemes on poll results batch {contacts_count} for org #{org_id} in {elapsed:.1f} seconds"
-        )
+    populate_schemes_from_contacts(org_id, "polls_pollresult", poll_results_schemes_max_id_key, "poll results")
 
     elapsed = time.time() - start_time
     logger.info(f"Finished populating schemes on poll results for org #{org_id} in {elapsed:.1f} seconds")
@@ -1,13 +1,27 @@
 # -*- coding: utf-8 -*-
 from __future__ import absolute_import, division, print_function, unicode_literals
 
+from collections import defaultdict
+from datetime import date
+
 from mock import patch
 
+from django.core.cache import cache
+
 from dash.orgs.models import TaskState
 from dash.utils.sync import SyncOutcome
 from ureport.contacts.models import Contact, ContactField, ReportersCounter
-from ureport.contacts.tasks import check_contacts_count_mismatch, pull_contacts, update_org_contact_count
+from ureport.contacts.tasks import (
+    CONTACT_COUNTS_CHECK_STATE_KEY,
+    check_contacts_count_mismatch,
+    populate_contact_activities_schemes,
+    populate_poll_results_schemes,
+    pull_contacts,
+    update_org_contact_count,
+)
 from ureport.locations.models import Boundary
+from ureport.polls.models import PollResult
+from ureport.stats.models import ContactActivity
 from ureport.tests import TestBackend, UreportTest
 from ureport.utils import json_date_to_datetime
 
@@ -228,6 +242,34 @@ class ContactTest(UreportTest):
 
         self.assertEqual(ReportersCounter.get_counts(self.nigeria), expected)
 
+        # counters match the ones generated for each contact, including contacts with blank or missing fields
+        Contact.objects.create(uuid="C-010", org=self.nigeria, gender="", born=0, occupation="", state="", scheme="")
+        Contact.objects.create(
+            uuid="C-011",
+            org=self.nigeria,
+            gender="F",
+            registered_on=json_date_to_datetime("2014-01-03T23:59:05.000"),
+            ward="R-IKEJA",
+            scheme="WhatsApp",
+        )
+        Contact.objects.create(uuid="C-012", org=self.uganda, gender="F", born=2000)
+
+        expected = defaultdict(int)
+        for contact in Contact.objects.filter(org=self.nigeria):
+            for counter_type, count in contact.generate_counters().items():
+                expected[counter_type] += count
+
+        ReportersCounter.objects.filter(org=self.nigeria).update(count=0)
+        uganda_counts = ReportersCounter.get_counts(self.uganda)
+
+        counters = Contact.recalculate_reporters_stats(self.nigeria)
+
+        self.assertEqual(ReportersCounter.get_counts(self.nigeria), expected)
+        self.assertEqual(
+            counters, {(self.nigeria.id, counter_type): count for counter_type, count in expected.items()}
+        )
+        self.assertEqual(ReportersCounter.get_counts(self.uganda), uganda_counts)
+
     def test_reporters_counter(self):
         self.assertEqual(ReportersCounter.get_counts(self.nigeria), dict())
         Contact.objects.create(
@@ -296,6 +338,40 @@ class ContactTest(UreportTest):
             {"total-reporters": 2, "gender:m": 2},
         )
 
+        # the counters are updated once per statement with one row per counter type changed
+        counters_count = ReportersCounter.objects.filter(org=self.nigeria).count()
+        Contact.objects.bulk_create(
+            [
+                Contact(uuid="C-1%02d" % i, org=self.nigeria, gender="F", state="R-LAGOS", scheme="tel")
+                for i in range(10)
+            ]
+        )
+        self.assertEqual(ReportersCounter.objects.filter(org=self.nigeria).count(), counters_count + 4)
+
+        counts = ReportersCounter.get_counts(self.nigeria)
+        self.assertEqual(counts["total-reporters"], 12)
+        self.assertEqual(counts["gender:f"], 10)
+        self.assertEqual(counts["state:R-LAGOS"], 12)
+        self.assertEqual(counts["scheme:tel"], 11)
+
+        counters_count = ReportersCounter.objects.filter(org=self.nigeria).count()
+        Contact.objects.filter(org=self.nigeria, gender="F").update(gender="M", state="")
+        Contact.objects.filter(org=self.nigeria, uuid="C-100").update(is_active=False)
+        self.assertEqual(ReportersCounter.objects.filter(org=self.nigeria).count(), counters_count + 3 + 3)
+
+        counts = ReportersCounter.get_counts(self.nigeria)
+        self.assertEqual(counts["total-reporters"], 11)
+        self.assertEqual(counts["gender:f"], 0)
+        self.assertEqual(counts["gender:m"], 11)
+        self.assertEqual(counts["state:R-LAGOS"], 2)
+        self.assertEqual(counts["scheme:tel"], 10)
+
+        Contact.objects.filter(org=self.nigeria, uuid__startswith="C-1").delete()
+        self.assertEqual(
+            ReportersCounter.get_counts(self.nigeria, ["total-reporters", "gender:m", "scheme:tel"]),
+            {"total-reporters": 2, "gender:m": 2, "scheme:tel": 1},
+        )
+
     @patch("redis.client.StrictRedis.get")
     def test_squash_reporters(self, mock_redis_get):
         mock_redis_get.return_value = None
@@ -322,10 +398,24 @@ class ContactTest(UreportTest):
 
         self.assertTrue(counter_type_a.count, 5)
 
+        # the counters of all orgs are squashed, keeping the counts of each org apart
+        ReportersCounter.objects.create(org=self.nigeria, type="type-a", count=-1)
+        ReportersCounter.objects.create(org=self.nigeria, type="type-b", count=-4)
+        ReportersCounter.objects.create(org=self.uganda, type="type-a", count=7)
+        ReportersCounter.objects.create(org=self.uganda, type="type-a", count=1)
+
+        ReportersCounter.squash_counts()
+
+        self.assertEqual(ReportersCounter.objects.filter(org=self.nigeria).count(), 2)
+        self.assertEqual(ReportersCounter.objects.filter(org=self.uganda).count(), 1)
+        self.assertEqual(ReportersCounter.get_counts(self.nigeria), {"type-a": 4, "type-b": 0})
+        self.assertEqual(ReportersCounter.get_counts(self.uganda), {"type-a": 8})
+
 
 class ContactsTasksTest(UreportTest):
     def setUp(self):
         super(ContactsTasksTest, self).setUp()
+        cache.delete(CONTACT_COUNTS_CHECK_STATE_KEY)
 
     @patch("redis.client.StrictRedis.get")
     @patch("django.core.cache.cache.set")
@@ -341,7 +431,7 @@ class ContactsTasksTest(UreportTest):
 
         check_contacts_count_mismatch()
 
-        mock_cache_set.assert_called_once_with(
+        mock_cache_set.assert_any_call(
             "contact_counts_status",
             {
                 "mismatch_counts": {
@@ -361,17 +451,16 @@ class ContactsTasksTest(UreportTest):
 
         check_contacts_count_mismatch()
 
-        mock_cache_set.assert_called_once_with(
-            "contact_counts_status", {"mismatch_counts": {}, "error_counts": {}}, None
-        )
+        mock_cache_set.assert_any_call("contact_counts_status", {"mismatch_counts": {}, "error_counts": {}}, None)
 
-        mock_redis_get.side_effect = ["foo_locked_task_running", None]
+        # the first GET reads the check states, then one per org for its contact pull lock
+        mock_redis_get.side_effect = [None, "foo_locked_task_running", None]
         mock_cache_set.reset_mock()
         mock_counter_counts.side_effect = [{"total-reporters": 1000}, {"total-reporters": 1000}]
 
         check_contacts_count_mismatch()
 
-        mock_cache_set.assert_called_once_with(
+        mock_cache_set.assert_any_call(
             "contact_counts_status",
             {
                 "mismatch_counts": {
@@ -391,6 +480,108 @@ class ContactsTasksTest(UreportTest):
             None,
         )
 
+    def test_check_contacts_count_mismatch_incremental(self):
+        for i in range(5):
+            Contact.objects.create(org=self.nigeria, uuid=f"C-00{i}", gender="M", born=1990, state="R-LAGOS")
+
+        check_contacts_count_mismatch()
+
+        self.assertEqual(cache.get("contact_counts_status"), {"mismatch_counts": {}, "error_counts": {}})
+        full_check_state = cache.get(CONTACT_COUNTS_CHECK_STATE_KEY)[self.nigeria.id]
+        self.assertEqual((full_check_state["db"], full_check_state["count"]), (5, 5))
+
+        for i in range(5, 8):
+            Contact.objects.create(org=self.nigeria, uuid=f"C-00{i}", gender="M", born=1990, state="R-LAGOS")
+
+        check_contacts_count_mismatch()
+
+        # only the new contacts were counted
+        check_state = cache.get(CONTACT_COUNTS_CHECK_STATE_KEY)[self.nigeria.id]
+        self.assertEqual((check_state["db"], check_state["count"]), (8, 8))
+        self.assertEqual(check_state["checked_on"], full_check_state["checked_on"])
+        self.assertEqual(check_state["contact_id"], Contact.objects.order_by("-id").first().id)
+        self.assertEqual(cache.get("contact_counts_status"), {"mismatch_counts": {}, "error_counts": {}})
+
+        # counters not matching the new contacts fail the check of the new contacts, so all contacts are counted
+        ReportersCounter.objects.create(org=self.nigeria, type="total-reporters", count=-2)
+        Contact.objects.create(org=self.nigeria, uuid="C-008", gender="M", born=1990, state="R-LAGOS")
+
+        check_contacts_count_mismatch()
+
+        check_state = cache.get(CONTACT_COUNTS_CHECK_STATE_KEY)[self.nigeria.id]
+        self.assertEqual((check_state["db"], check_state["count"]), (9, 7))
+        self.assertNotEqual(check_state["checked_on"], full_check_state["checked_on"])
+        self.assertEqual(
+            cache.get("contact_counts_status")["mismatch_counts"],
+            {f"{self.nigeria.pk}": {"db": 9, "count": 7, "count_diff": 2, "pct_diff": 2 / 9}},
+        )
+
+        # an org is counted again on the daily check even when consistent
+        ReportersCounter.objects.create(org=self.nigeria, type="total-reporters", count=2)
+        check_contacts_count_mismatch()
+        full_check_state = cache.get(CONTACT_COUNTS_CHECK_STATE_KEY)[self.nigeria.id]
+
+        with self.settings(CONTACT_COUNTS_FULL_CHECK_INTERVAL=0):
+            check_contacts_count_mismatch()
+
+        check_state = cache.get(CONTACT_COUNTS_CHECK_STATE_KEY)[self.nigeria.id]
+        self.assertEqual((check_state["db"], check_state["count"]), (9, 9))
+        self.assertNotEqual(check_state["checked_on"], full_check_state["checked_on"])
+
+    @patch("ureport.contacts.tasks.POPULATE_SCHEMES_BATCH_SIZE", 2)
+    @patch("ureport.contacts.tasks.populate_poll_results_schemes.apply_async")
+    def test_populate_schemes(self, mock_populate_poll_results_schemes):
+        for key in ("contact_activities_schemes", "poll_results_schemes"):
+            cache.delete(f"{key}_populated:{self.nigeria.id}")
+            cache.delete(f"{key}_max_id:{self.nigeria.id}")
+
+        Contact.objects.create(org=self.nigeria, uuid="C-001", scheme="tel")
+        Contact.objects.create(org=self.nigeria, uuid="C-002", scheme="")
+        Contact.objects.create(org=self.nigeria, uuid="C-003", scheme="facebook", is_active=False)
+        Contact.objects.create(org=self.uganda, uuid="C-004", scheme="whatsapp")
+        last_contact = Contact.objects.create(org=self.nigeria, uuid="C-005", scheme="facebook")
+
+        for org, uuid in (
+            (self.nigeria, "C-001"),
+            (self.nigeria, "C-002"),
+            (self.nigeria, "C-003"),
+            (self.nigeria, "C-004"),
+            (self.uganda, "C-004"),
+            (self.nigeria, "C-005"),
+        ):
+            ContactActivity.objects.create(org=org, contact=uuid, date=date(2023, 1, 1))
+            ContactActivity.objects.create(org=org, contact=uuid, date=date(2023, 2, 1))
+            PollResult.objects.create(org=org, flow="flow-uuid", ruleset="ruleset-uuid", contact=uuid, completed=True)
+
+        populate_contact_activities_schemes(self.nigeria.id)
+
+        self.assertEqual(
+            set(ContactActivity.objects.exclude(scheme=None).values_list("org_id", "contact", "scheme")),
+            {(self.nigeria.id, "C-001", "tel"), (self.nigeria.id, "C-005", "facebook")},
+        )
+        self.assertEqual(ContactActivity.objects.exclude(scheme=None).count(), 4)
+        self.assertEqual(cache.get(f"contact_activities_schemes_max_id:{self.nigeria.id}"), last_contact.id)
+        self.assertTrue(cache.get(f"contact_activities_schemes_populated:{self.nigeria.id}"))
+        mock_populate_poll_results_schemes.assert_called_once_with((self.nigeria.id,), queue="slow")
+
+        # poll results of other orgs for the same contacts uuids are left alone
+        populate_poll_results_schemes(self.nigeria.id)
+
+        self.assertEqual(
+            set(PollResult.objects.exclude(scheme=None).values_list("org_id", "contact", "scheme")),
+            {(self.nigeria.id, "C-001", "tel"), (self.nigeria.id, "C-005", "facebook")},
+        )
+        self.assertEqual(cache.get(f"poll_results_schemes_max_id:{self.nigeria.id}"), last_contact.id)
+
+        # resumes after the checkpoint, and skips when populated
+        Contact.objects.filter(uuid="C-001").update(scheme="whatsapp")
+        cache.delete(f"poll_results_schemes_populated:{self.nigeria.id}")
+        populate_poll_results_schemes(self.nigeria.id)
+        self.assertTrue(PollResult.objects.filter(contact="C-001", scheme="tel"))
+
+        populate_contact_activities_schemes(self.nigeria.id)
+        self.assertTrue(ContactActivity.objects.filter(contact="C-001", scheme="tel"))
+
     @patch("ureport.contacts.tasks.update_cache_org_contact_counts")
     def test_update_org_contact_count(self, mock_update_cache_org_contact_counts):
         mock_update_cache_org_contact_counts.return_value = "Called"
@@ -444,3 +635,62 @@ class ContactsTasksTest(UreportTest):
         )
 
         # mock_squash_counts.assert_called_once_with()
+
+        self.assertEqual(mock_pull_contacts.call_args[1]["resume_cursor"], None)
+        self.assertEqual(mock_pull_contacts.call_args[1]["time_limit"], Contact.CONTACT_PULL_TIME_LIMIT)
+
+    @patch("dash.orgs.models.Org.get_backend")
+    @patch("ureport.tests.TestBackend.pull_fields")
+    @patch("ureport.tests.TestBackend.pull_boundaries")
+    @patch("ureport.tests.TestBackend.pull_contacts")
+    def test_pull_contacts_resume(self, mock_pull_contacts, mock_pull_boundaries, mock_pull_fields, mock_get_backend):
+        mock_get_backend.return_value = TestBackend(self.rapidpro_backend)
+        mock_pull_fields.return_value = {outcome: 0 for outcome in SyncOutcome}
+        mock_pull_boundaries.return_value = {outcome: 0 for outcome in SyncOutcome}
+
+        self.nigeria.backends.exclude(slug="rapidpro").delete()
+
+        last_fetch_date_key = Contact.CONTACT_LAST_FETCHED_CACHE_KEY % (self.nigeria.pk, "rapidpro")
+        checkpoint_key = Contact.CONTACT_PULL_CHECKPOINT_CACHE_KEY % (self.nigeria.pk, "rapidpro")
+        cache.delete(last_fetch_date_key)
+        cache.delete(checkpoint_key)
+
+        def interrupted_pull(org, since, until, progress_callback=None, resume_cursor=None, time_limit=None):
+            self.assertIsNone(since)
+            self.assertIsNone(resume_cursor)
+
+            progress_callback(250, "cursor-1")
+            progress_callback(500, "cursor-2")
+            return {outcome: 0 for outcome in SyncOutcome}, "cursor-2"
+
+        mock_pull_contacts.side_effect = interrupted_pull
+
+        pull_contacts(self.nigeria.pk)
+
+        # time window not finished so it isn't moved forward
+        self.assertIsNone(cache.get(last_fetch_date_key))
+
+        checkpoint = cache.get(checkpoint_key)
+        self.assertIsNone(checkpoint["since"])
+        self.assertTrue(checkpoint["until"])
+        self.assertEqual(checkpoint["cursor"], "cursor-2")
+        self.assertEqual(checkpoint["num_synced"], 500)
+
+        def resumed_pull(org, since, until, progress_callback=None, resume_cursor=None, time_limit=None):
+            self.assertIsNone(since)
+            self.assertEqual(until, checkpoint["until"])
+            self.assertEqual(resume_cursor, "cursor-2")
+
+            progress_callback(250, "cursor-3")
+            self.assertEqual(cache.get(checkpoint_key)["num_synced"], 750)
+
+            # deleted contacts fetches don't move the cursor
+            progress_callback(260, None)
+            return {outcome: 0 for outcome in SyncOutcome}, None
+
+        mock_pull_contacts.side_effect = resumed_pull
+
+        pull_contacts(self.nigeria.pk)
+
+        self.assertEqual(cache.get(last_fetch_date_key), checkpoint["until"])
+        self.assertIsNone(cache.get(checkpoint_key))
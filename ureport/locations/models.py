@@ -2,9 +2,11 @@
 from __future__ import absolute_import, division, print_function, unicode_literals
 
 import json
+import uuid
 
 from django_redis import get_redis_connection
 
+from django.core.cache import cache
 from django.db import models
 from django.utils.translation import gettext_lazy as _
 
@@ -26,6 +28,10 @@ class Boundary(models.Model):
     BOUNDARIES_CACHE_TIMEOUT = 60 * 60 * 24 * 15
     BOUNDARIES_CACHE_KEY = "org:%d:boundaries-osm-ids"
 
+    BOUNDARIES_VERSION_CACHE_KEY = "org:%d:boundaries-version"
+    BOUNDARIES_NAMES_LOOKUP_CACHE_KEY = "org:%d:backend:%s:boundaries-names-lookup:%s"
+    BOUNDARIES_NAMES_LOOKUP_CACHE_TIMEOUT = 60 * 60 * 24
+
     org = models.ForeignKey(Org, on_delete=models.PROTECT, verbose_name=_("Organization"), related_name="boundaries")
 
     is_active = models.BooleanField(default=True)
@@ -88,6 +94,63 @@ class Boundary(models.Model):
 
         return boundaries
 
+    @classmethod
+    def update_version(cls, org):
+        """
+        Marks the boundaries of the org as changed, invalidating the cached names lookups
+        """
+        cache.set(cls.BOUNDARIES_VERSION_CACHE_KEY % org.pk, uuid.uuid4().hex, None)
+
+    @classmethod
+    def get_names_lookup(cls, org, backend=None):
+        """
+        Returns the maps used to find boundaries from contact field values, as a tuple of state names to state
+        osm ids, state osm ids to district names to district osm ids, and district osm ids to ward names to
+        ward osm ids. Built with a single query and cached until the next boundaries sync changes the version,
+        orgs without a synced version yet are always looked up.
+        """
+        version = cache.get(cls.BOUNDARIES_VERSION_CACHE_KEY % org.pk, None)
+        key = None
+        if version is not None:
+            key = cls.BOUNDARIES_NAMES_LOOKUP_CACHE_KEY % (org.pk, backend.slug if backend else "*", version)
+            cached = cache.get(key, None)
+            if cached is not None:
+                return cached
+
+        boundaries = cls.objects.filter(
+            org=org, level__in=[cls.STATE_LEVEL, cls.DISTRICT_LEVEL, cls.WARD_LEVEL]
+        ).order_by("level", "id")
+        if backend:
+            boundaries = boundaries.filter(backend=backend)
+
+        state_names = dict()
+        district_names = dict()
+        ward_names = dict()
+        osm_ids = dict()
+        for boundary_id, osm_id, name, level, parent_id in boundaries.values_list(
+            "id", "osm_id", "name", "level", "parent_id"
+        ):
+            if level == cls.STATE_LEVEL:
+                state_names[name.lower()] = osm_id
+                district_names[osm_id] = dict()
+                osm_ids[boundary_id] = osm_id
+            else:
+                # only keep boundaries under a parent of the level above
+                parent_names = district_names if level == cls.DISTRICT_LEVEL else ward_names
+                parent_osm_id = osm_ids.get(parent_id)
+                if parent_osm_id is None or parent_osm_id not in parent_names:
+                    continue
+
+                parent_names[parent_osm_id][name.lower()] = osm_id
+                if level == cls.DISTRICT_LEVEL:
+                    ward_names[osm_id] = dict()
+                    osm_ids[boundary_id] = osm_id
+
+        lookup = (state_names, district_names, ward_names)
+        if key:
+            cache.set(key, lookup, cls.BOUNDARIES_NAMES_LOOKUP_CACHE_TIMEOUT)
+        return lookup
+
     def as_geojson(self):
         return dict(
             type="Feature",
@@ -5,6 +5,7 @@ import json
 
 from mock import Mock, patch
 
+from django.core.cache import cache
 from django.urls import reverse
 
 from ureport.tests import UreportTest
@@ -112,3 +113,69 @@ class LocationTest(UreportTest):
             self.assertEqual(faroe.level, 0)
             self.assertEqual(faroe.geometry.type, "Polygon")
             self.assertEqual(faroe.geometry.coordinates, [[[5, 6], [7, 8]]])
+
+    def test_get_names_lookup(self):
+        cache.delete(Boundary.BOUNDARIES_VERSION_CACHE_KEY % self.nigeria.pk)
+
+        country = Boundary.objects.create(
+            org=self.nigeria, osm_id="R-NIGERIA", name="Nigeria", level=Boundary.COUNTRY_LEVEL, geometry="{}"
+        )
+        lagos = Boundary.objects.create(
+            org=self.nigeria, osm_id="R-LAGOS", name="Lagos", level=Boundary.STATE_LEVEL, parent=country, geometry="{}"
+        )
+        oyo = Boundary.objects.create(
+            org=self.nigeria, osm_id="R-OYO", name="Oyo", level=Boundary.DISTRICT_LEVEL, parent=lagos, geometry="{}"
+        )
+        Boundary.objects.create(
+            org=self.nigeria, osm_id="R-IKEJA", name="Ikeja", level=Boundary.WARD_LEVEL, parent=oyo, geometry="{}"
+        )
+        # ward directly under a state is not found from district names
+        Boundary.objects.create(
+            org=self.nigeria, osm_id="R-ORPHAN", name="Orphan", level=Boundary.WARD_LEVEL, parent=lagos, geometry="{}"
+        )
+        Boundary.objects.create(
+            org=self.nigeria,
+            osm_id="R-KANO",
+            name="Kano",
+            level=Boundary.STATE_LEVEL,
+            parent=country,
+            backend=self.floip_backend,
+            geometry="{}",
+        )
+
+        expected = (
+            {"lagos": "R-LAGOS", "kano": "R-KANO"},
+            {"R-LAGOS": {"oyo": "R-OYO"}, "R-KANO": {}},
+            {"R-OYO": {"ikeja": "R-IKEJA"}},
+        )
+
+        with self.assertNumQueries(1):
+            self.assertEqual(Boundary.get_names_lookup(self.nigeria), expected)
+
+        with self.assertNumQueries(1):
+            self.assertEqual(
+                Boundary.get_names_lookup(self.nigeria, self.floip_backend), ({"kano": "R-KANO"}, {"R-KANO": {}}, {})
+            )
+
+        # not cached until boundaries have a synced version
+        with self.assertNumQueries(1):
+            Boundary.get_names_lookup(self.nigeria)
+
+        Boundary.update_version(self.nigeria)
+
+        with self.assertNumQueries(1):
+            self.assertEqual(Boundary.get_names_lookup(self.nigeria), expected)
+
+        with self.assertNumQueries(0):
+            self.assertEqual(Boundary.get_names_lookup(self.nigeria), expected)
+
+        Boundary.objects.filter(osm_id="R-IKEJA").update(name="Ikeja Central")
+
+        # still cached until the next sync updates the version
+        with self.assertNumQueries(0):
+            self.assertEqual(Boundary.get_names_lookup(self.nigeria), expected)
+
+        Boundary.update_version(self.nigeria)
+
+        with self.assertNumQueries(1):
+            self.assertEqual(Boundary.get_names_lookup(self.nigeria)[2], {"R-OYO": {"ikeja central": "R-IKEJA"}})
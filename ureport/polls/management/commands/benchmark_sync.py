@@ -0,0 +1,187 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import logging
+import resource
+import threading
+import time
+import zoneinfo
+
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.test.utils import override_settings
+from django.utils import timezone
+
+from dash.categories.models import Category
+from dash.orgs.models import Org
+from ureport.backend.standin import REPORTER_GROUP, add_standin_arguments, create_standin_server
+from ureport.polls.models import Poll
+from ureport.utils import fetch_flows
+
+logger = logging.getLogger(__name__)
+
+
+class QueryCounter(object):
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        self.count += 1
+        return execute(sql, params, many, context)
+
+
+class Command(BaseCommand):
+    help = (
+        "Runs the RapidPro backend syncs of a new org against a stand-in RapidPro server, reporting for each sync "
+        "its objects per second, database queries per object and the peak memory of the process. Everything is "
+        "rolled back at the end unless --keep is given."
+    )
+
+    ORG_CONFIG = {
+        "rapidpro.reporter_group": REPORTER_GROUP,
+        "rapidpro.state_label": "State",
+        "rapidpro.district_label": "District",
+        "rapidpro.gender_label": "Gender",
+        "rapidpro.female_label": "Female",
+        "rapidpro.male_label": "Male",
+        "rapidpro.born_label": "Born",
+        "rapidpro.registration_label": "Registration Date",
+        "rapidpro.occupation_label": "Occupation",
+    }
+
+    def add_arguments(self, parser):
+        add_standin_arguments(parser)
+        parser.add_argument("--keep", action="store_true", help="Keep the benchmark org and its synced data")
+        parser.add_argument(
+            "--keep-rate-limit",
+            action="store_true",
+            help="Keep the RapidPro rate limit settings instead of lifting them for the benchmark",
+        )
+
+    def handle(self, *args, **options):
+        server = create_standin_server(options, ("127.0.0.1", 0))
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+
+        rate_limit_settings = dict()
+        if not options["keep_rate_limit"]:
+            rate_limit_settings = dict(RAPIDPRO_RATE_LIMIT=False)
+
+        self.stdout.write(
+            "%-12s %10s %10s %10s %12s %10s %12s %14s"
+            % ("sync", "seconds", "requests", "objects", "objects/s", "queries", "queries/obj", "peak RSS (MB)")
+        )
+
+        org = None
+        try:
+            with override_settings(**rate_limit_settings), transaction.atomic():
+                org, user = self.create_org(server.url)
+                self.run_syncs(server, org, user)
+
+                if not options["keep"]:
+                    transaction.set_rollback(True)
+        finally:
+            server.shutdown()
+            server.server_close()
+
+            if org is not None and not options["keep"] and hasattr(cache, "delete_pattern"):
+                cache.delete_pattern("*org:%d:*" % org.pk)
+                cache.delete_pattern("*:%d:backend:*" % org.pk)
+
+    def create_org(self, host):
+        user = User.objects.filter(is_superuser=True).first()
+        if user is None:
+            user = User.objects.create(username="standin-benchmark")
+
+        subdomain = "standin-%d" % int(time.time())
+        org = Org.objects.create(
+            name="Stand-in benchmark",
+            subdomain=subdomain,
+            timezone=zoneinfo.ZoneInfo("UTC"),
+            created_by=user,
+            modified_by=user,
+        )
+        org.backends.create(
+            slug="rapidpro",
+            backend_type="ureport.backend.rapidpro.RapidProBackend",
+            host=host,
+            api_token="standin",
+            created_by=user,
+            modified_by=user,
+        )
+
+        for name, value in self.ORG_CONFIG.items():
+            org.set_config(name, value, commit=False)
+        org.save()
+
+        return org, user
+
+    def run_syncs(self, server, org, user):
+        backend = org.get_backend(backend_slug="rapidpro")
+
+        self.measure(server, "fields", ("fields",), lambda: backend.pull_fields(org))
+        self.measure(server, "boundaries", ("boundaries",), lambda: backend.pull_boundaries(org))
+        self.measure(server, "contacts", ("contacts",), lambda: backend.pull_contacts(org, None, timezone.now()))
+
+        polls = []
+
+        def create_polls():
+            category = Category.objects.create(org=org, name="Stand-in", created_by=user, modified_by=user)
+            for flow_uuid, flow in sorted(fetch_flows(org).items()):
+                poll = Poll.objects.create(
+                    org=org,
+                    backend=org.backends.get(slug="rapidpro"),
+                    flow_uuid=flow_uuid,
+                    title=flow["name"],
+                    category=category,
+                    poll_date=timezone.now(),
+                    created_by=user,
+                    modified_by=user,
+                )
+                poll.update_or_create_questions(user)
+                polls.append(poll)
+
+        self.measure(server, "flows", ("flows",), create_polls)
+
+        def pull_archives():
+            for poll in polls:
+                backend.pull_results_from_archives(poll)
+
+        if server.data.num_archived_runs:
+            self.measure(server, "archives", ("archived_runs",), pull_archives)
+
+        def pull_runs():
+            for poll in polls:
+                backend.pull_results(poll, None, None)
+
+        self.measure(server, "runs", ("runs",), pull_runs)
+
+    def measure(self, server, name, object_keys, sync):
+        queries = QueryCounter()
+        server.reset_stats()
+
+        start = time.time()
+        with connection.execute_wrapper(queries):
+            sync()
+        elapsed = time.time() - start
+
+        stats = server.reset_stats()
+        num_objects = sum(stats.get(key, 0) for key in object_keys)
+
+        # ru_maxrss is in kilobytes on Linux
+        peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+        self.stdout.write(
+            "%-12s %10.2f %10d %10d %12.1f %10d %12.2f %14.1f"
+            % (
+                name,
+                elapsed,
+                stats.get("requests", 0),
+                num_objects,
+                num_objects / elapsed if elapsed else 0,
+                queries.count,
+                queries.count / num_objects if num_objects else 0,
+                peak_rss,
+            )
+        )
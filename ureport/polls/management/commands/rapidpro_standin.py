@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import logging
+
+from django.core.management.base import BaseCommand
+
+from ureport.backend.standin import add_standin_arguments, create_standin_server
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = (
+        "Serves a synthetic RapidPro workspace on the runs, contacts, archives, flows, fields and boundaries "
+        "endpoints of the API v2, to load test the syncs without a real workspace"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--host", default="127.0.0.1", help="Address to listen on")
+        parser.add_argument("--port", type=int, default=8765, help="Port to listen on")
+        add_standin_arguments(parser)
+
+    def handle(self, *args, **options):
+        server = create_standin_server(options, (options["host"], options["port"]))
+
+        self.stdout.write(
+            "Serving %d contacts and %d flows with %d runs each on %s, "
+            "use it as the host of a RapidPro backend, stop with CONTROL-C"
+            % (options["contacts"], options["flows"], options["runs_per_flow"], server.url)
+        )
+
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+            self.stdout.write("Served %s" % ", ".join("%s %d" % item for item in sorted(server.reset_stats().items())))
@@ -0,0 +1,11 @@
+from django.db import migrations
+
+from ureport.sql import InstallSQL
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("polls", "0073_alter_poll_index_together_and_more"),
+    ]
+
+    operations = [InstallSQL("polls_0074")]
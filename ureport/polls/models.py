@@ -3,6 +3,7 @@ from __future__ import absolute_import, division, print_function, unicode_litera
 
 import json
 import logging
+import time
 import uuid
 from collections import defaultdict
 from datetime import timedelta
@@ -25,6 +26,7 @@ from dash.categories.models import Category, CategoryImage
 from dash.orgs.models import Org, OrgBackend
 from dash.tags.models import Tag
 from smartmin.models import SmartModel
+from ureport.backend import SkippedPullResults
 from ureport.flows.models import FlowResult, FlowResultCategory
 
 logger = logging.getLogger(__name__)
@@ -48,6 +50,8 @@ CACHE_POLL_RESULTS_KEY = "org:%d:poll:%d:results:%d"
 
 CACHE_ORG_FLOWS_KEY = "org:%d:backend:%s:flows"
 
+CACHE_ORG_FLOWS_CHECKED_HASH_KEY = "org:%d:backend:%s:flows-checked-hash"
+
 CACHE_ORG_REPORTER_GROUP_KEY = "org:%d:reporters:%s"
 
 CACHE_ORG_FIELD_DATA_KEY = "org:%d:field:%s:segment:%s"
@@ -97,6 +101,8 @@ class Poll(SmartModel):
 
     POLL_RESULTS_MAX_SYNC_RUNS = 100_000
 
+    POLL_RESULTS_CONTACTS_FILTER_MIN_RUNS = 10_000
+
     POLL_RESULTS_LAST_OTHER_POLLS_SYNCED_CACHE_KEY = "last:poll_last_other_polls_sync:org:%d:poll:%s"
 
     POLL_RESULTS_LAST_OTHER_POLLS_SYNCED_CACHE_TIMEOUT = 60 * 60 * 24 * 2
@@ -105,6 +111,22 @@ class Poll(SmartModel):
 
     POLL_SYNC_LOCK_TIMEOUT = 60 * 60 * 2
 
+    POLL_RESULTS_COMBINED_SYNC_MAX_LAG = 60 * 60 * 24 * 3
+
+    POLL_RESULTS_SYNC_RATE_CACHE_KEY = "poll-results-sync-rate:org:%d:poll:%s"
+
+    POLL_RESULTS_SYNCS_IN_FLIGHT_KEY = "poll-results-syncs-in-flight"
+
+    POLL_RESULTS_SYNC_MIN_INTERVAL = 60 * 5
+
+    POLL_RESULTS_SYNC_MAX_INTERVAL = 60 * 60 * 48
+
+    POLL_RESULTS_SYNC_DEFAULT_INTERVAL = 60 * 60
+
+    POLL_RESULTS_MAIN_POLL_SYNC_MAX_INTERVAL = 60 * 20
+
+    POLL_RESULTS_SYNC_TARGET_RESULTS = 100
+
     flow_uuid = models.CharField(max_length=36, help_text=_("The Flow this Poll is based on"))
 
     poll_date = models.DateTimeField(
@@ -210,6 +232,12 @@ class Poll(SmartModel):
 
             pull_refresh_from_archives.apply_async((poll.pk,), queue="sync")
 
+        results = backend.pull_results(poll, None, None)
+
+        # the sync holding the lock tracks the results, nothing was pulled to measure the sync rate with
+        if isinstance(results, SkippedPullResults):
+            return results
+
         (
             num_val_created,
             num_val_updated,
@@ -217,15 +245,94 @@ class Poll(SmartModel):
             num_path_created,
             num_path_updated,
             num_path_ignored,
-        ) = backend.pull_results(poll, None, None)
+        ) = results
 
         if num_val_created + num_val_updated + num_path_created + num_path_updated != 0:
             poll.rebuild_poll_results_counts()
 
         Poll.objects.filter(org=poll.org_id, flow_uuid=poll.flow_uuid).update(has_synced=True)
+        poll.update_sync_rate(num_val_created)
 
         return num_val_created, num_val_updated, num_val_ignored, num_path_created, num_path_updated, num_path_ignored
 
+    @classmethod
+    def pull_results_for_polls(cls, org, polls):
+        """
+        Pulls the results of already synced polls together, sharing the backend fetches between them
+        :return: dict of the results stats tuples by poll id of the polls synced
+        """
+        polls_by_id = {poll.pk: poll for poll in polls}
+        polls_by_backend = defaultdict(list)
+        for poll in polls:
+            polls_by_backend[poll.backend.slug].append(poll)
+
+        polls_results = dict()
+        for backend_slug, backend_polls in polls_by_backend.items():
+            backend = org.get_backend(backend_slug=backend_slug)
+            polls_results.update(backend.pull_results_for_polls(org, backend_polls))
+
+        for poll_id, results in polls_results.items():
+            num_val_created, num_val_updated, _, num_path_created, num_path_updated, _ = results
+            if num_val_created + num_val_updated + num_path_created + num_path_updated != 0:
+                polls_by_id[poll_id].rebuild_poll_results_counts()
+            polls_by_id[poll_id].update_sync_rate(num_val_created)
+
+        return polls_results
+
+    @classmethod
+    def get_polls_to_sync(cls, org):
+        """
+        Returns the polls of the org whose results are still synced, one poll per flow
+        """
+        polls_ids = (
+            Poll.get_public_polls(org)
+            .exclude(stopped_syncing=True)
+            .order_by("flow_uuid")
+            .distinct("flow_uuid")
+            .values_list("id", flat=True)
+        )
+        return Poll.objects.filter(id__in=polls_ids).order_by("-created_on")
+
+    def update_sync_rate(self, num_val_created):
+        """
+        Tracks how fast new results arrive on this poll, as a moving average of the results created per hour between
+        two syncs
+        """
+        key = Poll.POLL_RESULTS_SYNC_RATE_CACHE_KEY % (self.org_id, self.flow_uuid)
+        now = time.time()
+
+        rate = None
+        sync_rate = cache.get(key, None)
+        if sync_rate:
+            elapsed = max(now - sync_rate["time"], 60)
+            current_rate = num_val_created * 60 * 60 / elapsed
+            rate = current_rate if sync_rate["rate"] is None else (current_rate + sync_rate["rate"]) / 2
+
+        cache.set(key, dict(rate=rate, time=now), None)
+
+    def get_sync_staleness(self, now=None):
+        """
+        Returns how overdue the next sync of this poll is, 1 meaning it is due now. Polls receiving results faster
+        are due more often, dormant ones only every POLL_RESULTS_SYNC_MAX_INTERVAL.
+        """
+        sync_rate = cache.get(Poll.POLL_RESULTS_SYNC_RATE_CACHE_KEY % (self.org_id, self.flow_uuid), None)
+        if not sync_rate:
+            return float("inf")
+
+        if sync_rate["rate"] is None:
+            interval = Poll.POLL_RESULTS_SYNC_DEFAULT_INTERVAL
+        elif sync_rate["rate"] <= 0:
+            interval = Poll.POLL_RESULTS_SYNC_MAX_INTERVAL
+        else:
+            interval = Poll.POLL_RESULTS_SYNC_TARGET_RESULTS * 60 * 60 / sync_rate["rate"]
+            interval = min(max(interval, Poll.POLL_RESULTS_SYNC_MIN_INTERVAL), Poll.POLL_RESULTS_SYNC_MAX_INTERVAL)
+
+        if self.pk == cache.get(Poll.ORG_MAIN_POLL_ID % self.org_id, None):
+            interval = min(interval, Poll.POLL_RESULTS_MAIN_POLL_SYNC_MAX_INTERVAL)
+
+        now = now if now is not None else time.time()
+        return (now - sync_rate["time"]) / interval
+
     def get_pull_cached_params(self):
         latest_synced_obj_time = cache.get(Poll.POLL_RESULTS_LAST_PULL_CACHE_KEY % (self.org.pk, self.flow_uuid), None)
 
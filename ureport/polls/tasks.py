@@ -8,6 +8,7 @@ from datetime import timedelta
 from django_redis import get_redis_connection
 from temba_client.exceptions import TembaRateExceededError
 
+from django.conf import settings
 from django.core.cache import cache
 from django.utils import timezone
 
@@ -18,6 +19,7 @@ from ureport.utils import (
     fetch_flows,
     fetch_old_sites_count as do_fetch_old_sites_count,
     fetch_shared_sites_count,
+    map_concurrently,
     populate_age_and_gender_poll_results,
     update_poll_flow_data,
 )
@@ -61,6 +63,9 @@ def backfill_poll_results(org, since, until):
 def pull_results_main_poll(org, since, until):
     from .models import Poll
 
+    if getattr(settings, "POLL_RESULTS_ADAPTIVE_SCHEDULE", False):
+        return dict()
+
     results_log = dict()
     main_poll = Poll.get_main_poll(org)
     if main_poll:
@@ -88,6 +93,9 @@ def pull_results_main_poll(org, since, until):
 def pull_results_other_polls(org, since, until):
     from .models import Poll
 
+    if getattr(settings, "POLL_RESULTS_ADAPTIVE_SCHEDULE", False):
+        return dict()
+
     now = timezone.now()
     recent_window = now - timedelta(days=7)
 
@@ -95,30 +103,42 @@ def pull_results_other_polls(org, since, until):
     other_polls_ids = Poll.get_other_polls(org).exclude(created_on__gt=recent_window)
     other_polls_ids = other_polls_ids.order_by("flow_uuid").distinct("flow_uuid").values_list("id", flat=True)
     other_polls = Poll.objects.filter(id__in=other_polls_ids).order_by("-created_on")
+
+    other_polls = [
+        poll
+        for poll in other_polls
+        if not cache.get(Poll.POLL_RESULTS_LAST_OTHER_POLLS_SYNCED_CACHE_KEY % (org.id, poll.flow_uuid))
+    ]
+
+    polls_results = dict()
+    if getattr(settings, "POLL_RESULTS_COMBINED_SYNC", False):
+        try:
+            polls_results = Poll.pull_results_for_polls(org, other_polls)
+        except TembaRateExceededError:
+            pass
+
     for poll in other_polls:
-        key = Poll.POLL_RESULTS_LAST_OTHER_POLLS_SYNCED_CACHE_KEY % (org.id, poll.flow_uuid)
-        if not cache.get(key):
-            try:
-                (
-                    num_val_created,
-                    num_val_updated,
-                    num_val_ignored,
-                    num_path_created,
-                    num_path_updated,
-                    num_path_ignored,
-                ) = Poll.pull_results(poll.id)
-
-                results_log["flow-%s" % poll.flow_uuid] = {
-                    "num_val_created": num_val_created,
-                    "num_val_updated": num_val_updated,
-                    "num_val_ignored": num_val_ignored,
-                    "num_path_created": num_path_created,
-                    "num_path_updated": num_path_updated,
-                    "num_path_ignored": num_path_ignored,
-                }
-
-            except TembaRateExceededError:
-                pass
+        try:
+            (
+                num_val_created,
+                num_val_updated,
+                num_val_ignored,
+                num_path_created,
+                num_path_updated,
+                num_path_ignored,
+            ) = polls_results.get(poll.pk) or Poll.pull_results(poll.id)
+
+            results_log["flow-%s" % poll.flow_uuid] = {
+                "num_val_created": num_val_created,
+                "num_val_updated": num_val_updated,
+                "num_val_ignored": num_val_ignored,
+                "num_path_created": num_path_created,
+                "num_path_updated": num_path_updated,
+                "num_path_ignored": num_path_ignored,
+            }
+
+        except TembaRateExceededError:
+            pass
 
     return results_log
 
@@ -127,11 +147,20 @@ def pull_results_other_polls(org, since, until):
 def pull_results_recent_polls(org, since, until):
     from .models import Poll
 
+    if getattr(settings, "POLL_RESULTS_ADAPTIVE_SCHEDULE", False):
+        return dict()
+
     results_log = dict()
     recent_polls_ids = Poll.get_recent_polls(org).order_by("flow_uuid")
     recent_polls_ids = recent_polls_ids.distinct("flow_uuid").values_list("id", flat=True)
 
     recent_polls = Poll.objects.filter(id__in=recent_polls_ids).order_by("-created_on")
+
+    # polls already synced share one cursor, the others are pulled one by one
+    polls_results = dict()
+    if getattr(settings, "POLL_RESULTS_COMBINED_SYNC", False):
+        polls_results = Poll.pull_results_for_polls(org, recent_polls)
+
     for poll in recent_polls:
         (
             num_val_created,
@@ -140,7 +169,7 @@ def pull_results_recent_polls(org, since, until):
             num_path_created,
             num_path_updated,
             num_path_ignored,
-        ) = Poll.pull_results(poll.id)
+        ) = polls_results.get(poll.pk) or Poll.pull_results(poll.id)
         results_log["flow-%s" % poll.flow_uuid] = {
             "num_val_created": num_val_created,
             "num_val_updated": num_val_updated,
@@ -153,6 +182,55 @@ def pull_results_recent_polls(org, since, until):
     return results_log
 
 
+@app.task(name="polls.schedule_results_pulls")
+def schedule_results_pulls():
+    """
+    Queues the pulls of the polls whose results are the most overdue, within the budget of concurrent pulls
+    """
+    from .models import Poll
+
+    if not getattr(settings, "POLL_RESULTS_ADAPTIVE_SCHEDULE", False):
+        return
+
+    r = get_redis_connection()
+    now = time.time()
+
+    # pulls that never reported back are given up on once their lock would have expired
+    r.zremrangebyscore(Poll.POLL_RESULTS_SYNCS_IN_FLIGHT_KEY, "-inf", now)
+    in_flight = {int(poll_id) for poll_id in r.zrange(Poll.POLL_RESULTS_SYNCS_IN_FLIGHT_KEY, 0, -1)}
+
+    budget = getattr(settings, "POLL_RESULTS_SYNC_CONCURRENCY", 8) - len(in_flight)
+    if budget <= 0:
+        return
+
+    due_polls = []
+    for org in Org.objects.filter(is_active=True).order_by("pk"):
+        for poll in Poll.get_polls_to_sync(org):
+            if poll.pk in in_flight:
+                continue
+
+            staleness = poll.get_sync_staleness(now)
+            if staleness >= 1:
+                due_polls.append((staleness, poll.pk))
+
+    due_polls = sorted(due_polls, key=lambda due_poll: due_poll[0], reverse=True)[:budget]
+    for staleness, poll_id in due_polls:
+        r.zadd(Poll.POLL_RESULTS_SYNCS_IN_FLIGHT_KEY, {poll_id: now + Poll.POLL_SYNC_LOCK_TIMEOUT})
+        pull_scheduled_results.apply_async((poll_id,), queue="sync")
+
+    logger.info("Queued results pulls for %d polls" % len(due_polls))
+
+
+@app.task(name="polls.pull_scheduled_results")
+def pull_scheduled_results(poll_id):
+    from .models import Poll
+
+    try:
+        Poll.pull_results(poll_id)
+    finally:
+        get_redis_connection().zrem(Poll.POLL_RESULTS_SYNCS_IN_FLIGHT_KEY, poll_id)
+
+
 @org_task("clear-old-poll-results", 60 * 60 * 5)
 def clear_old_poll_results(org, since, until):
     from .models import Poll
@@ -260,13 +338,15 @@ def update_results_age_gender(org_id=None):
     if org_id:
         org = Org.objects.filter(pk=org_id).first()
 
-    populate_age_and_gender_poll_results(org)
+    updated_flows = populate_age_and_gender_poll_results(org)
 
-    polls = Poll.objects.all()
+    # only the polls with poll results changed need their counts rebuilt
+    polls = Poll.objects.filter(flow_uuid__in={flow for org_id, flow in updated_flows})
     if org:
         polls = polls.filter(org=org)
     for poll in polls:
-        poll.rebuild_poll_results_counts()
+        if (poll.org_id, poll.flow_uuid) in updated_flows:
+            poll.rebuild_poll_results_counts()
 
 
 @app.task(name="polls.refresh_org_flows")
@@ -287,8 +367,11 @@ def refresh_org_flows(org_id=None):
             if org_id:
                 active_orgs = Org.objects.filter(pk=org_id)
 
-            for org in active_orgs:
-                fetch_flows(org)
+            # fetching flows mostly waits on the backends so fetch them for several orgs at a time
+            active_orgs = list(active_orgs)
+            for org, (_, error) in zip(active_orgs, map_concurrently(fetch_flows, active_orgs)):
+                if error is not None:
+                    logger.error("Fetching flows for org #%d failed: %s" % (org.pk, error))
 
         logger.info("Task: refresh_flows took %ss" % (time.time() - start))
 
@@ -1,11 +1,13 @@
 # -*- coding: utf-8 -*-
 from __future__ import absolute_import, division, print_function, unicode_literals
 
+import time
 import uuid
 import zoneinfo
 from datetime import date, datetime, timedelta
 
 import six
+from django_redis import get_redis_connection
 from mock import Mock, patch
 from temba_client.exceptions import TembaRateExceededError
 
@@ -15,13 +17,16 @@ from django.db.models import Count, ExpressionWrapper, F, IntegerField, Sum, Tex
 from django.db.models.functions import Cast, ExtractYear
 from django.http import HttpRequest
 from django.template import TemplateSyntaxError
+from django.test import override_settings
 from django.urls import reverse
 from django.utils import timezone
 
 from dash.categories.fields import CategoryChoiceField
 from dash.categories.models import Category, CategoryImage
-from dash.orgs.models import TaskState
+from dash.orgs.models import OrgBackend, TaskState
 from dash.tags.models import Tag
+from ureport.backend import SkippedPullResults
+from ureport.backend.rapidpro import RapidProBackend
 from ureport.flows.models import FlowResultCategory
 from ureport.locations.models import Boundary
 from ureport.polls.models import Poll, PollImage, PollQuestion, PollResponseCategory, PollResult
@@ -31,9 +36,12 @@ from ureport.polls.tasks import (
     pull_refresh,
     pull_results_main_poll,
     pull_results_other_polls,
+    pull_results_recent_polls,
+    pull_scheduled_results,
     rebuild_counts,
     recheck_poll_flow_data,
     refresh_org_flows,
+    schedule_results_pulls,
     update_or_create_questions,
     update_results_age_gender,
 )
@@ -42,10 +50,12 @@ from ureport.stats.models import (
     AgeSegment,
     ContactActivity,
     ContactActivityCounter,
+    ContactActivitySketch,
     GenderSegment,
     PollStats,
     PollWordCloud,
 )
+from ureport.stats.tasks import backfill_contact_activity_sketches
 from ureport.tests import MockTembaClient, TestBackend, UreportTest
 from ureport.utils import datetime_to_json_date, json_date_to_datetime
 
@@ -1213,6 +1223,28 @@ class PollTest(UreportTest):
         self.assertEqual(mock_get_backend.call_args[1], {"backend_slug": "rapidpro"})
         mock_pull_results.assert_called_once()
 
+    @patch("ureport.polls.tasks.pull_refresh_from_archives.apply_async")
+    @patch("ureport.polls.models.Poll.get_flow_date")
+    @patch("dash.orgs.models.Org.get_backend")
+    @patch("ureport.tests.TestBackend.pull_results")
+    def test_poll_pull_results_skipped(
+        self, mock_pull_results, mock_get_backend, mock_poll_flow_date, mock_pull_refresh_from_archives_task
+    ):
+        mock_get_backend.return_value = TestBackend(self.rapidpro_backend)
+        mock_pull_results.return_value = SkippedPullResults()
+        mock_poll_flow_date.return_value = None
+
+        poll = self.create_poll(self.nigeria, "Poll 1", "flow-uuid", self.education_nigeria, self.admin)
+        sync_rate_key = Poll.POLL_RESULTS_SYNC_RATE_CACHE_KEY % (poll.org_id, poll.flow_uuid)
+        cache.set(sync_rate_key, dict(rate=600, time=time.time()), None)
+
+        # another sync holds the lock, the sync rate is left to it
+        self.assertEqual(Poll.pull_results(poll.pk), (0, 0, 0, 0, 0, 0))
+        self.assertEqual(cache.get(sync_rate_key)["rate"], 600)
+
+        poll = Poll.objects.get(pk=poll.pk)
+        self.assertFalse(poll.has_synced)
+
     @patch("ureport.polls.tasks.pull_refresh_from_archives.apply_async")
     @patch("ureport.polls.models.Poll.get_flow_date")
     @patch("dash.orgs.models.Org.get_backend")
@@ -1251,6 +1283,46 @@ class PollTest(UreportTest):
         self.assertEqual(mock_get_backend.call_args[1], {"backend_slug": "rapidpro"})
         mock_pull_results.assert_called_once()
 
+    @patch("time.time")
+    def test_sync_staleness(self, mock_time):
+        mock_time.return_value = 100_000.0
+
+        poll = self.create_poll(self.nigeria, "Poll 1", "flow-uuid", self.education_nigeria, self.admin)
+        cache.delete(Poll.POLL_RESULTS_SYNC_RATE_CACHE_KEY % (self.nigeria.pk, "flow-uuid"))
+        cache.delete(Poll.ORG_MAIN_POLL_ID % self.nigeria.pk)
+
+        # never synced
+        self.assertEqual(poll.get_sync_staleness(), float("inf"))
+
+        # first sync, no rate yet
+        poll.update_sync_rate(5000)
+        self.assertEqual(poll.get_sync_staleness(), 0)
+        self.assertEqual(poll.get_sync_staleness(100_000.0 + 1800), 0.5)
+
+        # 600 results in the half hour since
+        mock_time.return_value += 1800
+        poll.update_sync_rate(600)
+        self.assertEqual(
+            cache.get(Poll.POLL_RESULTS_SYNC_RATE_CACHE_KEY % (self.nigeria.pk, "flow-uuid")),
+            dict(rate=1200.0, time=101_800.0),
+        )
+
+        # so 100 results are expected every 5 minutes
+        self.assertEqual(poll.get_sync_staleness(101_800.0 + 600), 2)
+
+        # nothing new for an hour halves the rate
+        mock_time.return_value += 3600
+        poll.update_sync_rate(0)
+        self.assertEqual(poll.get_sync_staleness(105_400.0 + 600), 1)
+
+        # dormant polls are synced every two days, unless it is the main poll
+        cache.set(Poll.POLL_RESULTS_SYNC_RATE_CACHE_KEY % (self.nigeria.pk, "flow-uuid"), dict(rate=0, time=0.0), None)
+        self.assertEqual(poll.get_sync_staleness(60 * 60 * 24), 0.5)
+
+        cache.set(Poll.ORG_MAIN_POLL_ID % self.nigeria.pk, poll.pk, None)
+        self.assertEqual(poll.get_sync_staleness(60 * 60 * 24), 72)
+        cache.delete(Poll.ORG_MAIN_POLL_ID % self.nigeria.pk)
+
 
 class PollQuestionTest(UreportTest):
     def setUp(self):
@@ -2130,12 +2202,24 @@ class PollQuestionTest(UreportTest):
             mock_rebuild_counts.return_value = "Rebuilt"
 
             with patch("ureport.polls.tasks.populate_age_and_gender_poll_results") as mock_populate_age_gender_results:
-                mock_populate_age_gender_results.return_value = "Populated"
+                nigeria_poll = self.create_poll(self.nigeria, "Poll 3", "flow-uuid-3", self.education, self.admin)
+                self.create_poll(self.nigeria, "Poll 4", "flow-uuid-4", self.education, self.admin)
+                mock_populate_age_gender_results.return_value = {
+                    (self.nigeria.pk, nigeria_poll.flow_uuid),
+                    (self.uganda.pk, "flow-uuid-2"),
+                }
 
                 update_results_age_gender(self.nigeria.pk)
 
                 mock_populate_age_gender_results.assert_called_once_with(self.nigeria)
-                self.assertEqual(mock_rebuild_counts.call_count, Poll.objects.filter(org=self.nigeria).count())
+                # only the polls with changed results are rebuilt
+                mock_rebuild_counts.assert_called_once_with()
+
+                mock_rebuild_counts.reset_mock()
+                mock_populate_age_gender_results.return_value = set()
+
+                update_results_age_gender(self.nigeria.pk)
+                self.assertFalse(mock_rebuild_counts.called)
 
 
 class PollResultsTest(UreportTest):
@@ -2243,6 +2327,13 @@ class PollResultsTest(UreportTest):
             ward="R-IKEJA",
             scheme="tel",
         )
+
+        # a batch of results generates the activities of its contacts in one go
+        self.assertFalse(ContactActivity.objects.filter(org=self.nigeria))
+        ContactActivity.update_for_poll_results(
+            self.nigeria.id, PollResult.objects.filter(org=self.nigeria).order_by("id")
+        )
+
         self.assertTrue(ContactActivity.objects.filter(org=self.nigeria, contact="contact-uuid"))
         self.assertTrue(ContactActivity.objects.filter(org=self.nigeria, contact="contact-uuid2"))
         self.assertTrue(ContactActivity.objects.filter(org=self.nigeria, contact="contact-uuid3"))
@@ -2368,7 +2459,7 @@ class PollResultsTest(UreportTest):
 
         verify_counts()
 
-        self.assertEqual(324, ContactActivityCounter.objects.all().count())
+        self.assertEqual(96, ContactActivityCounter.objects.all().count())
         ContactActivityCounter.squash()
         self.assertEqual(96, ContactActivityCounter.objects.all().count())
 
@@ -2384,11 +2475,116 @@ class PollResultsTest(UreportTest):
         ContactActivity.recalculate_contact_activity_counts(self.nigeria)
         verify_counts()
 
+    def test_contact_activity_sketches(self):
+        r = get_redis_connection()
+        for key in r.scan_iter("contact-activity-sketch:%d:*" % self.nigeria.id):
+            r.delete(key)
+        r.delete(ContactActivitySketch.BACKFILLED_KEY % self.nigeria.id)
+
+        this_month = self.now.astimezone(timezone.utc).date().replace(day=1)
+        this_month_key = str(this_month)
+        born = this_month.year - 22
+
+        ContactActivitySketch.add_poll_results(
+            self.nigeria.id,
+            [
+                PollResult(contact="contact-uuid", category=None, date=self.now),
+                PollResult(contact="contact-uuid2", category="No", date=None),
+                PollResult(
+                    contact="contact-uuid3",
+                    category="Yes",
+                    date=self.now,
+                    born=born,
+                    gender="M",
+                    state="R-LAGOS",
+                    scheme="tel",
+                ),
+                PollResult(contact="contact-uuid3", category="No", date=self.now, gender="M", state="R-LAGOS"),
+                PollResult(contact="contact-uuid4", category="Yes", date=self.now, gender="F", scheme="facebook"),
+            ],
+        )
+
+        self.assertEqual(
+            ContactActivitySketch.count(
+                self.nigeria.id, ContactActivitySketch.get_months(this_month), ContactActivityCounter.TYPE_ALL, [""]
+            ),
+            {month: 2 for month in ContactActivitySketch.get_months(this_month)},
+        )
+        self.assertTrue(
+            r.ttl(ContactActivitySketch.get_key(self.nigeria.id, this_month, ContactActivityCounter.TYPE_ALL, ""))
+        )
+
+        with override_settings(CONTACT_ACTIVITY_SKETCHES=False):
+            activity = ContactActivity.get_activity(self.nigeria, 12)
+            self.assertEqual(activity[0]["data"][this_month_key], 0)
+
+        with override_settings(CONTACT_ACTIVITY_SKETCHES=True):
+            # the counters are read until the sketches are backfilled with the existing activities
+            activity = ContactActivity.get_activity(self.nigeria, 12)
+            self.assertEqual(activity[0]["data"][this_month_key], 0)
+
+            backfill_contact_activity_sketches()
+            self.assertTrue(r.exists(ContactActivitySketch.BACKFILLED_KEY % self.nigeria.id))
+
+            activity = ContactActivity.get_activity(self.nigeria, 12)
+            self.assertEqual(activity[0]["data"][this_month_key], 2)
+            self.assertEqual(set(activity[0]["data"].values()), {0, 2})
+
+            # backfilled orgs are skipped by the next backfills
+            with patch("ureport.stats.models.ContactActivitySketch.add_contact_activities") as mock_add_activities:
+                backfill_contact_activity_sketches()
+                self.assertFalse(mock_add_activities.called)
+
+            # and their synced results are only added to the sketches, not to the contact activities
+            RapidProBackend._record_poll_results_activity(
+                self.nigeria, [PollResult(contact="contact-uuid5", category="Yes", date=self.now)]
+            )
+            self.assertFalse(ContactActivity.objects.filter(org=self.nigeria, contact="contact-uuid5"))
+            self.assertFalse(ContactActivityCounter.objects.filter(org=self.nigeria))
+
+            activity = ContactActivity.get_activity(self.nigeria, 12)
+            self.assertEqual(activity[0]["data"][this_month_key], 3)
+
+            activity_age = {elt["name"]: elt["data"] for elt in ContactActivity.get_activity_age(self.nigeria, 12)}
+            self.assertEqual(activity_age["20-24"][this_month_key], 1)
+            self.assertEqual(activity_age["25-30"][this_month_key], 0)
+
+            activity_gender = {
+                elt["name"]: elt["data"] for elt in ContactActivity.get_activity_gender(self.nigeria, 12)
+            }
+            self.assertEqual(activity_gender["Male"][this_month_key], 1)
+            self.assertEqual(activity_gender["Female"][this_month_key], 1)
+
+            with patch("ureport.locations.models.Boundary.get_org_top_level_boundaries_name") as mock_boundaries:
+                mock_boundaries.return_value = {"R-LAGOS": "Lagos", "R-ABUJA": "Abuja"}
+
+                activity_location = {
+                    elt["osm_id"]: elt["data"]
+                    for elt in ContactActivity.get_contact_activity_location(self.nigeria, 12)
+                }
+                self.assertEqual(activity_location["R-LAGOS"][this_month_key], 1)
+                self.assertEqual(activity_location["R-ABUJA"][this_month_key], 0)
+
+            # and still for orgs with a backend not feeding the sketches
+            OrgBackend.objects.update_or_create(
+                org=self.nigeria,
+                slug="floip",
+                defaults=dict(
+                    backend_type="ureport.backend.floip.FLOIPBackend",
+                    is_active=True,
+                    created_by=self.admin,
+                    modified_by=self.admin,
+                ),
+            )
+
+            activity = ContactActivity.get_activity(self.nigeria, 12)
+            self.assertEqual(activity[0]["data"][this_month_key], 0)
+
     def test_contact_activity(self):
         self.assertFalse(ContactActivity.objects.filter(org=self.nigeria, contact="contact-uuid"))
         self.assertFalse(ContactActivityCounter.objects.filter(org=self.nigeria))
 
-        PollResult.objects.create(
+        poll_result = PollResult.objects.create(
             org=self.nigeria,
             flow=self.poll.flow_uuid,
             ruleset=self.poll_question.flow_result.result_uuid,
@@ -2396,11 +2592,12 @@ class PollResultsTest(UreportTest):
             contact="contact-uuid",
             completed=False,
         )
+        ContactActivity.update_for_poll_results(self.nigeria.id, [poll_result])
 
         self.assertFalse(ContactActivity.objects.filter(org=self.nigeria, contact="contact-uuid"))
         self.assertFalse(ContactActivityCounter.objects.filter(org=self.nigeria))
 
-        PollResult.objects.create(
+        poll_result = PollResult.objects.create(
             org=self.nigeria,
             flow=self.poll.flow_uuid,
             ruleset=self.poll_question.flow_result.result_uuid,
@@ -2409,6 +2606,7 @@ class PollResultsTest(UreportTest):
             contact="contact-uuid",
             completed=False,
         )
+        ContactActivity.update_for_poll_results(self.nigeria.id, [poll_result])
 
         self.assertTrue(ContactActivity.objects.filter(org=self.nigeria, contact="contact-uuid"))
         self.assertEqual(ContactActivity.objects.filter(org=self.nigeria, contact="contact-uuid").count(), 12)
@@ -2475,7 +2673,7 @@ class PollResultsTest(UreportTest):
             .count(),
         )
 
-        PollResult.objects.create(
+        poll_result = PollResult.objects.create(
             org=self.nigeria,
             flow=self.poll.flow_uuid,
             ruleset="other-uuid",
@@ -2488,6 +2686,7 @@ class PollResultsTest(UreportTest):
             district="R-oyo",
             ward="R-IKEJA",
         )
+        ContactActivity.update_for_poll_results(self.nigeria.id, [poll_result])
 
         self.assertTrue(ContactActivity.objects.filter(org=self.nigeria, contact="contact-uuid"))
         self.assertEqual(ContactActivity.objects.filter(org=self.nigeria, contact="contact-uuid").count(), 12)
@@ -2557,7 +2756,7 @@ class PollResultsTest(UreportTest):
             self.assertEqual("R-LAGOS", elt["value"])
             self.assertEqual(1, elt["count__sum"])
 
-        PollResult.objects.create(
+        poll_result = PollResult.objects.create(
             org=self.nigeria,
             flow=self.poll.flow_uuid,
             ruleset="other-uuid",
@@ -2572,6 +2771,7 @@ class PollResultsTest(UreportTest):
             district="R-oyo",
             ward="R-IKEJA",
         )
+        ContactActivity.update_for_poll_results(self.nigeria.id, [poll_result])
 
         self.assertTrue(ContactActivity.objects.filter(org=self.nigeria, contact="contact-uuid2"))
         self.assertEqual(ContactActivity.objects.filter(org=self.nigeria, contact="contact-uuid2").count(), 12)
@@ -2953,6 +3153,66 @@ class PollsTasksTest(UreportTest):
         self.create_poll(self.nigeria, "Poll 4", "", self.education_nigeria, self.admin, has_synced=False)
         self.create_poll(self.nigeria, "Poll 5", "", self.education_nigeria, self.admin, has_synced=True)
 
+    @patch("ureport.polls.tasks.pull_scheduled_results.apply_async")
+    def test_schedule_results_pulls(self, mock_pull_scheduled_results):
+        r = get_redis_connection()
+        r.delete(Poll.POLL_RESULTS_SYNCS_IN_FLIGHT_KEY)
+        cache.delete(Poll.ORG_MAIN_POLL_ID % self.nigeria.pk)
+
+        busy_poll = self.create_poll(self.nigeria, "Busy", "flow-busy", self.education_nigeria, self.admin)
+        dormant_poll = self.create_poll(self.nigeria, "Dormant", "flow-dormant", self.education_nigeria, self.admin)
+        new_poll = self.create_poll(self.nigeria, "New", "flow-new", self.education_nigeria, self.admin)
+        Poll.objects.filter(pk__in=[busy_poll.pk, dormant_poll.pk, new_poll.pk]).update(has_synced=True)
+
+        now = time.time()
+        sync_rates = {
+            "flow-busy": dict(rate=1200, time=now - 600),
+            "flow-dormant": dict(rate=0, time=now - 3600),
+            "flow-new": None,
+            "uuid-1": dict(rate=None, time=now - 1800),
+        }
+        for flow_uuid, sync_rate in sync_rates.items():
+            key = Poll.POLL_RESULTS_SYNC_RATE_CACHE_KEY % (self.nigeria.pk, flow_uuid)
+            if sync_rate:
+                cache.set(key, sync_rate, None)
+            else:
+                cache.delete(key)
+
+        # disabled by default
+        schedule_results_pulls()
+        mock_pull_scheduled_results.assert_not_called()
+
+        with override_settings(POLL_RESULTS_ADAPTIVE_SCHEDULE=True, POLL_RESULTS_SYNC_CONCURRENCY=1):
+            # the poll never synced is the most overdue
+            schedule_results_pulls()
+            mock_pull_scheduled_results.assert_called_once_with((new_poll.pk,), queue="sync")
+            mock_pull_scheduled_results.reset_mock()
+
+            # no budget left until it is done
+            schedule_results_pulls()
+            mock_pull_scheduled_results.assert_not_called()
+
+        with override_settings(POLL_RESULTS_ADAPTIVE_SCHEDULE=True, POLL_RESULTS_SYNC_CONCURRENCY=3):
+            schedule_results_pulls()
+            mock_pull_scheduled_results.assert_called_once_with((busy_poll.pk,), queue="sync")
+            mock_pull_scheduled_results.reset_mock()
+
+        with patch("ureport.polls.models.Poll.pull_results") as mock_pull_results:
+            pull_scheduled_results(new_poll.pk)
+            mock_pull_results.assert_called_once_with(new_poll.pk)
+
+        self.assertEqual(
+            {int(poll_id) for poll_id in r.zrange(Poll.POLL_RESULTS_SYNCS_IN_FLIGHT_KEY, 0, -1)}, {busy_poll.pk}
+        )
+
+        # the fixed schedules are skipped
+        with override_settings(POLL_RESULTS_ADAPTIVE_SCHEDULE=True):
+            with patch("ureport.polls.models.Poll.pull_results") as mock_pull_results:
+                pull_results_recent_polls(self.nigeria.pk)
+                mock_pull_results.assert_not_called()
+
+        r.delete(Poll.POLL_RESULTS_SYNCS_IN_FLIGHT_KEY)
+
     @patch("ureport.polls.models.Poll.get_flow_date")
     @patch("dash.orgs.models.Org.get_backend")
     @patch("ureport.tests.TestBackend.pull_results")
@@ -1104,6 +1104,11 @@ CELERY_BEAT_SCHEDULE = {
         "relative": True,
         "args": ("ureport.polls.tasks.pull_results_other_polls", "sync"),
     },
+    "results-pull-schedule": {
+        "task": "polls.schedule_results_pulls",
+        "schedule": timedelta(minutes=1),
+        "relative": True,
+    },
     "refresh-engagement-data": {
         "task": "dash.orgs.tasks.trigger_org_task",
         "schedule": crontab(hour=2, minute=0),
@@ -1140,8 +1145,56 @@ CELERY_BEAT_SCHEDULE = {
         "relative": True,
         "options": {"queue": "slow"},
     },
+    "stats_activity_sketches_backfill": {
+        "task": "stats.backfill_contact_activity_sketches",
+        "schedule": crontab(hour=3, minute=0),
+        "options": {"queue": "slow"},
+    },
 }
 
+# -----------------------------------------------------------------------------------
+# Results Sync Settings
+# -----------------------------------------------------------------------------------
+
+# number of processes decoding run archives ahead of the database writer, 0 or 1 to decode in the worker itself
+POLL_RESULTS_ARCHIVE_WORKERS = 0
+
+# number of RapidPro API pages of runs and contacts fetched ahead in the background while a page is processed
+RAPIDPRO_PREFETCH_FETCHES = 2
+
+# whether the tasks calling the same RapidPro workspace share a requests budget per API throttle scope, the results
+# pulls reschedule themselves when it is spent while the other tasks wait for it to refill
+RAPIDPRO_RATE_LIMIT = False
+RAPIDPRO_RATE_LIMIT_PER_HOUR = 2500
+RAPIDPRO_RATE_LIMIT_BURST = 2500
+
+# write each page of pulled contacts with bulk statements instead of saving the contacts one by one
+RAPIDPRO_BULK_CONTACTS_SYNC = False
+
+# pull the new runs of the recent and other polls already synced through one cursor on the runs of the org
+POLL_RESULTS_COMBINED_SYNC = False
+
+# pull poll results as often as their results arrive, replacing the fixed main, recent and other polls schedules
+POLL_RESULTS_ADAPTIVE_SCHEDULE = False
+POLL_RESULTS_SYNC_CONCURRENCY = 8
+
+# threads and seconds per request used by the beat jobs fetching flows and counts from the backends and linked sites
+HTTP_FETCH_WORKERS = 8
+HTTP_FETCH_TIMEOUT = 30
+
+# retries with backoff of the FLOIP API requests, and pages of responses fetched ahead while a page is processed
+FLOIP_HTTP_RETRIES = 3
+FLOIP_PREFETCH_PAGES = 1
+
+# seconds between the exact contacts counts of the contacts counters check, which only checks the new contacts in
+# between, so a drift of the counters on existing contacts can go unnoticed for that long
+CONTACT_COUNTS_FULL_CHECK_INTERVAL = 60 * 60 * 24
+
+# whether the active users stats are estimated from the redis HyperLogLog sketches fed by the poll results sync,
+# for each org once the scheduled stats.backfill_contact_activity_sketches task filled them from its contact
+# activities, the poll results sync of the org stops writing its contact activities and their counters from then on
+CONTACT_ACTIVITY_SKETCHES = False
+
 # -----------------------------------------------------------------------------------
 # U-Report Defaults
 # -----------------------------------------------------------------------------------
@@ -0,0 +1,95 @@
+-----------------------------------------------------------------------------
+-- The reporters counter types of an active contact, the same as Contact.generate_counters
+-----------------------------------------------------------------------------
+CREATE OR REPLACE FUNCTION
+  ureport_contact_counter_types(_gender VARCHAR, _born INT, _occupation VARCHAR, _registered_on TIMESTAMP WITH TIME ZONE, _state VARCHAR, _district VARCHAR, _ward VARCHAR, _scheme VARCHAR)
+RETURNS SETOF VARCHAR AS $$
+  SELECT t."type" FROM (
+    SELECT
+      LOWER(NULLIF(_gender, '')) AS "gender",
+      CAST(NULLIF(_born, 0) AS VARCHAR) AS "born",
+      LOWER(NULLIF(_occupation, '')) AS "occupation",
+      TO_CHAR(_registered_on AT TIME ZONE 'UTC', 'YYYY-MM-DD') AS "registered_on",
+      UPPER(NULLIF(_state, '')) AS "state",
+      UPPER(NULLIF(_district, '')) AS "district",
+      UPPER(NULLIF(_ward, '')) AS "ward",
+      LOWER(NULLIF(_scheme, '')) AS "scheme"
+  ) c CROSS JOIN LATERAL (
+    VALUES
+      ('total-reporters'),
+      ('gender:' || c."gender"),
+      ('born:' || c."born"),
+      ('occupation:' || c."occupation"),
+      ('registered_on:' || c."registered_on"),
+      ('registered_gender:' || c."registered_on" || ':' || c."gender"),
+      ('registered_born:' || c."registered_on" || ':' || c."born"),
+      ('registered_state:' || c."registered_on" || ':' || c."state"),
+      ('registered_scheme:' || c."registered_on" || ':' || c."scheme"),
+      ('state:' || c."state"),
+      ('district:' || c."district"),
+      ('ward:' || c."ward"),
+      ('scheme:' || c."scheme")
+  ) AS t("type")
+  WHERE t."type" IS NOT NULL;
+$$ LANGUAGE sql STABLE;
+
+-----------------------------------------------------------------------------
+-- Updates our reporters counters once per statement, with one delta per org and counter type changed by the
+-- statement, counting only active contacts
+-----------------------------------------------------------------------------
+CREATE OR REPLACE FUNCTION ureport_update_counters_for_statement() RETURNS TRIGGER AS $$
+BEGIN
+  IF TG_OP = 'INSERT' THEN
+    INSERT INTO contacts_reporterscounter("org_id", "type", "count")
+    SELECT c."org_id", t."type", COUNT(*)
+    FROM new_contacts c
+    CROSS JOIN LATERAL ureport_contact_counter_types(c."gender", c."born", c."occupation", c."registered_on", c."state", c."district", c."ward", c."scheme") AS t("type")
+    WHERE c."org_id" IS NOT NULL AND c."is_active" = TRUE
+    GROUP BY c."org_id", t."type";
+
+  ELSIF TG_OP = 'UPDATE' THEN
+    INSERT INTO contacts_reporterscounter("org_id", "type", "count")
+    SELECT d."org_id", d."type", SUM(d."count")
+    FROM (
+      SELECT c."org_id", t."type", 1 AS "count"
+      FROM new_contacts c
+      CROSS JOIN LATERAL ureport_contact_counter_types(c."gender", c."born", c."occupation", c."registered_on", c."state", c."district", c."ward", c."scheme") AS t("type")
+      WHERE c."org_id" IS NOT NULL AND c."is_active" = TRUE
+      UNION ALL
+      SELECT c."org_id", t."type", -1 AS "count"
+      FROM old_contacts c
+      CROSS JOIN LATERAL ureport_contact_counter_types(c."gender", c."born", c."occupation", c."registered_on", c."state", c."district", c."ward", c."scheme") AS t("type")
+      WHERE c."org_id" IS NOT NULL AND c."is_active" = TRUE
+    ) d
+    GROUP BY d."org_id", d."type"
+    HAVING SUM(d."count") != 0;
+
+  ELSIF TG_OP = 'DELETE' THEN
+    INSERT INTO contacts_reporterscounter("org_id", "type", "count")
+    SELECT c."org_id", t."type", -COUNT(*)
+    FROM old_contacts c
+    CROSS JOIN LATERAL ureport_contact_counter_types(c."gender", c."born", c."occupation", c."registered_on", c."state", c."district", c."ward", c."scheme") AS t("type")
+    WHERE c."org_id" IS NOT NULL AND c."is_active" = TRUE
+    GROUP BY c."org_id", t."type";
+  END IF;
+  RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Replace the row triggers on contacts_contact by statement triggers, transition tables need a trigger per event
+DROP TRIGGER IF EXISTS ureport_when_contacts_update_then_update_counters ON contacts_contact;
+
+DROP TRIGGER IF EXISTS ureport_when_contacts_insert_then_update_counters ON contacts_contact;
+CREATE TRIGGER ureport_when_contacts_insert_then_update_counters
+  AFTER INSERT ON contacts_contact REFERENCING NEW TABLE AS new_contacts
+  FOR EACH STATEMENT EXECUTE PROCEDURE ureport_update_counters_for_statement();
+
+DROP TRIGGER IF EXISTS ureport_when_contacts_change_then_update_counters ON contacts_contact;
+CREATE TRIGGER ureport_when_contacts_change_then_update_counters
+  AFTER UPDATE ON contacts_contact REFERENCING OLD TABLE AS old_contacts NEW TABLE AS new_contacts
+  FOR EACH STATEMENT EXECUTE PROCEDURE ureport_update_counters_for_statement();
+
+DROP TRIGGER IF EXISTS ureport_when_contacts_delete_then_update_counters ON contacts_contact;
+CREATE TRIGGER ureport_when_contacts_delete_then_update_counters
+  AFTER DELETE ON contacts_contact REFERENCING OLD TABLE AS old_contacts
+  FOR EACH STATEMENT EXECUTE PROCEDURE ureport_update_counters_for_statement();
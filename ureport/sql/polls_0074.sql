@@ -0,0 +1,19 @@
+-----------------------------------------------------------------------------
+-- Clears the contact activities when the poll results are truncated, the activities of saved poll results are now
+-- generated by the sync for each batch of results
+-----------------------------------------------------------------------------
+CREATE OR REPLACE FUNCTION ureport_update_contact_activities() RETURNS TRIGGER AS $$
+BEGIN
+  IF TG_OP = 'TRUNCATE' THEN
+   -- Clear all contact_activities
+   TRUNCATE stats_contactactivity;
+  END IF;
+  RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Remove the row trigger generating the contact activities of each inserted or updated poll result
+DROP TRIGGER IF EXISTS ureport_when_poll_result_contact_activities ON polls_pollresult;
+
+DROP FUNCTION IF EXISTS generate_contact_activities_for_latest_poll_result(polls_pollresult);
+DROP FUNCTION IF EXISTS ureport_insert_missing_contact_activities(polls_pollresult);
@@ -0,0 +1,77 @@
+-----------------------------------------------------------------------------
+-- The activity counter types and values of a contact activity
+-----------------------------------------------------------------------------
+CREATE OR REPLACE FUNCTION
+  ureport_activity_counter_values(_date DATE, _born INT, _gender VARCHAR, _state VARCHAR, _scheme VARCHAR)
+RETURNS TABLE(counter_type VARCHAR, counter_value VARCHAR) AS $$
+  SELECT t."type", t."value" FROM (
+    VALUES
+      ('A'::VARCHAR, ''::VARCHAR),
+      ('B', (EXTRACT('year' FROM _date::date) - _born)::VARCHAR),
+      ('G', _gender),
+      ('L', _state),
+      ('S', _scheme)
+  ) AS t("type", "value")
+  WHERE t."value" IS NOT NULL;
+$$ LANGUAGE sql IMMUTABLE;
+
+-----------------------------------------------------------------------------
+-- Updates our activity counters once per statement, with one delta per org, date, type and value changed by the
+-- statement
+-----------------------------------------------------------------------------
+CREATE OR REPLACE FUNCTION ureport_update_activity_counters_for_statement() RETURNS TRIGGER AS $$
+BEGIN
+  IF TG_OP = 'INSERT' THEN
+    INSERT INTO stats_contactactivitycounter("org_id", "date", "type", "value", "count", "is_squashed")
+    SELECT a."org_id", a."date", t.counter_type, t.counter_value, COUNT(*), FALSE
+    FROM new_activities a
+    CROSS JOIN LATERAL ureport_activity_counter_values(a."date", a."born", a."gender", a."state", a."scheme") AS t
+    WHERE a."org_id" IS NOT NULL
+    GROUP BY a."org_id", a."date", t.counter_type, t.counter_value;
+
+  ELSIF TG_OP = 'UPDATE' THEN
+    INSERT INTO stats_contactactivitycounter("org_id", "date", "type", "value", "count", "is_squashed")
+    SELECT d."org_id", d."date", d.counter_type, d.counter_value, SUM(d."count"), FALSE
+    FROM (
+      SELECT a."org_id", a."date", t.counter_type, t.counter_value, 1 AS "count"
+      FROM new_activities a
+      CROSS JOIN LATERAL ureport_activity_counter_values(a."date", a."born", a."gender", a."state", a."scheme") AS t
+      WHERE a."org_id" IS NOT NULL
+      UNION ALL
+      SELECT a."org_id", a."date", t.counter_type, t.counter_value, -1 AS "count"
+      FROM old_activities a
+      CROSS JOIN LATERAL ureport_activity_counter_values(a."date", a."born", a."gender", a."state", a."scheme") AS t
+      WHERE a."org_id" IS NOT NULL
+    ) d
+    GROUP BY d."org_id", d."date", d.counter_type, d.counter_value
+    HAVING SUM(d."count") != 0;
+
+  ELSIF TG_OP = 'DELETE' THEN
+    INSERT INTO stats_contactactivitycounter("org_id", "date", "type", "value", "count", "is_squashed")
+    SELECT a."org_id", a."date", t.counter_type, t.counter_value, -COUNT(*), FALSE
+    FROM old_activities a
+    CROSS JOIN LATERAL ureport_activity_counter_values(a."date", a."born", a."gender", a."state", a."scheme") AS t
+    WHERE a."org_id" IS NOT NULL
+    GROUP BY a."org_id", a."date", t.counter_type, t.counter_value;
+  END IF;
+  RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Replace the row triggers on stats_contactactivity by statement triggers, transition tables need a trigger per event
+DROP TRIGGER IF EXISTS ureport_when_activity_update_then_update_activity_counters ON stats_contactactivity;
+
+DROP TRIGGER IF EXISTS ureport_when_activity_insert_then_update_activity_counters ON stats_contactactivity;
+CREATE TRIGGER ureport_when_activity_insert_then_update_activity_counters
+  AFTER INSERT ON stats_contactactivity REFERENCING NEW TABLE AS new_activities
+  FOR EACH STATEMENT EXECUTE PROCEDURE ureport_update_activity_counters_for_statement();
+
+DROP TRIGGER IF EXISTS ureport_when_activity_change_then_update_activity_counters ON stats_contactactivity;
+CREATE TRIGGER ureport_when_activity_change_then_update_activity_counters
+  AFTER UPDATE ON stats_contactactivity REFERENCING OLD TABLE AS old_activities NEW TABLE AS new_activities
+  FOR EACH STATEMENT EXECUTE PROCEDURE ureport_update_activity_counters_for_statement();
+
+DROP TRIGGER IF EXISTS ureport_when_activity_delete_then_update_activity_counters ON stats_contactactivity;
+CREATE TRIGGER ureport_when_activity_delete_then_update_activity_counters
+  AFTER DELETE ON stats_contactactivity REFERENCING OLD TABLE AS old_activities
+  FOR EACH STATEMENT EXECUTE PROCEDURE ureport_update_activity_counters_for_statement();
@@ -0,0 +1,11 @@
+from django.db import migrations
+
+from ureport.sql import InstallSQL
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("stats", "0028_activities_counter_triggers"),
+    ]
+
+    operations = [InstallSQL("stats_0029")]
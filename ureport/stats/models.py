@@ -1,8 +1,12 @@
 import logging
 import time
 from collections import defaultdict
-from datetime import timedelta
+from datetime import date, timedelta
+from pydoc import locate
 
+from django_redis import get_redis_connection
+
+from django.conf import settings
 from django.core.cache import cache
 from django.db import connection, models
 from django.db.models import IntegerField, JSONField, Q, Sum
@@ -737,6 +741,31 @@ class ContactActivity(models.Model):
         index_together = (("org", "contact"), ("org", "date"))
         unique_together = ("org", "contact", "date")
 
+    # adds the missing activities of the 12 months from the given first month of each contact
+    ADD_MISSING_ACTIVITIES_SQL = """
+        INSERT INTO stats_contactactivity("org_id", "contact", "date")
+        SELECT DISTINCT %(org_id)s, a."contact", m."date"::date
+        FROM UNNEST(%(contacts)s::varchar[], %(months)s::date[]) AS a("contact", "month")
+        CROSS JOIN LATERAL GENERATE_SERIES(
+          a."month"::timestamp, a."month"::timestamp + INTERVAL '11 months', INTERVAL '1 month'
+        ) AS m("date")
+        ON CONFLICT ("org_id", "contact", "date") DO NOTHING
+    """
+
+    # sets the given attributes of each contact on their activities of the last year which differ
+    UPDATE_ACTIVITIES_ATTRIBUTES_SQL = """
+        UPDATE stats_contactactivity a SET "born" = c."born", "gender" = c."gender", "state" = c."state",
+          "district" = c."district", "ward" = c."ward", "scheme" = c."scheme", "used" = TRUE
+        FROM UNNEST(
+          %(contacts)s::varchar[], %(born)s::integer[], %(gender)s::varchar[], %(state)s::varchar[],
+          %(district)s::varchar[], %(ward)s::varchar[], %(scheme)s::varchar[]
+        ) AS c("contact", "born", "gender", "state", "district", "ward", "scheme")
+        WHERE a."org_id" = %(org_id)s AND a."contact" = c."contact"
+          AND a."date" > DATE_TRUNC('month', CURRENT_DATE) - INTERVAL '1 year'
+          AND (a."born", a."gender", a."state", a."district", a."ward", a."scheme", a."used")
+            IS DISTINCT FROM (c."born", c."gender", c."state", c."district", c."ward", c."scheme", TRUE)
+    """
+
     def generate_counters(self):
         generated_counters = dict()
         if not self.org_id:
@@ -758,6 +787,60 @@ class ContactActivity(models.Model):
 
         return generated_counters
 
+    @classmethod
+    def update_for_poll_results(cls, org_id, poll_results):
+        """
+        Generates the activities of the contacts of a batch of saved poll results, adding the 12 months from the month
+        of each answered result and setting the attributes of the latest answered result of each contact on their
+        activities of the last year, with one statement each for the whole batch
+        """
+        contact_months = set()
+        latest_results = dict()
+        for result in poll_results:
+            if result.category is None or result.date is None:
+                continue
+
+            contact_months.add((result.contact, result.date.astimezone(timezone.utc).date().replace(day=1)))
+
+            latest_result = latest_results.get(result.contact)
+            if latest_result is None or result.date >= latest_result.date:
+                latest_results[result.contact] = result
+
+        if not contact_months:
+            return
+
+        contacts, months = zip(*sorted(contact_months))
+        with connection.cursor() as cursor:
+            cursor.execute(
+                cls.ADD_MISSING_ACTIVITIES_SQL, dict(org_id=org_id, contacts=list(contacts), months=list(months))
+            )
+
+        cls.update_contacts_attributes(
+            org_id,
+            [
+                (result.contact, result.born, result.gender, result.state, result.district, result.ward, result.scheme)
+                for result in latest_results.values()
+            ],
+        )
+
+    @classmethod
+    def update_contacts_attributes(cls, org_id, contacts_attributes):
+        """
+        Sets the given (contact, born, gender, state, district, ward, scheme) attributes on the activities of the last
+        year of their contacts
+        """
+        if not contacts_attributes:
+            return 0
+
+        columns = list(zip(*contacts_attributes))
+        params = dict(org_id=org_id)
+        for name, values in zip(("contacts", "born", "gender", "state", "district", "ward", "scheme"), columns):
+            params[name] = list(values)
+
+        with connection.cursor() as cursor:
+            cursor.execute(cls.UPDATE_ACTIVITIES_ATTRIBUTES_SQL, params)
+            return cursor.rowcount
+
     @classmethod
     def recalculate_contact_activity_counts(cls, org):
         from ureport.utils import chunk_list
@@ -822,14 +905,47 @@ class ContactActivity(models.Model):
 
         return dict(data)
 
+    @classmethod
+    def get_activity_sketch_data(cls, org, time_filter, counter_type, values):
+        from ureport.utils import get_time_filter_dates_map
+
+        dates_map = get_time_filter_dates_map(time_filter=time_filter)
+        keys = list(set(dates_map.values()))
+
+        months = sorted({date.fromisoformat(key[:-2] + "01") for key in keys})
+        counts = ContactActivitySketch.count(org.id, months, counter_type, values)
+
+        data = dict()
+        for key in keys:
+            data[key] = counts[date.fromisoformat(key[:-2] + "01")]
+
+        return data
+
+    @classmethod
+    def use_sketches(cls):
+        return getattr(settings, "CONTACT_ACTIVITY_SKETCHES", False)
+
+    @classmethod
+    def count_from_sketches(cls, org):
+        """
+        Whether the active users stats of the org are estimated from the sketches rather than read from the counters,
+        only once the sketches hold all its activity
+        """
+        return cls.use_sketches() and ContactActivitySketch.is_complete(org)
+
     @classmethod
     def get_activity(cls, org, time_filter):
         now = timezone.now()
         today = now.date()
         year_ago = now - timedelta(days=365)
         start = year_ago.replace(day=1).date()
+        count_from_sketches = cls.count_from_sketches(org)
         translation.activate(org.language)
 
+        if count_from_sketches:
+            series = ContactActivity.get_activity_sketch_data(org, time_filter, ContactActivityCounter.TYPE_ALL, [""])
+            return [dict(name=str(_("Active Users")), data=series)]
+
         activities = (
             ContactActivityCounter.objects.filter(
                 org=org, type=ContactActivityCounter.TYPE_ALL, date__lte=today, date__gte=start
@@ -845,6 +961,7 @@ class ContactActivity(models.Model):
         today = now.date()
         year_ago = now - timedelta(days=365)
         start = year_ago.replace(day=1).date()
+        count_from_sketches = cls.count_from_sketches(org)
 
         ages = AgeSegment.objects.all().values("id", "min_age", "max_age")
         output_data = []
@@ -862,6 +979,13 @@ class ContactActivity(models.Model):
             elif age["min_age"] == 35:
                 data_key = "35+"
 
+            if count_from_sketches:
+                series = ContactActivity.get_activity_sketch_data(
+                    org, time_filter, ContactActivityCounter.TYPE_AGE, [age["min_age"]]
+                )
+                output_data.append(dict(name=data_key, data=series))
+                continue
+
             activities = (
                 ContactActivityCounter.objects.filter(
                     org=org, type=ContactActivityCounter.TYPE_AGE, date__lte=today, date__gte=start
@@ -881,6 +1005,7 @@ class ContactActivity(models.Model):
         today = now.date()
         year_ago = now - timedelta(days=365)
         start = year_ago.replace(day=1).date()
+        count_from_sketches = cls.count_from_sketches(org)
         org_gender_labels = org.get_gender_labels()
 
         genders = GenderSegment.objects.all()
@@ -891,6 +1016,13 @@ class ContactActivity(models.Model):
 
         output_data = []
         for gender in genders:
+            if count_from_sketches:
+                series = ContactActivity.get_activity_sketch_data(
+                    org, time_filter, ContactActivityCounter.TYPE_GENDER, [gender["gender"].lower()]
+                )
+                output_data.append(dict(name=org_gender_labels.get(gender["gender"]), data=series))
+                continue
+
             activities = (
                 ContactActivityCounter.objects.filter(
                     org=org,
@@ -913,10 +1045,18 @@ class ContactActivity(models.Model):
         today = now.date()
         year_ago = now - timedelta(days=365)
         start = year_ago.replace(day=1).date()
+        count_from_sketches = cls.count_from_sketches(org)
 
         top_boundaries = Boundary.get_org_top_level_boundaries_name(org)
         output_data = []
         for osm_id, name in top_boundaries.items():
+            if count_from_sketches:
+                series = ContactActivity.get_activity_sketch_data(
+                    org, time_filter, ContactActivityCounter.TYPE_LOCATION, [osm_id.lower()]
+                )
+                output_data.append(dict(name=name, osm_id=osm_id, data=series))
+                continue
+
             activities = (
                 ContactActivityCounter.objects.filter(
                     org=org,
@@ -938,24 +1078,30 @@ class ContactActivity(models.Model):
         today = now.date()
         year_ago = now - timedelta(days=365)
         start = year_ago.replace(day=1).date()
+        count_from_sketches = cls.count_from_sketches(org)
 
         org_contacts_counts = org.get_org_contacts_counts()
         schemes = [k[7:] for k, v in org_contacts_counts.items() if k.startswith("scheme:") if k[7:]]
 
         output_data = []
         for scheme in schemes:
-            activities = (
-                ContactActivityCounter.objects.filter(
-                    org=org,
-                    type=ContactActivityCounter.TYPE_SCHEME,
-                    date__lte=today,
-                    date__gte=start,
-                    value__iexact=scheme,
+            if count_from_sketches:
+                series = ContactActivity.get_activity_sketch_data(
+                    org, time_filter, ContactActivityCounter.TYPE_SCHEME, [scheme.lower()]
                 )
-                .values("date")
-                .annotate(Sum("count"))
-            )
-            series = ContactActivity.get_activity_data(activities, time_filter)
+            else:
+                activities = (
+                    ContactActivityCounter.objects.filter(
+                        org=org,
+                        type=ContactActivityCounter.TYPE_SCHEME,
+                        date__lte=today,
+                        date__gte=start,
+                        value__iexact=scheme,
+                    )
+                    .values("date")
+                    .annotate(Sum("count"))
+                )
+                series = ContactActivity.get_activity_data(activities, time_filter)
 
             name = SchemeSegment.SCHEME_DISPLAY.get(scheme, scheme.upper())
             if not name:
@@ -1017,6 +1163,145 @@ class ContactActivityCounter(SquashableModel):
         ]
 
 
+class ContactActivitySketch(object):
+    """
+    HyperLogLog sketches of the contacts active per org, month and counter segment, kept in redis as an alternative
+    to the contact activities and their counters. Adding a result costs one PFADD per segment and month, whatever the
+    number of contacts, and a month segment is counted with one PFCOUNT, an estimate within about 1% of the exact count
+    """
+
+    KEY = "contact-activity-sketch:%d:%s:%s:%s"
+
+    # set once the sketches of an org were filled from its existing contact activities
+    BACKFILLED_KEY = "contact-activity-sketch-backfilled:%d"
+
+    # a result keeps its contact active for the month it was given and the 11 following months
+    ACTIVE_MONTHS = 12
+
+    # sketches are kept a year past the last month of activity they could be read for
+    TIMEOUT = 60 * 60 * 24 * 31 * 25
+
+    @classmethod
+    def get_key(cls, org_id, month, counter_type, value):
+        return cls.KEY % (org_id, month.isoformat(), counter_type, value)
+
+    @classmethod
+    def get_months(cls, first_month):
+        months = []
+        for i in range(cls.ACTIVE_MONTHS):
+            month_index = first_month.month - 1 + i
+            months.append(date(first_month.year + month_index // 12, month_index % 12 + 1, 1))
+        return months
+
+    @classmethod
+    def get_segments(cls, month, born, gender, state, scheme):
+        segments = [(ContactActivityCounter.TYPE_ALL, "")]
+
+        if born and month.year - born >= 0:
+            segments.append((ContactActivityCounter.TYPE_AGE, AgeSegment.get_age_segment_min_age(month.year - born)))
+
+        if gender:
+            segments.append((ContactActivityCounter.TYPE_GENDER, gender.lower()))
+
+        if state:
+            segments.append((ContactActivityCounter.TYPE_LOCATION, state.lower()))
+
+        if scheme:
+            segments.append((ContactActivityCounter.TYPE_SCHEME, scheme.lower()))
+
+        return segments
+
+    @classmethod
+    def add(cls, org_id, activities):
+        """
+        Adds the contacts of the given (contact, month, born, gender, state, scheme) activities to their sketches
+        """
+        members_by_key = defaultdict(set)
+        for contact, month, born, gender, state, scheme in activities:
+            for counter_type, value in cls.get_segments(month, born, gender, state, scheme):
+                members_by_key[cls.get_key(org_id, month, counter_type, value)].add(contact)
+
+        if not members_by_key:
+            return
+
+        r = get_redis_connection()
+        pipe = r.pipeline(transaction=False)
+        for key, members in members_by_key.items():
+            pipe.pfadd(key, *members)
+            pipe.expire(key, cls.TIMEOUT)
+        pipe.execute()
+
+    @classmethod
+    def add_poll_results(cls, org_id, poll_results):
+        """
+        Adds the contacts of the given answered poll results to the sketches of the months they keep them active
+        """
+        activities = []
+        for result in poll_results:
+            if result.category is None or result.date is None:
+                continue
+
+            first_month = result.date.astimezone(timezone.utc).date().replace(day=1)
+            for month in cls.get_months(first_month):
+                activities.append((result.contact, month, result.born, result.gender, result.state, result.scheme))
+
+        cls.add(org_id, activities)
+
+    @classmethod
+    def add_contact_activities(cls, org, batch_size=5000):
+        """
+        Fills the sketches of an org from its existing contact activities
+        """
+        activities = ContactActivity.objects.filter(org=org).order_by("id")
+        max_id = 0
+        while True:
+            batch = list(
+                activities.filter(id__gt=max_id).values_list(
+                    "id", "contact", "date", "born", "gender", "state", "scheme"
+                )[:batch_size]
+            )
+            if not batch:
+                break
+
+            cls.add(org.id, [activity[1:] for activity in batch])
+            max_id = batch[-1][0]
+
+        get_redis_connection().set(cls.BACKFILLED_KEY % org.id, 1)
+
+    @classmethod
+    def is_backfilled(cls, org):
+        return bool(get_redis_connection().exists(cls.BACKFILLED_KEY % org.id))
+
+    @classmethod
+    def is_fed(cls, org):
+        """
+        Whether every active backend of the org adds the results it syncs to the sketches, backends which cannot be
+        loaded sync nothing
+        """
+        backend_types = org.backends.filter(is_active=True).values_list("backend_type", flat=True)
+        backend_classes = [locate(backend_type) for backend_type in backend_types if backend_type]
+        return all(backend_class.feeds_activity_sketches for backend_class in backend_classes if backend_class)
+
+    @classmethod
+    def is_complete(cls, org):
+        """
+        Whether the sketches of an org hold all its activity, they must have been backfilled and be fed since
+        """
+        return cls.is_backfilled(org) and cls.is_fed(org)
+
+    @classmethod
+    def count(cls, org_id, months, counter_type, values):
+        """
+        Estimates the contacts active in each of the given months for any of the given values of a counter type
+        """
+        r = get_redis_connection()
+        pipe = r.pipeline(transaction=False)
+        for month in months:
+            pipe.pfcount(*[cls.get_key(org_id, month, counter_type, value) for value in values])
+
+        return dict(zip(months, pipe.execute()))
+
+
 class PollWordCloud(models.Model):
     org = models.ForeignKey(Org, on_delete=models.PROTECT)
 
@@ -101,3 +101,25 @@ def rebuild_contacts_activities_counts():
         logger.info(
             f"Task: rebuild_contacts_activities_counts finished recalculating contact activity and refreshing contacts activities engagement stats for org {org.id} in {time.time() - start_rebuild}s"
         )
+
+
+@app.task(name="stats.backfill_contact_activity_sketches")
+def backfill_contact_activity_sketches():
+    from .models import ContactActivity, ContactActivitySketch
+
+    if not ContactActivity.use_sketches():
+        return
+
+    orgs = Org.objects.filter(is_active=True)
+    for org in orgs:
+        # orgs with backends not feeding the sketches keep reading their counters, and backfilled orgs are done
+        if not ContactActivitySketch.is_fed(org) or ContactActivitySketch.is_backfilled(org):
+            continue
+
+        start = time.time()
+
+        # the active users stats of the org are estimated from its sketches from now on
+        ContactActivitySketch.add_contact_activities(org)
+        logger.info(
+            f"Task: backfill_contact_activity_sketches finished adding the contact activities of org {org.id} to its sketches in {time.time() - start}s"
+        )
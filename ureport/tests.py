@@ -1,6 +1,7 @@
 # -*- coding: utf-8 -*-
 from __future__ import absolute_import, division, print_function, unicode_literals
 
+import io
 import json
 import uuid
 import zoneinfo
@@ -22,7 +23,7 @@ from django.http.request import HttpRequest
 from django.test import override_settings
 from django.urls import reverse
 from django.utils import timezone
-from django.utils.encoding import force_str
+from django.utils.encoding import force_bytes, force_str
 
 from dash.orgs.middleware import SetOrgMiddleware
 from dash.orgs.models import Org
@@ -124,6 +125,7 @@ class TestBackend(RapidProBackend):
 class MockResponse(object):
     def __init__(self, status_code, content=""):
         self.content = content
+        self.raw = io.BytesIO(force_bytes(content))
         self.status_code = status_code
 
     def raise_for_status(self):
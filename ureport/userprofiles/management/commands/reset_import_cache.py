@@ -40,6 +40,9 @@ class Command(BaseCommand):
             for backend_obj in backends:
                 last_fetch_date_key = Contact.CONTACT_LAST_FETCHED_CACHE_KEY % (org.pk, backend_obj.slug)
                 cache.delete(last_fetch_date_key, None)
+
+                checkpoint_key = Contact.CONTACT_PULL_CHECKPOINT_CACHE_KEY % (org.pk, backend_obj.slug)
+                cache.delete(checkpoint_key)
             logger.info("Reset the contacts import cache for org: %s", org)
 
 
@@ -1,12 +1,15 @@
 # -*- coding: utf-8 -*-
 from __future__ import absolute_import, division, print_function, unicode_literals
 
+import hashlib
 import json
 import logging
+import math
+import queue
+import threading
 import time
-import zoneinfo
 from collections import defaultdict
-from datetime import datetime, timedelta
+from datetime import date, datetime, timedelta
 from itertools import chain, islice
 
 import iso8601
@@ -15,6 +18,7 @@ from sentry_sdk import capture_exception
 
 from django.conf import settings
 from django.core.cache import cache
+from django.db import connection
 from django.db.models import Sum
 from django.utils import timezone, translation
 
@@ -23,11 +27,11 @@ from dash.utils import datetime_to_ms
 from ureport.assets.models import LOGO, Image
 from ureport.locations.models import Boundary
 from ureport.polls.models import Poll, PollResult
-from ureport.stats.models import AgeSegment, GenderSegment, PollStats, SchemeSegment
 
 GLOBAL_COUNT_CACHE_KEY = "global_count"
 
 ORG_CONTACT_COUNT_KEY = "org:%d:contacts-counts"
+ORG_CONTACT_COUNT_SNAPSHOT_KEY = "org:%d:contacts-counts-snapshot"
 ORG_CONTACT_COUNT_TIMEOUT = 3600
 
 logger = logging.getLogger(__name__)
@@ -101,6 +105,13 @@ def get_time_filter_dates_map(time_filter=12):
     return keys_map
 
 
+def get_time_filter_ordinals_map(time_filter=12):
+    """
+    Same as get_time_filter_dates_map but keyed by the ordinals of the dates
+    """
+    return {date.fromisoformat(k).toordinal(): v for k, v in get_time_filter_dates_map(time_filter).items()}
+
+
 def get_dict_from_cursor(cursor):
     """
     Returns all rows from a cursor as a dict
@@ -123,6 +134,145 @@ def chunk_list(iterable, size):
             return
 
 
+class BloomFilter(object):
+    """
+    Compact probabilistic set of strings. Membership tests have no false negatives, and about error_rate
+    false positives once capacity items have been added.
+    """
+
+    def __init__(self, capacity, error_rate=0.01):
+        capacity = max(capacity, 1)
+        self.num_bits = max(8, int(math.ceil(-capacity * math.log(error_rate) / (math.log(2) ** 2))))
+        self.num_hashes = max(1, int(round(self.num_bits / capacity * math.log(2))))
+        self.bits = bytearray((self.num_bits + 7) // 8)
+
+    def _positions(self, item):
+        digest = hashlib.blake2b(item.encode("utf-8"), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        return [(h1 + i * h2) % self.num_bits for i in range(self.num_hashes)]
+
+    def add(self, item):
+        for position in self._positions(item):
+            self.bits[position >> 3] |= 1 << (position & 7)
+
+    def update(self, items):
+        for item in items:
+            self.add(item)
+
+    def __contains__(self, item):
+        return all(self.bits[position >> 3] & (1 << (position & 7)) for position in self._positions(item))
+
+
+def prefetch_iter(iterable, size=2):
+    """
+    Iterates over the iterable in a background thread, keeping up to size items ready ahead of the consumer.
+    Exceptions raised by the iterable, even the ones not deriving from Exception like a task time limit, are
+    re-raised in the consumer, and closing the returned generator stops the background thread once its current
+    item is done.
+    """
+    if size <= 0:
+        yield from iterable
+        return
+
+    items = queue.Queue(maxsize=size)
+    stopped = threading.Event()
+    finished = object()
+
+    def put(item, error=None):
+        while not stopped.is_set():
+            try:
+                items.put((item, error), timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for item in iterable:
+                if not put(item):
+                    return
+        except BaseException as e:
+            # the consumer would otherwise wait forever for the next item
+            put(None, e)
+        else:
+            put(finished)
+
+    producer = threading.Thread(target=produce, daemon=True)
+    producer.start()
+
+    try:
+        while True:
+            item, error = items.get()
+            if error is not None:
+                raise error
+            if item is finished:
+                return
+            yield item
+    finally:
+        stopped.set()
+
+
+def get_http_session(pool_size=None, retries=0):
+    """
+    Gets a requests session keeping up to pool_size connections alive per host, so that concurrent fetches to
+    the same sites reuse their connections instead of opening a new one for each request. GET requests failing
+    to connect or getting a throttling or server error are retried up to retries times with an exponential backoff.
+    """
+    import requests
+    from requests.adapters import HTTPAdapter
+    from urllib3.util.retry import Retry
+
+    pool_size = pool_size or getattr(settings, "HTTP_FETCH_WORKERS", 8)
+
+    max_retries = Retry(
+        total=retries,
+        backoff_factor=0.5,
+        status_forcelist=(429, 500, 502, 503, 504),
+        allowed_methods=("GET",),
+        respect_retry_after_header=True,
+    )
+
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=max_retries)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def map_concurrently(func, items, max_workers=None):
+    """
+    Calls func with each of the items from a pool of threads, returning a list of (result, error) pairs in the
+    order of the items. A failing item doesn't stop the others, its exception is returned as its error instead.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    from django.db import connections
+
+    items = list(items)
+    max_workers = min(max_workers or getattr(settings, "HTTP_FETCH_WORKERS", 8), len(items))
+
+    def call(item):
+        try:
+            return func(item), None
+        except Exception as e:
+            return None, e
+
+    if max_workers <= 1:
+        return [call(item) for item in items]
+
+    def call_in_thread(item):
+        try:
+            return call(item)
+        finally:
+            # worker threads get their own database connections which would otherwise be left open
+            connections.close_all()
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return list(executor.map(call_in_thread, items))
+
+
 def get_logo(org):
     if hasattr(org, "_logo_field"):
         return org._logo_field
@@ -181,12 +331,39 @@ def get_flows(org, backend):
 
 
 def update_poll_flow_data(org):
+    from ureport.polls.models import CACHE_ORG_FLOWS_CHECKED_HASH_KEY, UREPORT_ASYNC_FETCHED_DATA_CACHE_TIME
+
+    updated_polls = []
+    checked_hashes = dict()
+
     backends = org.backends.filter(is_active=True)
     for backend_obj in backends:
         flows = get_flows(org, backend_obj)
 
         if flows:
-            org_polls = Poll.objects.filter(org=org, backend=backend_obj)
+            org_polls = list(Poll.objects.filter(org=org, backend=backend_obj).order_by("pk"))
+
+            # skip the backend if the flow data compared below and the polls it is compared against are unchanged
+            # since they were last checked, polls are modified by every sync so only their compared fields count
+            compared = [
+                (
+                    poll.pk,
+                    poll.flow_uuid,
+                    poll.flow_archived,
+                    poll.runs_count,
+                    flows.get(poll.flow_uuid, dict()).get("archived", False),
+                    flows.get(poll.flow_uuid, dict()).get("runs", 0),
+                )
+                for poll in org_polls
+            ]
+            flows_hash = hashlib.blake2b(json.dumps(compared, default=str).encode("utf-8"), digest_size=16).hexdigest()
+
+            hash_key = CACHE_ORG_FLOWS_CHECKED_HASH_KEY % (org.pk, backend_obj.slug)
+            if cache.get(hash_key) == flows_hash:
+                continue
+
+            checked_hashes[hash_key] = flows_hash
+
             for poll in org_polls:
                 flow = flows.get(poll.flow_uuid, dict())
 
@@ -196,16 +373,24 @@ def update_poll_flow_data(org):
                     if not runs_count:
                         runs_count = 0
 
-                    updated_fields = dict()
+                    updated = False
 
                     if archived != poll.flow_archived:
-                        updated_fields["flow_archived"] = archived
+                        poll.flow_archived = archived
+                        updated = True
 
                     if runs_count > 0 and runs_count != poll.runs_count:
-                        updated_fields["runs_count"] = runs_count
+                        poll.runs_count = runs_count
+                        updated = True
+
+                    if updated:
+                        updated_polls.append(poll)
+
+    if updated_polls:
+        Poll.objects.bulk_update(updated_polls, ["flow_archived", "runs_count"])
 
-                    if updated_fields:
-                        Poll.objects.filter(pk=poll.pk).update(**updated_fields)
+    for hash_key, flows_hash in checked_hashes.items():
+        cache.set(hash_key, flows_hash, UREPORT_ASYNC_FETCHED_DATA_CACHE_TIME)
 
 
 def fetch_shared_sites_count():
@@ -258,30 +443,32 @@ def get_linked_orgs(authenticated=False):
 def fetch_old_sites_count():
     import re
 
-    import requests
-
     start = time.time()
     this_time = datetime.now()
     linked_sites = list(getattr(settings, "COUNTRY_FLAGS_SITES", []))
+    timeout = getattr(settings, "HTTP_FETCH_TIMEOUT", 30)
 
-    old_site_values = []
+    count_sites = [site for site in linked_sites if site.get("count_link", "")]
 
-    for site in linked_sites:
-        count_link = site.get("count_link", "")
-        if count_link:
-            try:
-                response = requests.get(count_link)
-                response.raise_for_status()
+    def fetch_count(session, site):
+        response = session.get(site.get("count_link"), timeout=timeout)
+        response.raise_for_status()
+        return int(re.search(r"\d+", response.content.decode("utf-8")).group())
 
-                count = int(re.search(r"\d+", response.content.decode("utf-8")).group())
-                key = "org:%s:reporters:%s" % (site.get("name").lower(), "old-site")
-                value = {"time": datetime_to_ms(this_time), "results": dict(size=count)}
-                old_site_values.append(value)
-                cache.set(key, value, None)
-            except Exception:
-                import traceback
+    with get_http_session() as session:
+        fetched = map_concurrently(lambda site: fetch_count(session, site), count_sites)
+
+    old_site_values = []
+
+    for site, (count, error) in zip(count_sites, fetched):
+        if error is not None:
+            logger.error("Fetching count from %s failed: %s" % (site.get("count_link"), error))
+            continue
 
-                traceback.print_exc()
+        key = "org:%s:reporters:%s" % (site.get("name").lower(), "old-site")
+        value = {"time": datetime_to_ms(this_time), "results": dict(size=count)}
+        old_site_values.append(value)
+        cache.set(key, value, None)
 
     # delete the global count cache to force a recalculate at the end
     cache.delete(GLOBAL_COUNT_CACHE_KEY)
@@ -340,10 +527,91 @@ def update_cache_org_contact_counts(org):
     key = ORG_CONTACT_COUNT_KEY % org.pk
     org_contacts_counts = ReportersCounter.get_counts(org)
     cache.set(key, org_contacts_counts, None)
+    cache.set(ORG_CONTACT_COUNT_SNAPSHOT_KEY % org.pk, build_org_contacts_counts_snapshot(org_contacts_counts), None)
     return org_contacts_counts
 
 
+def _parse_date_ordinal(date_str):
+    try:
+        return date.fromisoformat(date_str).toordinal()
+    except ValueError:
+        return None
+
+
+def _parse_int(value):
+    try:
+        return int(value)
+    except ValueError:
+        return None
+
+
+def build_org_contacts_counts_snapshot(org_contacts_counts):
+    """
+    Splits the flat contacts counts of an org by dimension, with the registration dates as date ordinals and the
+    birth years as ints, so the stats only read the counts they need without parsing the counter types
+    """
+    snapshot = dict(
+        born=defaultdict(int),
+        occupation=dict(),
+        state=dict(),
+        district=dict(),
+        ward=dict(),
+        scheme=dict(),
+        registered_on=defaultdict(int),
+        registered_state=defaultdict(lambda: defaultdict(int)),
+        registered_gender=defaultdict(lambda: defaultdict(int)),
+        registered_born=defaultdict(lambda: defaultdict(int)),
+        registered_scheme=defaultdict(lambda: defaultdict(int)),
+    )
+
+    for counter_type, count in org_contacts_counts.items():
+        dimension, _, value = counter_type.partition(":")
+
+        if dimension in ("occupation", "state", "district", "ward", "scheme"):
+            snapshot[dimension][value] = count
+
+        elif dimension == "born":
+            # only four digits years are ages we can chart
+            year = _parse_int(value) if len(value) == 4 else None
+            if year is not None:
+                snapshot["born"][year] += count
+
+        elif dimension == "registered_on":
+            ordinal = _parse_date_ordinal(value)
+            if ordinal is not None:
+                snapshot["registered_on"][ordinal] += count
+
+        elif dimension in ("registered_state", "registered_gender", "registered_born", "registered_scheme"):
+            date_str, _, segment = value.partition(":")
+            ordinal = _parse_date_ordinal(date_str)
+            if dimension == "registered_born":
+                segment = _parse_int(segment)
+
+            if ordinal is not None and segment is not None:
+                snapshot[dimension][segment][ordinal] += count
+
+    # store plain dicts, defaultdicts of lambdas can not be pickled
+    return {
+        dimension: {k: dict(v) if isinstance(v, dict) else v for k, v in values.items()}
+        for dimension, values in snapshot.items()
+    }
+
+
+def get_org_contacts_counts_snapshot(org):
+    key = ORG_CONTACT_COUNT_SNAPSHOT_KEY % org.pk
+    snapshot = cache.get(key, None)
+
+    # an empty snapshot is a miss, like the empty contacts counts it was built from
+    if not snapshot or not any(snapshot.values()):
+        snapshot = build_org_contacts_counts_snapshot(get_org_contacts_counts(org))
+        cache.set(key, snapshot, None)
+
+    return snapshot
+
+
 def get_gender_labels(org):
+    from ureport.stats.models import GenderSegment
+
     translation.activate(org.language)
     return {k: str(v) for k, v in GenderSegment.GENDERS.items()}
 
@@ -394,9 +662,7 @@ def get_age_stats(org):
     now = timezone.now()
     current_year = now.year
 
-    org_contacts_counts = get_org_contacts_counts(org)
-
-    year_counts = {k[-4:]: v for k, v in org_contacts_counts.items() if k.startswith("born:") and len(k) == 9}
+    year_counts = get_org_contacts_counts_snapshot(org)["born"]
 
     age_counts_interval = dict()
     age_counts_interval["0-14"] = 0
@@ -407,9 +673,9 @@ def get_age_stats(org):
     age_counts_interval["35+"] = 0
 
     total = 0
-    for year_key, age_count in year_counts.items():
+    for year, age_count in year_counts.items():
         total += age_count
-        age = current_year - int(year_key)
+        age = current_year - year
         if age > 34:
             age_counts_interval["35+"] += age_count
         elif age > 30:
@@ -436,10 +702,9 @@ def get_age_stats(org):
 
 
 def get_schemes_stats(org):
-    org_contacts_counts = get_org_contacts_counts(org)
-    schemes_counts = {
-        k[7:]: v for k, v in org_contacts_counts.items() if k.startswith("scheme:") if k[7:] and k[7:] != "ext"
-    }
+    from ureport.stats.models import SchemeSegment
+
+    schemes_counts = {k: v for k, v in get_org_contacts_counts_snapshot(org)["scheme"].items() if k and k != "ext"}
 
     total = 0
     schemes_stats_data = defaultdict(int)
@@ -478,25 +743,18 @@ def get_schemes_stats(org):
 def get_sign_up_rate(org, time_filter):
     now = timezone.now()
     year_ago = now - timedelta(days=365)
-    start = year_ago.replace(day=1)
-    tz = zoneinfo.ZoneInfo("UTC")
-
-    org_contacts_counts = get_org_contacts_counts(org)
+    start = year_ago.replace(day=1).date().toordinal()
 
-    registered_on_counts = {k[14:]: v for k, v in org_contacts_counts.items() if k.startswith("registered_on")}
+    registered_on_counts = get_org_contacts_counts_snapshot(org)["registered_on"]
 
     interval_dict = defaultdict(int)
 
-    dates_map = get_time_filter_dates_map(time_filter=time_filter)
+    dates_map = get_time_filter_ordinals_map(time_filter=time_filter)
     keys = list(set(dates_map.values()))
 
-    for date_key, date_count in registered_on_counts.items():
-        parsed_time = datetime.strptime(date_key, "%Y-%m-%d").replace(
-            hour=0, minute=0, second=0, microsecond=0, tzinfo=tz
-        )
-
-        if parsed_time > start:
-            key = dates_map.get(str(parsed_time.date()))
+    for date_ordinal, date_count in registered_on_counts.items():
+        if date_ordinal > start:
+            key = dates_map.get(date_ordinal)
 
             interval_dict[key] += date_count
 
@@ -510,34 +768,22 @@ def get_sign_up_rate(org, time_filter):
 def get_sign_up_rate_location(org, time_filter):
     now = timezone.now()
     year_ago = now - timedelta(days=365)
-    start = year_ago.replace(day=1)
-    tz = zoneinfo.ZoneInfo("UTC")
-
-    org_contacts_counts = get_org_contacts_counts(org)
+    start = year_ago.replace(day=1).date().toordinal()
 
-    registered_on_counts = {k[17:]: v for k, v in org_contacts_counts.items() if k.startswith("registered_state")}
+    registered_on_counts = get_org_contacts_counts_snapshot(org)["registered_state"]
 
     top_boundaries = Boundary.get_org_top_level_boundaries_name(org)
 
-    dates_map = get_time_filter_dates_map(time_filter=time_filter)
+    dates_map = get_time_filter_ordinals_map(time_filter=time_filter)
     keys = list(set(dates_map.values()))
 
     output_data = []
 
     for osm_id, name in top_boundaries.items():
         interval_dict = defaultdict(int)
-        for date_key, date_count in registered_on_counts.items():
-            if date_key.endswith(f":{osm_id.upper()}"):
-                date_key = date_key[:10]
-            else:
-                continue
-
-            parsed_time = datetime.strptime(date_key, "%Y-%m-%d").replace(
-                hour=0, minute=0, second=0, microsecond=0, tzinfo=tz
-            )
-
-            if parsed_time > start:
-                key = dates_map.get(str(parsed_time.date()))
+        for date_ordinal, date_count in registered_on_counts.get(osm_id.upper(), {}).items():
+            if date_ordinal > start:
+                key = dates_map.get(date_ordinal)
                 interval_dict[key] += date_count
 
         data = dict()
@@ -548,16 +794,15 @@ def get_sign_up_rate_location(org, time_filter):
 
 
 def get_sign_up_rate_gender(org, time_filter):
+    from ureport.stats.models import GenderSegment
+
     now = timezone.now()
     year_ago = now - timedelta(days=365)
-    start = year_ago.replace(day=1)
-    tz = zoneinfo.ZoneInfo("UTC")
+    start = year_ago.replace(day=1).date().toordinal()
 
     org_gender_labels = org.get_gender_labels()
 
-    org_contacts_counts = get_org_contacts_counts(org)
-
-    registered_on_counts = {k[18:]: v for k, v in org_contacts_counts.items() if k.startswith("registered_gender")}
+    registered_on_counts = get_org_contacts_counts_snapshot(org)["registered_gender"]
 
     genders = GenderSegment.objects.all()
     if not org.get_config("common.has_extra_gender"):
@@ -565,24 +810,15 @@ def get_sign_up_rate_gender(org, time_filter):
 
     genders = genders.values("gender", "id")
 
-    dates_map = get_time_filter_dates_map(time_filter=time_filter)
+    dates_map = get_time_filter_ordinals_map(time_filter=time_filter)
     keys = list(set(dates_map.values()))
     output_data = []
 
     for gender in genders:
         interval_dict = defaultdict(int)
-        for date_key, date_count in registered_on_counts.items():
-            if date_key.endswith(f":{gender['gender'].lower()}"):
-                date_key = date_key[:-2]
-            else:
-                continue
-
-            parsed_time = datetime.strptime(date_key, "%Y-%m-%d").replace(
-                hour=0, minute=0, second=0, microsecond=0, tzinfo=tz
-            )
-
-            if parsed_time > start:
-                key = dates_map.get(str(parsed_time.date()))
+        for date_ordinal, date_count in registered_on_counts.get(gender["gender"].lower(), {}).items():
+            if date_ordinal > start:
+                key = dates_map.get(date_ordinal)
                 interval_dict[key] += date_count
 
         data = dict()
@@ -593,15 +829,14 @@ def get_sign_up_rate_gender(org, time_filter):
 
 
 def get_sign_up_rate_age(org, time_filter):
+    from ureport.stats.models import AgeSegment
+
     now = timezone.now()
     current_year = now.year
     year_ago = now - timedelta(days=365)
-    start = year_ago.replace(day=1)
-    tz = zoneinfo.ZoneInfo("UTC")
-
-    org_contacts_counts = get_org_contacts_counts(org)
+    start = year_ago.replace(day=1).date().toordinal()
 
-    registered_on_counts = {k[16:]: v for k, v in org_contacts_counts.items() if k.startswith("registered_born")}
+    registered_on_counts = get_org_contacts_counts_snapshot(org)["registered_born"]
     registered_on_counts_by_age = {
         "0-14": defaultdict(int),
         "15-19": defaultdict(int),
@@ -611,32 +846,27 @@ def get_sign_up_rate_age(org, time_filter):
         "35+": defaultdict(int),
     }
 
-    dates_map = get_time_filter_dates_map(time_filter=time_filter)
+    dates_map = get_time_filter_ordinals_map(time_filter=time_filter)
     keys = list(set(dates_map.values()))
 
-    for date_key, date_count in registered_on_counts.items():
-        date_key_date, date_key_year = date_key.split(":")
-        parsed_time = datetime.strptime(date_key_date, "%Y-%m-%d").replace(
-            hour=0, minute=0, second=0, microsecond=0, tzinfo=tz
-        )
-        if parsed_time < start:
-            continue
-
-        date_key_date = dates_map.get(str(parsed_time.date()))
-
-        age = current_year - int(date_key_year)
+    for year, year_counts in registered_on_counts.items():
+        age = current_year - year
         if age > 34:
-            registered_on_counts_by_age["35+"][date_key_date] += date_count
+            age_counts = registered_on_counts_by_age["35+"]
         elif age > 30:
-            registered_on_counts_by_age["31-34"][date_key_date] += date_count
+            age_counts = registered_on_counts_by_age["31-34"]
         elif age > 24:
-            registered_on_counts_by_age["25-30"][date_key_date] += date_count
+            age_counts = registered_on_counts_by_age["25-30"]
         elif age > 19:
-            registered_on_counts_by_age["20-24"][date_key_date] += date_count
+            age_counts = registered_on_counts_by_age["20-24"]
         elif age > 14:
-            registered_on_counts_by_age["15-19"][date_key_date] += date_count
+            age_counts = registered_on_counts_by_age["15-19"]
         else:
-            registered_on_counts_by_age["0-14"][date_key_date] += date_count
+            age_counts = registered_on_counts_by_age["0-14"]
+
+        for date_ordinal, date_count in year_counts.items():
+            if date_ordinal > start:
+                age_counts[dates_map.get(date_ordinal)] += date_count
 
     ages = AgeSegment.objects.all().values("id", "min_age", "max_age")
     output_data = []
@@ -665,37 +895,33 @@ def get_sign_up_rate_age(org, time_filter):
 
 
 def get_sign_up_rate_scheme(org, time_filter):
+    from ureport.stats.models import SchemeSegment
+
     now = timezone.now()
     year_ago = now - timedelta(days=365)
-    start = year_ago.replace(day=1)
-    tz = zoneinfo.ZoneInfo("UTC")
+    start = year_ago.replace(day=1).date().toordinal()
 
-    org_contacts_counts = get_org_contacts_counts(org)
+    org_contacts_counts_snapshot = get_org_contacts_counts_snapshot(org)
 
-    registered_on_counts = {k[18:]: v for k, v in org_contacts_counts.items() if k.startswith("registered_scheme")}
+    registered_on_counts = org_contacts_counts_snapshot["registered_scheme"]
 
-    schemes = [k[7:] for k, v in org_contacts_counts.items() if k.startswith("scheme:") if k[7:] and k[7:] != "ext"]
+    schemes = [k for k in org_contacts_counts_snapshot["scheme"].keys() if k and k != "ext"]
     registered_on_counts_by_scheme = {}
 
     for scheme in schemes:
         registered_on_counts_by_scheme[scheme] = defaultdict(int)
 
-    dates_map = get_time_filter_dates_map(time_filter=time_filter)
+    dates_map = get_time_filter_ordinals_map(time_filter=time_filter)
     keys = list(set(dates_map.values()))
 
-    for date_key, date_count in registered_on_counts.items():
-        date_key_date, scheme = date_key.split(":")
-        parsed_time = datetime.strptime(date_key_date, "%Y-%m-%d").replace(
-            hour=0, minute=0, second=0, microsecond=0, tzinfo=tz
-        )
-        if parsed_time < start:
-            continue
-
-        date_key_date = dates_map.get(str(parsed_time.date()))
+    for scheme, scheme_counts in registered_on_counts.items():
+        for date_ordinal, date_count in scheme_counts.items():
+            if date_ordinal <= start:
+                continue
 
-        if scheme not in registered_on_counts_by_scheme:
-            registered_on_counts_by_scheme[scheme] = defaultdict(int)
-        registered_on_counts_by_scheme[scheme][date_key_date] += date_count
+            if scheme not in registered_on_counts_by_scheme:
+                registered_on_counts_by_scheme[scheme] = defaultdict(int)
+            registered_on_counts_by_scheme[scheme][dates_map.get(date_ordinal)] += date_count
 
     output_data = []
     for scheme in registered_on_counts_by_scheme.keys():
@@ -716,21 +942,17 @@ def get_registration_stats(org):
     now = timezone.now()
     six_months_ago = now - timedelta(days=180)
     six_months_ago = six_months_ago - timedelta(six_months_ago.weekday())
-    tz = zoneinfo.ZoneInfo("UTC")
-
-    org_contacts_counts = get_org_contacts_counts(org)
+    start_ordinal = six_months_ago.date().toordinal()
 
-    registered_on_counts = {k[14:]: v for k, v in org_contacts_counts.items() if k.startswith("registered_on")}
+    registered_on_counts = get_org_contacts_counts_snapshot(org)["registered_on"]
 
     interval_dict = dict()
 
-    for date_key, date_count in registered_on_counts.items():
-        parsed_time = datetime.strptime(date_key, "%Y-%m-%d").replace(tzinfo=tz)
-
+    for date_ordinal, date_count in registered_on_counts.items():
         # this is in the range we care about
-        if parsed_time > six_months_ago:
+        if date_ordinal > start_ordinal:
             # get the week of the year
-            dict_key = parsed_time.strftime("%W")
+            dict_key = date.fromordinal(date_ordinal).strftime("%W")
 
             if interval_dict.get(dict_key, None):
                 interval_dict[dict_key] += date_count
@@ -754,21 +976,17 @@ def get_reporter_registration_dates(org):
     now = timezone.now()
     one_year_ago = now - timedelta(days=365)
     one_year_ago = one_year_ago - timedelta(one_year_ago.weekday())
-    tz = zoneinfo.ZoneInfo("UTC")
+    start_ordinal = one_year_ago.date().toordinal()
 
-    org_contacts_counts = get_org_contacts_counts(org)
-
-    registered_on_counts = {k[14:]: v for k, v in org_contacts_counts.items() if k.startswith("registered_on")}
+    registered_on_counts = get_org_contacts_counts_snapshot(org)["registered_on"]
 
     interval_dict = dict()
 
-    for date_key, date_count in registered_on_counts.items():
-        parsed_time = datetime.strptime(date_key, "%Y-%m-%d").replace(tzinfo=tz)
-
+    for date_ordinal, date_count in registered_on_counts.items():
         # this is in the range we care about
-        if parsed_time > one_year_ago:
+        if date_ordinal > start_ordinal:
             # get the week of the year
-            dict_key = parsed_time.strftime("%W")
+            dict_key = date.fromordinal(date_ordinal).strftime("%W")
 
             if interval_dict.get(dict_key, None):
                 interval_dict[dict_key] += date_count
@@ -811,7 +1029,7 @@ def get_ureporters_locations_stats(org, segment):
 
     field_type = field_type.lower()
 
-    org_contacts_counts = get_org_contacts_counts(org)
+    location_counts = get_org_contacts_counts_snapshot(org)[field_type]
 
     if field_type == "state":
         boundary_top_level = Boundary.COUNTRY_LEVEL if org.get_config("common.is_global") else Boundary.STATE_LEVEL
@@ -820,7 +1038,6 @@ def get_ureporters_locations_stats(org, segment):
             .values("osm_id", "name")
             .order_by("osm_id")
         )
-        location_counts = {k[6:]: v for k, v in org_contacts_counts.items() if k.startswith("state")}
 
     elif field_type == "ward":
         boundaries = (
@@ -828,7 +1045,6 @@ def get_ureporters_locations_stats(org, segment):
             .values("osm_id", "name")
             .order_by("osm_id")
         )
-        location_counts = {k[5:]: v for k, v in org_contacts_counts.items() if k.startswith("ward")}
     else:
         boundaries = (
             Boundary.objects.filter(
@@ -837,7 +1053,6 @@ def get_ureporters_locations_stats(org, segment):
             .values("osm_id", "name")
             .order_by("osm_id")
         )
-        location_counts = {k[9:]: v for k, v in org_contacts_counts.items() if k.startswith("district")}
 
     return [
         dict(boundary=elt["osm_id"], label=elt["name"], set=location_counts.get(elt["osm_id"], 0))
@@ -846,6 +1061,8 @@ def get_ureporters_locations_stats(org, segment):
 
 
 def get_ureporters_locations_response_rates(org, segment):
+    from ureport.stats.models import PollStats
+
     parent = segment.get("parent", None)
     field_type = segment.get("location", None)
 
@@ -916,9 +1133,7 @@ def get_reporters_count(org):
 
 
 def get_occupation_stats(org):
-    org_contacts_counts = get_org_contacts_counts(org)
-
-    occupation_counts = {k[11:]: v for k, v in org_contacts_counts.items() if k.startswith("occupation")}
+    occupation_counts = get_org_contacts_counts_snapshot(org)["occupation"]
 
     return json.dumps(
         sorted(
@@ -934,10 +1149,9 @@ def get_occupation_stats(org):
 
 
 def get_regions_stats(org):
-    org_contacts_counts = get_org_contacts_counts(org)
     boundaries_name = Boundary.get_org_top_level_boundaries_name(org)
 
-    boundaries_stats = {k[6:]: v for k, v in org_contacts_counts.items() if len(k) > 7 and k.startswith("state")}
+    boundaries_stats = {k: v for k, v in get_org_contacts_counts_snapshot(org)["state"].items() if len(k) > 1}
 
     regions_stats = sorted(
         [dict(name=boundaries_name[k], count=v) for k, v in boundaries_stats.items() if k and k in boundaries_name],
@@ -988,53 +1202,112 @@ def get_segment_org_boundaries(org, segment):
     return location_boundaries
 
 
-def populate_age_and_gender_poll_results(org=None):
+# copies the born and gender of a range of contacts to their poll results when they differ, returning the distinct
+# org and flow of the poll results changed
+POPULATE_AGE_AND_GENDER_SQL = """
+    WITH updated AS (
+      UPDATE polls_pollresult r SET
+        "born" = CASE WHEN c."born" > 0 THEN c."born" ELSE r."born" END,
+        "gender" = COALESCE(NULLIF(c."gender", ''), r."gender")
+      FROM contacts_contact c
+      WHERE c."id" > %(min_id)s AND c."id" <= %(max_id)s AND (%(org_id)s IS NULL OR c."org_id" = %(org_id)s)
+        AND r."org_id" = c."org_id" AND r."contact" = c."uuid"
+        AND (
+          (c."born" > 0 AND r."born" IS DISTINCT FROM c."born")
+          OR (NULLIF(c."gender", '') IS NOT NULL AND r."gender" IS DISTINCT FROM c."gender")
+        )
+      RETURNING r."org_id", r."flow"
+    )
+    SELECT DISTINCT "org_id", "flow" FROM updated
+"""
+
+# copies the born and gender of a range of contacts to their contact activities of the last year when they differ
+POPULATE_AGE_AND_GENDER_ACTIVITIES_SQL = """
+    UPDATE stats_contactactivity a SET
+      "born" = CASE WHEN c."born" > 0 THEN c."born" ELSE a."born" END,
+      "gender" = COALESCE(NULLIF(c."gender", ''), a."gender")
+    FROM contacts_contact c
+    WHERE c."id" > %(min_id)s AND c."id" <= %(max_id)s AND (%(org_id)s IS NULL OR c."org_id" = %(org_id)s)
+      AND a."org_id" = c."org_id" AND a."contact" = c."uuid"
+      AND a."date" > DATE_TRUNC('month', CURRENT_DATE) - INTERVAL '1 year'
+      AND (
+        (c."born" > 0 AND a."born" IS DISTINCT FROM c."born")
+        OR (NULLIF(c."gender", '') IS NOT NULL AND a."gender" IS DISTINCT FROM c."gender")
+      )
+"""
+
+
+def populate_age_and_gender_poll_results(org=None, batch_size=5000):
+    """
+    Populates the born and gender of the poll results from their contacts, of all orgs resuming after the last
+    contact populated or of the given org, and returns the (org id, flow uuid) of the poll results changed
+    """
     from ureport.contacts.models import Contact
 
     LAST_POPULATED_CONTACT = "last-contact-id-populated"
 
-    last_contact_id_populated = cache.get(LAST_POPULATED_CONTACT, 0)
-
-    all_contacts = Contact.objects.filter(id__gt=last_contact_id_populated).values_list("id", flat=True).order_by("id")
-
+    contacts = Contact.objects.all()
+    max_id = 0
     if org is not None:
-        all_contacts = Contact.objects.filter(org=org).values_list("id", flat=True).order_by("id")
+        contacts = contacts.filter(org=org)
+    else:
+        max_id = cache.get(LAST_POPULATED_CONTACT, 0)
 
     start = time.time()
-    i = 0
+    num_contacts = 0
+    updated_flows = set()
 
-    all_contacts = list(all_contacts)
-
-    for contact_id_batch in chunk_list(all_contacts, 1000):
-        contact_batch = list(contact_id_batch)
-        contacts = Contact.objects.filter(id__in=contact_batch)
-        for contact in contacts:
-            i += 1
+    while True:
+        batch_ids = list(contacts.filter(id__gt=max_id).order_by("id").values_list("id", flat=True)[:batch_size])
+        if not batch_ids:
+            break
 
-            update_fields = dict()
-            if contact.born > 0:
-                update_fields["born"] = contact.born
+        params = dict(org_id=org.id if org else None, min_id=max_id, max_id=batch_ids[-1])
+        with connection.cursor() as cursor:
+            cursor.execute(POPULATE_AGE_AND_GENDER_SQL, params)
+            updated_flows.update(cursor.fetchall())
 
-            if contact.gender != "":
-                update_fields["gender"] = contact.gender
+            cursor.execute(POPULATE_AGE_AND_GENDER_ACTIVITIES_SQL, params)
 
-            if update_fields:
-                results_ids = list(PollResult.objects.filter(contact=contact.uuid).values_list("id", flat=True))
-                PollResult.objects.filter(id__in=results_ids).update(**update_fields)
+        max_id = batch_ids[-1]
+        num_contacts += len(batch_ids)
 
-            if org is None:
-                cache.set(LAST_POPULATED_CONTACT, contact.pk, None)
+        if org is None:
+            cache.set(LAST_POPULATED_CONTACT, max_id, None)
 
         logger.info(
-            "Processed poll results update %d / %d contacts in %ds" % (i, len(all_contacts), time.time() - start)
+            "Processed poll results update %d contacts, %d flows changed in %ds"
+            % (num_contacts, len(updated_flows), time.time() - start)
         )
 
+    return updated_flows
+
+
+# selects the oldest result before now and the newest result after the start date of each contact of a range, the
+# results the contact activities of the contacts are generated from
+CONTACTS_FIRST_AND_LAST_RESULTS_SQL = """
+    WITH ranked AS (
+      SELECT r."id", r."date",
+        ROW_NUMBER() OVER (PARTITION BY r."contact" ORDER BY r."date", r."id") AS "oldest_rank",
+        ROW_NUMBER() OVER (PARTITION BY r."contact" ORDER BY r."date" DESC, r."id" DESC) AS "newest_rank"
+      FROM polls_pollresult r
+      INNER JOIN contacts_contact c ON c."org_id" = r."org_id" AND c."uuid" = r."contact"
+      WHERE c."org_id" = %(org_id)s AND c."id" > %(min_id)s AND c."id" <= %(max_id)s
+        AND r."org_id" = %(org_id)s AND r."flow" = ANY(%(flows)s) AND r."date" IS NOT NULL
+        AND r."category" IS NOT NULL
+    )
+    SELECT r.* FROM polls_pollresult r
+    INNER JOIN ranked ON ranked."id" = r."id"
+    WHERE (ranked."oldest_rank" = 1 AND ranked."date" < %(now)s)
+      OR (ranked."newest_rank" = 1 AND ranked."date" > %(start_date)s)
+"""
 
-def populate_contact_activity(org):
+
+def populate_contact_activity(org, batch_size=5000):
     from ureport.contacts.models import Contact
+    from ureport.stats.models import ContactActivity
 
     now = timezone.now()
-    now_month = now.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
     start_date = now - timedelta(days=365)
 
     flows = list(
@@ -1042,47 +1315,30 @@ def populate_contact_activity(org):
         .only("flow_uuid")
         .values_list("flow_uuid", flat=True)
     )
+    if not flows:
+        return
 
-    all_contacts = Contact.objects.filter(org=org).values_list("id", flat=True).order_by("id")
+    contacts = Contact.objects.filter(org=org)
 
     start = time.time()
-    i = 0
-
-    all_contacts = list(all_contacts)
-
-    for contact_id_batch in chunk_list(all_contacts, 1000):
-        contact_batch = list(contact_id_batch)
-        contacts = Contact.objects.filter(id__in=contact_batch)
-        for contact in contacts:
-            i += 1
-            results = PollResult.objects.filter(contact=contact.uuid, org_id=org.id, flow__in=flows).exclude(date=None)
-
-            oldest_id = None
-            newest_id = None
-            oldest_seen = now
-            newest_seen = start_date
-            for result in results:
-                if result.date > newest_seen:
-                    newest_seen = result.date
-                    newest_id = result.id
-                if result.date < oldest_seen:
-                    oldest_seen = result.date
-                    oldest_id = result.id
-
-                if oldest_seen <= start_date and newest_seen >= now_month:
-                    break
-
-            ids_to_update = []
-            if oldest_id:
-                ids_to_update.append(oldest_id)
-            if newest_id:
-                ids_to_update.append(newest_id)
-
-            PollResult.objects.filter(id__in=ids_to_update).update(contact=contact.uuid)
+    num_contacts = 0
+    max_id = 0
 
-        logger.info(
-            "Processed poll results update %d / %d contacts in %ds" % (i, len(all_contacts), time.time() - start)
+    while True:
+        batch_ids = list(contacts.filter(id__gt=max_id).order_by("id").values_list("id", flat=True)[:batch_size])
+        if not batch_ids:
+            break
+
+        poll_results = PollResult.objects.raw(
+            CONTACTS_FIRST_AND_LAST_RESULTS_SQL,
+            dict(org_id=org.id, min_id=max_id, max_id=batch_ids[-1], flows=flows, now=now, start_date=start_date),
         )
+        ContactActivity.update_for_poll_results(org.id, list(poll_results))
+
+        max_id = batch_ids[-1]
+        num_contacts += len(batch_ids)
+
+        logger.info("Processed poll results update %d contacts in %ds" % (num_contacts, time.time() - start))
 
 
 Org.get_gender_labels = get_gender_labels
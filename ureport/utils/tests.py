@@ -2,26 +2,33 @@
 from __future__ import absolute_import, division, print_function, unicode_literals
 
 import json
+import time
 import zoneinfo
-from datetime import datetime
+from datetime import date, datetime, timedelta
 
 import mock
 import redis
 from mock import patch
+from temba_client.exceptions import TembaRateExceededError
 from temba_client.v2 import Flow
 
 from django.conf import settings
+from django.core.cache import cache
 from django.utils import timezone
 
 from dash.categories.models import Category
 from dash.test import MockClientQuery, MockResponse
-from ureport.contacts.models import ReportersCounter
+from ureport.contacts.models import Contact, ReportersCounter
 from ureport.locations.models import Boundary
-from ureport.polls.models import CACHE_ORG_FLOWS_KEY, UREPORT_ASYNC_FETCHED_DATA_CACHE_TIME, Poll
+from ureport.polls.models import CACHE_ORG_FLOWS_KEY, UREPORT_ASYNC_FETCHED_DATA_CACHE_TIME, Poll, PollResult
+from ureport.stats.models import ContactActivity
 from ureport.tests import UreportTest
 from ureport.utils import (
     GLOBAL_COUNT_CACHE_KEY,
     ORG_CONTACT_COUNT_KEY,
+    ORG_CONTACT_COUNT_SNAPSHOT_KEY,
+    BloomFilter,
+    build_org_contacts_counts_snapshot,
     datetime_to_json_date,
     fetch_flows,
     fetch_old_sites_count,
@@ -32,11 +39,16 @@ from ureport.utils import (
     get_linked_orgs,
     get_occupation_stats,
     get_org_contacts_counts,
+    get_org_contacts_counts_snapshot,
     get_regions_stats,
     get_registration_stats,
     get_reporters_count,
     get_ureporters_locations_stats,
     json_date_to_datetime,
+    map_concurrently,
+    populate_age_and_gender_poll_results,
+    populate_contact_activity,
+    prefetch_iter,
     update_poll_flow_data,
 )
 
@@ -71,6 +83,55 @@ class UtilsTest(UreportTest):
         self.assertEqual(json_date_to_datetime("2014-01-02T01:04:05.000Z"), d2)
         self.assertEqual(json_date_to_datetime("2014-01-02T01:04:05.000"), d2)
 
+    def test_bloom_filter(self):
+        bloom = BloomFilter(1000)
+        self.assertNotIn("C-001", bloom)
+
+        bloom.update("C-%04d" % i for i in range(1000))
+        for i in range(1000):
+            self.assertIn("C-%04d" % i, bloom)
+
+        false_positives = sum(1 for i in range(1000, 11000) if "C-%04d" % i in bloom)
+        self.assertLess(false_positives, 300)
+
+    def test_prefetch_iter(self):
+        self.assertEqual(list(prefetch_iter(range(10))), list(range(10)))
+        self.assertEqual(list(prefetch_iter(range(10), size=0)), list(range(10)))
+        self.assertEqual(list(prefetch_iter([])), [])
+
+        def failing_fetches():
+            yield [1, 2]
+            raise TembaRateExceededError(0)
+
+        fetches = prefetch_iter(failing_fetches())
+        self.assertEqual(next(fetches), [1, 2])
+        with self.assertRaises(TembaRateExceededError):
+            next(fetches)
+
+        def interrupted_fetches():
+            yield [1, 2]
+            raise SystemExit()
+
+        fetches = prefetch_iter(interrupted_fetches())
+        self.assertEqual(next(fetches), [1, 2])
+        with self.assertRaises(SystemExit):
+            next(fetches)
+
+        consumed = []
+
+        def counted_fetches():
+            for i in range(100):
+                consumed.append(i)
+                yield i
+
+        fetches = prefetch_iter(counted_fetches(), size=2)
+        self.assertEqual(next(fetches), 0)
+        fetches.close()
+
+        # the producer stops shortly after the consumer closes, without reading the whole iterable
+        time.sleep(0.3)
+        self.assertTrue(len(consumed) <= 5)
+
     @mock.patch("ureport.utils.get_shared_sites_count")
     def test_get_linked_orgs(self, mock_get_shared_sites_count):
         settings_sites = list(getattr(settings, "COUNTRY_FLAGS_SITES", []))
@@ -214,6 +275,25 @@ class UtilsTest(UreportTest):
             self.assertFalse(poll.flow_archived)
             self.assertEqual(poll.runs_count, 2)
 
+            # unchanged flows and polls are not checked again
+            mock_get_flows.return_value = {"uuid-1": {"uuid": "uuid-1", "runs": 2}}
+            update_poll_flow_data(self.org)
+
+            # even after a sync modified the poll
+            poll = Poll.objects.get(pk=self.poll.pk)
+            poll.modified_on = timezone.now()
+            poll.save()
+
+            with patch("django.core.cache.cache.set") as mock_cache_set:
+                update_poll_flow_data(self.org)
+                mock_cache_set.assert_not_called()
+
+            # but a poll drifting from its flow is
+            Poll.objects.filter(pk=self.poll.pk).update(runs_count=7)
+
+            update_poll_flow_data(self.org)
+            self.assertEqual(Poll.objects.get(pk=self.poll.pk).runs_count, 2)
+
     def test_fetch_old_sites_count(self):
         self.clear_cache()
 
@@ -222,7 +302,7 @@ class UtilsTest(UreportTest):
         with patch("ureport.utils.datetime_to_ms") as mock_datetime_ms:
             mock_datetime_ms.return_value = 500
 
-            with patch("requests.get") as mock_get:
+            with patch("requests.Session.get") as mock_get:
                 mock_get.return_value = MockResponse(200, b"300")
 
                 with patch("django.core.cache.cache.set") as cache_set_mock:
@@ -238,7 +318,7 @@ class UtilsTest(UreportTest):
                             * len([elt for elt in settings_sites if elt["count_link"]]),
                         )
 
-                        mock_get.assert_called_with("https://www.ureport.in/count/")
+                        mock_get.assert_called_with("https://www.ureport.in/count/", timeout=30)
 
                         cache_set_mock.assert_called_with(
                             "org:global:reporters:old-site",
@@ -248,6 +328,104 @@ class UtilsTest(UreportTest):
 
                         cache_delete_mock.assert_called_once_with(GLOBAL_COUNT_CACHE_KEY)
 
+        with patch("requests.Session.get") as mock_get:
+            mock_get.side_effect = [MockResponse(200, b"300"), Exception("Timed out")] + [
+                MockResponse(200, b"300")
+            ] * len(settings_sites)
+
+            with patch("django.core.cache.cache.set"), patch("django.core.cache.cache.delete") as cache_delete_mock:
+                old_site_values = fetch_old_sites_count()
+
+                # a failing site is left out without stopping the others
+                self.assertEqual(len(old_site_values), len([elt for elt in settings_sites if elt["count_link"]]) - 1)
+                cache_delete_mock.assert_called_once_with(GLOBAL_COUNT_CACHE_KEY)
+
+    def test_populate_age_and_gender_poll_results(self):
+        Contact.objects.create(org=self.org, uuid="C-001", born=1990, gender="F")
+        Contact.objects.create(org=self.org, uuid="C-002", born=0, gender="")
+        Contact.objects.create(org=self.org, uuid="C-003", born=1980, gender="M")
+        Contact.objects.create(org=self.uganda, uuid="C-001", born=2000, gender="M")
+
+        def create_result(org, flow, contact, **kwargs):
+            return PollResult.objects.create(
+                org=org, flow=flow, ruleset="ruleset-uuid", contact=contact, completed=True, **kwargs
+            )
+
+        result1 = create_result(self.org, "flow-1", "C-001")
+        result2 = create_result(self.org, "flow-2", "C-002", born=1970, gender="M")
+        result3 = create_result(self.org, "flow-3", "C-003", born=1980, gender="M")
+        result4 = create_result(self.uganda, "flow-4", "C-001")
+
+        this_month = timezone.now().date().replace(day=1)
+        activity = ContactActivity.objects.create(org=self.org, contact="C-001", date=this_month)
+        old_activity = ContactActivity.objects.create(org=self.org, contact="C-001", date=date(2015, 1, 1))
+
+        self.assertEqual(populate_age_and_gender_poll_results(self.org, batch_size=2), {(self.org.id, "flow-1")})
+
+        # the born and gender are copied to the contact activities of the last year too
+        activity.refresh_from_db()
+        self.assertEqual((activity.born, activity.gender), (1990, "F"))
+        old_activity.refresh_from_db()
+        self.assertEqual((old_activity.born, old_activity.gender), (None, None))
+
+        result1.refresh_from_db()
+        self.assertEqual((result1.born, result1.gender), (1990, "F"))
+
+        # contacts without born or gender keep those of their results
+        result2.refresh_from_db()
+        self.assertEqual((result2.born, result2.gender), (1970, "M"))
+
+        # results of other orgs are left alone
+        result4.refresh_from_db()
+        self.assertEqual((result4.born, result4.gender), (None, None))
+
+        # nothing changes when run again
+        self.assertEqual(populate_age_and_gender_poll_results(self.org), set())
+
+        Contact.objects.filter(org=self.org, uuid="C-003").update(gender="F")
+        self.assertEqual(populate_age_and_gender_poll_results(self.org), {(self.org.id, "flow-3")})
+        result3.refresh_from_db()
+        self.assertEqual((result3.born, result3.gender), (1980, "F"))
+
+    def test_populate_contact_activity(self):
+        result_date = timezone.now() - timedelta(days=40)
+        for uuid in ("C-001", "C-002", "C-003"):
+            Contact.objects.create(org=self.org, uuid=uuid)
+
+        for uuid, flow in (("C-001", "uuid-1"), ("C-001", "uuid-1"), ("C-002", "uuid-1"), ("C-003", "old-flow")):
+            PollResult.objects.create(
+                org=self.org,
+                flow=flow,
+                ruleset="ruleset-uuid",
+                contact=uuid,
+                category="Yes",
+                date=result_date,
+                completed=True,
+            )
+
+        ContactActivity.objects.filter(org=self.org).delete()
+
+        populate_contact_activity(self.org, batch_size=2)
+
+        self.assertEqual(
+            set(ContactActivity.objects.filter(org=self.org).values_list("contact", flat=True)), {"C-001", "C-002"}
+        )
+        self.assertEqual(ContactActivity.objects.filter(org=self.org, contact="C-001").count(), 12)
+
+    def test_map_concurrently(self):
+        def square(value):
+            if value == 3:
+                raise ValueError("Bad value")
+            return value * value
+
+        for max_workers in (1, 4):
+            results = map_concurrently(square, range(6), max_workers=max_workers)
+
+            self.assertEqual([result for result, error in results], [0, 1, 4, None, 16, 25])
+            self.assertEqual([type(error) for result, error in results if error], [ValueError])
+
+        self.assertEqual(map_concurrently(square, []), [])
+
     def test_get_gender_labels(self):
         self.assertEqual(self.org.get_gender_labels(), {"M": "Male", "F": "Female", "O": "Other"})
 
@@ -513,10 +691,54 @@ class UtilsTest(UreportTest):
 
                     self.assertEqual(get_org_contacts_counts(self.org), {"total-reporters": 50})
                     mock_get_counts.assert_called_once_with(self.org)
-                    mock_cache_set.assert_called_once_with(
-                        ORG_CONTACT_COUNT_KEY % self.org.pk, {"total-reporters": 50}, None
+                    self.assertEqual(mock_cache_set.call_count, 2)
+                    mock_cache_set.assert_any_call(ORG_CONTACT_COUNT_KEY % self.org.pk, {"total-reporters": 50}, None)
+                    mock_cache_set.assert_any_call(
+                        ORG_CONTACT_COUNT_SNAPSHOT_KEY % self.org.pk,
+                        build_org_contacts_counts_snapshot({"total-reporters": 50}),
+                        None,
                     )
 
+    def test_build_org_contacts_counts_snapshot(self):
+        snapshot = build_org_contacts_counts_snapshot(
+            {
+                "total-reporters": 9,
+                "born:1990": 2,
+                "born:10": 3,
+                "gender:m": 4,
+                "state:R-LAGOS": 3,
+                "scheme:tel": 1,
+                "registered_on:2014-01-02": 5,
+                "registered_on:not-a-date": 1,
+                "registered_born:2014-01-02:1990": 1,
+                "registered_state:2014-01-02:R-LAGOS": 4,
+                "registered_gender:2014-01-02:m": 1,
+                "registered_scheme:2014-01-03:tel": 2,
+            }
+        )
+
+        ordinal = date(2014, 1, 2).toordinal()
+        self.assertEqual(snapshot["born"], {1990: 2})
+        self.assertEqual(snapshot["state"], {"R-LAGOS": 3})
+        self.assertEqual(snapshot["scheme"], {"tel": 1})
+        self.assertEqual(snapshot["district"], {})
+        self.assertEqual(snapshot["registered_on"], {ordinal: 5})
+        self.assertEqual(snapshot["registered_born"], {1990: {ordinal: 1}})
+        self.assertEqual(snapshot["registered_state"], {"R-LAGOS": {ordinal: 4}})
+        self.assertEqual(snapshot["registered_gender"], {"m": {ordinal: 1}})
+        self.assertEqual(snapshot["registered_scheme"], {"tel": {ordinal + 1: 2}})
+
+    def test_get_org_contacts_counts_snapshot(self):
+        cache.delete(ORG_CONTACT_COUNT_KEY % self.org.pk)
+        cache.delete(ORG_CONTACT_COUNT_SNAPSHOT_KEY % self.org.pk)
+
+        # read before the org has any counters, the empty snapshot is cached but not kept once counters exist
+        self.assertEqual(get_org_contacts_counts_snapshot(self.org)["state"], {})
+
+        ReportersCounter.objects.create(org=self.org, type="state:R-LAGOS", count=5)
+
+        self.assertEqual(get_org_contacts_counts_snapshot(self.org)["state"], {"R-LAGOS": 5})
+
     def test_get_flows(self):
         with patch("ureport.utils.fetch_flows") as mock_fetch_flows:
             mock_fetch_flows.return_value = "Fetched"